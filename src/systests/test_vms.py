@@ -50,6 +50,7 @@ class TestSessionStartClose:
     def assert_session_running(self):
         assert self.all_client_clones_exist()
         assert self.all_servers_running()
+        assert self.session.verify_clones() == []
 
     def close_session(self):
         self.session.close_session()
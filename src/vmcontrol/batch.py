@@ -0,0 +1,160 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import io
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+from vmcontrol.vmmcontroller.vmmconsole import command_status
+
+
+class BatchCommand(SimpleNamespace):
+    line_number = None
+    command = None
+    background = False
+    succeeded = None
+    output = ""
+    duration = None
+
+    def __str__(self):
+        return "{status:<6} {duration:7.1f}s  line {line_number}: {command}{background}".format(
+            status="ok" if self.succeeded else "FAILED", duration=self.duration or 0.0,
+            line_number=self.line_number, command=self.command, background=" &" if self.background else "")
+
+
+class ThreadOutput(io.TextIOBase):
+    # Sends the output of every thread that registered a buffer there, everything else to the original stream
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def capture(self, buffer):
+        self._local.buffer = buffer
+
+    def write(self, s):
+        buffer = getattr(self._local, "buffer", None)
+        return (buffer if buffer is not None else self.stream).write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def parse_batch(lines):
+    # One console command per line. A trailing "&" runs the command in the background, the next foreground
+    # command or a "wait" line waits for all background commands. Empty lines and "#" comments are skipped.
+    commands = list()
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        background = line.endswith("&")
+        if background:
+            line = line[:-1].rstrip()
+        commands.append(BatchCommand(line_number=line_number, command=line, background=background))
+    return commands
+
+
+class BatchRunner:
+    def __init__(self, console, max_parallel=8, keep_going=False, out=None):
+        self.console = console
+        self.max_parallel = max_parallel
+        self.keep_going = keep_going
+        self.out = out if out is not None else sys.stdout
+        self._output = None
+        self._print_lock = threading.Lock()
+        # The session handler is not thread-safe, so commands that change it never run at the same time
+        self._exclusive_lock = threading.Lock()
+
+    def run(self, lines):
+        commands = parse_batch(lines)
+        done = list()
+        pending = list()
+        self._output = ThreadOutput(sys.stdout)
+        sys.stdout = self._output
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+                for command in commands:
+                    if command.command == "wait":
+                        done.extend(self._wait(pending))
+                        continue
+                    if command.background:
+                        pending.append(executor.submit(self.run_command, command))
+                        continue
+                    done.extend(self._wait(pending))
+                    if command.command == "exit" or (self._failed(done) and not self.keep_going):
+                        break
+                    done.append(self.run_command(command))
+                    if self._failed(done) and not self.keep_going:
+                        break
+                done.extend(self._wait(pending))
+        finally:
+            sys.stdout = self._output.stream
+        self.report(done, len(commands))
+        return done
+
+    def run_command(self, command):
+        buffer = io.StringIO()
+        self._output.capture(buffer)
+        command_status.failed = False
+        start = time.perf_counter()
+        try:
+            name, _, _ = self.console.parseline(command.command)
+            if name is None or not hasattr(self.console, "do_" + name):
+                command_status.failed = True
+                print("Unknown command: {command}".format(command=command.command))
+            else:
+                with self._exclusive_lock if self.console.is_exclusive(name) else contextlib.nullcontext():
+                    self.console.onecmd(command.command)
+        except Exception as e:
+            # Commands only catch the errors they expect, e.g. missing arguments raise here
+            command_status.failed = True
+            print("*** {type}: {e}".format(type=type(e).__name__, e=e))
+        finally:
+            self._output.capture(None)
+        command.duration = time.perf_counter() - start
+        command.succeeded = not command_status.failed
+        command.output = buffer.getvalue()
+        with self._print_lock:
+            self.out.write("{command}\n".format(command=command))
+            if command.output:
+                self.out.write(command.output if command.output.endswith("\n") else command.output + "\n")
+            self.out.flush()
+        return command
+
+    @staticmethod
+    def _wait(futures):
+        wait(futures)
+        results = [future.result() for future in futures]
+        futures.clear()
+        return results
+
+    @staticmethod
+    def _failed(commands):
+        return any(not command.succeeded for command in commands)
+
+    def report(self, done, total):
+        failed = [command for command in done if not command.succeeded]
+        self.out.write("Batch summary: {run} of {total} commands run, {failed} failed\n".format(
+            run=len(done), total=total, failed=len(failed)))
+        for command in sorted(done, key=lambda command: command.line_number):
+            self.out.write("\t{command}\n".format(command=command))
+        self.out.flush()
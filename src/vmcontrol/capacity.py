@@ -0,0 +1,101 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+from types import SimpleNamespace
+
+capacity_policies = ("ignore", "refuse", "stagger")
+
+
+class CapacityEstimate(SimpleNamespace):
+    host_memory = None
+    host_cpus = None
+    memory = 0
+    cpus = 0
+    memory_reserve = 0
+    max_cpu_overcommit = 1.0
+    unknown_vms = ()
+
+    @property
+    def memory_headroom(self):
+        if self.host_memory is None:
+            return None
+        return self.host_memory - self.memory_reserve - self.memory
+
+    @property
+    def cpu_headroom(self):
+        if self.host_cpus is None:
+            return None
+        return self.host_cpus * self.max_cpu_overcommit - self.cpus
+
+    @property
+    def memory_fits(self):
+        return self.memory_headroom is None or self.memory_headroom >= 0
+
+    @property
+    def cpus_fit(self):
+        return self.cpu_headroom is None or self.cpu_headroom >= 0
+
+    def __str__(self):
+        lines = [
+            "Memory: {memory} MB of {host} MB ({reserve} MB reserved for the host), headroom {headroom} MB".format(
+                memory=self.memory, host=self.host_memory, reserve=self.memory_reserve,
+                headroom=self.memory_headroom),
+            "CPUs: {cpus} virtual CPUs on {host} host CPUs (at most {overcommit}x), headroom {headroom}".format(
+                cpus=self.cpus, host=self.host_cpus, overcommit=self.max_cpu_overcommit,
+                headroom=self.cpu_headroom),
+        ]
+        if self.unknown_vms:
+            lines.append("Unknown size: {vms}".format(vms=sorted(set(self.unknown_vms))))
+        return "\n".join(lines)
+
+
+class CapacityModel:
+    def __init__(self, memory_reserve=2048, max_cpu_overcommit=4.0):
+        self.memory_reserve = memory_reserve
+        self.max_cpu_overcommit = max_cpu_overcommit
+
+    def estimate(self, host_info, vm_infos):
+        # vm_infos lists every VM that will run, VMs that are not created yet are represented by their parent
+        estimate = CapacityEstimate(
+            host_memory=host_info.memory, host_cpus=host_info.cpus, memory_reserve=self.memory_reserve,
+            max_cpu_overcommit=self.max_cpu_overcommit, unknown_vms=list())
+        for vm_info in vm_infos:
+            if vm_info.memory is None or vm_info.cpus is None:
+                estimate.unknown_vms.append(vm_info.name)
+                continue
+            estimate.memory += vm_info.memory
+            estimate.cpus += vm_info.cpus
+        return estimate
+
+
+def start_batches(vms, cpus, cpu_budget):
+    # Splits vms in order into batches that need at most cpu_budget CPUs, every batch gets at least one VM
+    batches = list()
+    batch = list()
+    batch_cpus = 0
+    for vm in vms:
+        vm_cpus = cpus.get(vm) or 1
+        if batch and batch_cpus + vm_cpus > cpu_budget:
+            batches.append(batch)
+            batch = list()
+            batch_cpus = 0
+        batch.append(vm)
+        batch_cpus += vm_cpus
+    if batch:
+        batches.append(batch)
+    return batches
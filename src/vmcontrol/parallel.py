@@ -0,0 +1,80 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+
+class TaskResult(SimpleNamespace):
+    key = None
+    value = None
+    error = None
+    attempts = 0
+    duration = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    @property
+    def retried(self):
+        return self.attempts > 1
+
+
+def run_parallel(func, keys, max_workers=1, exceptions=(Exception,), retries=0, backoff=0.01, max_backoff=1.0,
+                 progress=None):
+    # Runs func(key) for every key with at most max_workers calls at a time. Exceptions listed in
+    # exceptions are retried with exponential backoff and finally stored in the result instead of
+    # being raised, so one failing key never aborts the others. Results keep the order of keys.
+    keys = list(keys)
+    lock = threading.Lock()
+    done = [0]
+
+    def run(key):
+        result = TaskResult(key=key)
+        delay = backoff
+        start = time.perf_counter()
+        while True:
+            result.attempts += 1
+            try:
+                result.value = func(key)
+                result.error = None
+                break
+            except exceptions as e:
+                result.error = e
+                if result.attempts > retries:
+                    break
+                time.sleep(delay)
+                delay = min(2 * delay, max_backoff)
+        result.duration = time.perf_counter() - start
+        if progress is not None:
+            with lock:
+                done[0] += 1
+                progress(done[0], len(keys), result)
+        return result
+
+    if max_workers is None or max_workers <= 1 or len(keys) <= 1:
+        return [run(key) for key in keys]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        return list(executor.map(run, keys))
+
+
+def failed_keys(results):
+    return [result.key for result in results if not result.succeeded]
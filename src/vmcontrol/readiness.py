@@ -0,0 +1,117 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import socket
+import time
+from types import SimpleNamespace
+
+from vmcontrol.parallel import run_parallel
+
+logger = logging.getLogger(__name__)
+
+
+class Probe(SimpleNamespace):
+    vm = None
+    host = None
+    port = 22
+    banner = None
+
+    def __str__(self):
+        return "{vm} ({host}:{port})".format(vm=self.vm, host=self.host, port=self.port)
+
+
+# Management addresses as used by attacks.ssh.SSHTargets
+server_probes = [
+    Probe(vm="Attacker", host="192.168.56.31", banner=b"SSH-"),
+    Probe(vm="Company Router", host="192.168.56.10", port=222, banner=b"SSH-"),
+    Probe(vm="DMZ Server", host="192.168.56.20", banner=b"SSH-"),
+    Probe(vm="Log Server", host="192.168.56.12", banner=b"SSH-"),
+    Probe(vm="Log Server", host="192.168.56.12", port=9200),
+    Probe(vm="Internal Server", host="192.168.56.11", banner=b"SSH-"),
+    Probe(vm="Internet Router", host="192.168.56.30", port=222, banner=b"SSH-"),
+]
+
+
+def client_probe(vm, client_id):
+    return Probe(vm=vm, host="192.168.56.{}".format(100 + client_id), banner=b"SSH-")
+
+
+class ReadinessChecker:
+    connect_timeout = 3
+    interval = 5
+
+    def __init__(self, probes, timeout=600, max_parallel=16, is_running=None, stable_time=0):
+        self.probes = list(probes)
+        self.timeout = timeout
+        self.max_parallel = max_parallel
+        self.is_running = is_running
+        # A probe only counts once it succeeded for this long without failing in between, e.g. to see through reboots
+        self.stable_time = stable_time
+
+    def wait(self):
+        logger.info("Waiting for {n} readiness probes".format(n=len(self.probes)))
+        deadline = time.monotonic() + self.timeout
+        results = run_parallel(
+            lambda probe: self.wait_for_probe(probe, deadline), self.probes,
+            max_workers=self.max_parallel, exceptions=(ReadinessException,)
+        )
+        failing = ["{probe}: {e}".format(probe=result.key, e=result.error) for result in results
+                   if not result.succeeded]
+        if failing:
+            raise ReadinessException("VMs not ready:\n" + "\n".join(failing))
+        logger.info("All VMs ready")
+        return results
+
+    def wait_for_probe(self, probe, deadline):
+        start = time.monotonic()
+        last_error = None
+        up_since = None
+        while True:
+            if self.is_running is not None and not self.is_running(probe.vm):
+                raise ReadinessException("VM is not running")
+            try:
+                self.check(probe)
+            except OSError as e:
+                if up_since is not None:
+                    logger.info("{probe} went down again: {e}".format(probe=probe, e=e))
+                last_error = e
+                up_since = None
+            else:
+                now = time.monotonic()
+                up_since = now if up_since is None else up_since
+                if now - up_since >= self.stable_time:
+                    duration = now - start
+                    logger.info("{probe} ready after {duration:.0f}s".format(probe=probe, duration=duration))
+                    return duration
+            if time.monotonic() + self.interval > deadline:
+                if up_since is not None:
+                    raise ReadinessException("Timeout, only up for {up:.0f}s".format(up=time.monotonic() - up_since))
+                raise ReadinessException("Timeout, last error: {e}".format(e=last_error))
+            time.sleep(self.interval)
+
+    def check(self, probe):
+        with socket.create_connection((probe.host, probe.port), timeout=self.connect_timeout) as sock:
+            if probe.banner is not None:
+                received = sock.recv(len(probe.banner))
+                if not received.startswith(probe.banner):
+                    raise ConnectionError("Unexpected banner {received}".format(received=received))
+
+
+class ReadinessException(Exception):
+    pass
@@ -17,5 +17,8 @@
 
 
 from vmcontrol.sessionhandler.sessionhandler import CloneCreator
-from vmcontrol.sessionhandler.sessionhandler import SessionHandler, SessionHandlerException, SessionConfig
+from vmcontrol.sessionhandler.sessionhandler import SessionHandler, SessionHandlerException, SessionConfig, \
+    TeardownReport
 from vmcontrol.sessionhandler.sessionconsole import SessionConsole
+from vmcontrol.sessionhandler.registry import SessionRegistry
+from vmcontrol.sessionhandler.clonebenchmark import CloneBenchmark
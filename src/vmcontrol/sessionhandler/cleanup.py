@@ -0,0 +1,121 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import re
+from types import SimpleNamespace
+
+from vmcontrol.parallel import run_parallel, failed_keys
+from vmcontrol.vmmcontroller import VMMController, VMMControllerException
+
+logger = logging.getLogger(__name__)
+
+
+def clone_pattern(client_vm, session_id=None):
+    # Names given by CloneCreator and SessionHandler.create_clone_bases
+    prefix = "" if session_id is None else re.escape(session_id + "-")
+    return re.compile(r"^{prefix}{client}(Clone\d+a*|Base\d+)$".format(prefix=prefix, client=re.escape(client_vm)))
+
+
+def backup_pattern(backup_snapshot, session_id=None):
+    suffix = "" if session_id is None else re.escape("-" + session_id)
+    return re.compile(r"^{backup}{suffix}\d*$".format(backup=re.escape(backup_snapshot), suffix=suffix))
+
+
+class CleanupPlan(SimpleNamespace):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("poweroff", list())
+        kwargs.setdefault("delete", list())
+        # Backup snapshots by VM, oldest first: the VM is restored to the first one, then all are deleted
+        kwargs.setdefault("restore", dict())
+        super().__init__(**kwargs)
+
+    @property
+    def empty(self):
+        return not (self.poweroff or self.delete or self.restore)
+
+    def _asdict(self):
+        return {"poweroff": self.poweroff, "delete": self.delete, "restore": self.restore}
+
+    def __str__(self):
+        if self.empty:
+            return "Nothing to clean up"
+        lines = ["Power off: {vms}".format(vms=self.poweroff), "Delete: {vms}".format(vms=self.delete),
+                 "Restore and delete snapshots:"]
+        for vm, snapshots in self.restore.items():
+            lines.append('\t"{vm}": restore {first}, delete {snapshots}'.format(
+                vm=vm, first=snapshots[0], snapshots=snapshots))
+        return "\n".join(lines)
+
+
+class SessionCleanup:
+    # Finds what a failed session left behind from one inventory query and the snapshots of the session VMs,
+    # without relying on the session state file or journal
+    def __init__(self, vmm_controller: VMMController, server_vms, client_vm, session_id=None,
+                 backup_snapshot="Backup", max_parallel=1, retries=3):
+        self.vmmc = vmm_controller
+        self.session_vms = list(server_vms) + [client_vm]
+        self.clone_pattern = clone_pattern(client_vm, session_id)
+        self.backup_pattern = backup_pattern(backup_snapshot, session_id)
+        self.max_parallel = max_parallel
+        self.retries = retries
+
+    def plan(self):
+        inventory = self.vmmc.get_inventory()
+        clones = [vm for vm in inventory if self.clone_pattern.match(vm)]
+        # Linked clones have to go before the clone bases they were made from
+        clones.sort(key=self.is_clone_base)
+        session_vms = [vm for vm in self.session_vms if vm in inventory]
+        poweroff = [vm for vm in session_vms + clones if inventory[vm]]
+        snapshots = self.vmmc.get_snapshots_many(session_vms)
+        restore = dict()
+        for vm in session_vms:
+            backups = [snapshot for snapshot in snapshots[vm] if self.backup_pattern.match(snapshot)]
+            if backups:
+                restore[vm] = backups
+        return CleanupPlan(poweroff=poweroff, delete=clones, restore=restore)
+
+    def execute(self, plan=None):
+        if plan is None:
+            plan = self.plan()
+        logger.info("Cleaning up:\n{plan}".format(plan=plan))
+        failing = dict()
+        failing["poweroff"] = self._run(self.vmmc.poweroff, plan.poweroff)
+        clone_bases = [vm for vm in plan.delete if self.is_clone_base(vm)]
+        clones = [vm for vm in plan.delete if vm not in clone_bases]
+        failing["delete"] = self._run(self.vmmc.delete, clones) + self._run(self.vmmc.delete, clone_bases)
+        failing["restore"] = self._run(lambda vm: self._restore_delete(vm, plan.restore[vm]), list(plan.restore))
+        return {step: vms for step, vms in failing.items() if vms}
+
+    def is_clone_base(self, vm):
+        match = self.clone_pattern.match(vm)
+        return match is not None and match.group(1).startswith("Base")
+
+    def _restore_delete(self, vm, snapshots):
+        existing_snapshots = self.vmmc.get_snapshots(vm)
+        if snapshots[0] in existing_snapshots:
+            self.vmmc.restore_snapshot(vm, snapshots[0])
+        for snapshot in reversed(snapshots):
+            if snapshot in existing_snapshots:
+                self.vmmc.delete_snapshot(vm, snapshot)
+
+    def _run(self, func, vms):
+        results = run_parallel(
+            func, vms, max_workers=self.max_parallel, exceptions=(VMMControllerException,), retries=self.retries
+        )
+        return failed_keys(results)
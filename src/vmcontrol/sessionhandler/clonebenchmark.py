@@ -0,0 +1,136 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+from types import SimpleNamespace
+
+from vmcontrol.sessionhandler.sessionhandler import SessionHandler, SessionHandlerException, SessionConfig, \
+    clone_strategies
+from vmcontrol.tracing import Tracer
+from vmcontrol.vmmcontroller import VMMController
+
+logger = logging.getLogger(__name__)
+
+sector_size = 512
+
+
+def read_disk_stats(diskstats="/proc/diskstats", block_devices="/sys/block"):
+    # Bytes read and written by all physical disks of this host since boot, None where unavailable.
+    # Only meaningful if the hypervisor stores its VMs on this host.
+    try:
+        with open(diskstats) as f:
+            lines = f.readlines()
+        devices = [device for device in os.listdir(block_devices) if not device.startswith(("loop", "ram"))]
+    except OSError:
+        return None
+    read_bytes = written_bytes = 0
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 10 and fields[2] in devices:
+            read_bytes += int(fields[5]) * sector_size
+            written_bytes += int(fields[9]) * sector_size
+    return read_bytes, written_bytes
+
+
+class StrategyResult(SimpleNamespace):
+    strategy = None
+    clone_time = None
+    start_time = None
+    ready_time = None
+    read_bytes = None
+    written_bytes = None
+    error = None
+
+    def __str__(self):
+        def seconds(value):
+            return "{:7.1f}s".format(value) if value is not None else "       -"
+
+        def megabytes(value):
+            return "{:9.1f} MB".format(value / 2 ** 20) if value is not None else "        - MB"
+
+        line = "{strategy:<8} clone {clone} start {start} ready {ready} read {read} written {written}".format(
+            strategy=self.strategy, clone=seconds(self.clone_time), start=seconds(self.start_time),
+            ready=seconds(self.ready_time), read=megabytes(self.read_bytes), written=megabytes(self.written_bytes))
+        if self.error is not None:
+            line += "\n\terror: {error}".format(error=self.error)
+        return line
+
+
+class CloneBenchmark:
+    # Runs one complete session per clone strategy and measures how long cloning, starting and booting
+    # (until all readiness probes succeed) take and how much disk I/O the host sees meanwhile.
+    # With a session state file, every benchmark session is journaled like a normal one, so recover_session
+    # can clean up after a benchmark that was killed.
+    def __init__(self, vmm_controller: VMMController, session_config: SessionConfig, strategies=clone_strategies,
+                 wait_ready=True, disk_stats=read_disk_stats, session_state_file=None, registry=None):
+        self.vmmc = vmm_controller
+        self.config = session_config
+        self.session_state_file = session_state_file
+        self.registry = registry
+        self.strategies = list(strategies)
+        self.wait_ready = wait_ready
+        self.disk_stats = disk_stats
+
+    def run(self):
+        unknown_strategies = [strategy for strategy in self.strategies if strategy not in clone_strategies]
+        if unknown_strategies:
+            raise SessionHandlerException("Unknown clone strategies {strategies}".format(strategies=unknown_strategies))
+        return [self.run_strategy(strategy) for strategy in self.strategies]
+
+    def run_strategy(self, strategy):
+        logger.info("Benchmarking clone strategy {strategy}".format(strategy=strategy))
+        config = SessionConfig(**self.config._asdict())
+        config.clone_strategy = strategy
+        config.warm_pool = False
+        tracer = Tracer()
+        session_handler = SessionHandler(
+            self.vmmc, config, self.session_state_file, registry=self.registry, tracer=tracer)
+        result = StrategyResult(strategy=strategy)
+        disk_stats_before = self.disk_stats()
+        try:
+            try:
+                session_handler.start_session(wait_ready=self.wait_ready)
+            except SessionHandlerException as e:
+                result.error = str(e)
+            disk_stats_after = self.disk_stats()
+        finally:
+            # Also when interrupted, nothing of a benchmark session may stay behind
+            self.clean_up(session_handler)
+        totals = {op.op: op.total for op in tracer.summary(category="session")}
+        result.clone_time = totals.get("create_clones")
+        result.start_time = totals.get("start_all_vms")
+        result.ready_time = totals.get("wait_until_ready")
+        if disk_stats_before is not None and disk_stats_after is not None:
+            result.read_bytes = disk_stats_after[0] - disk_stats_before[0]
+            result.written_bytes = disk_stats_after[1] - disk_stats_before[1]
+        logger.info(str(result))
+        return result
+
+    @staticmethod
+    def clean_up(session_handler: SessionHandler):
+        if session_handler.session_running:
+            session_handler.close_session()
+            return
+        if session_handler.journal is not None and session_handler.journal.entries():
+            session_handler.recover_session()
+            return
+        # Starting failed before any VM was started
+        session_handler.delete_clones()
+        session_handler.delete_clone_bases()
+        session_handler.restore_delete_backup_snapshots()
@@ -0,0 +1,224 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import os
+import threading
+import time
+
+from vmcontrol.parallel import run_parallel, failed_keys
+from vmcontrol.vmmcontroller import VMMController, VMMControllerException
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return os.path.isfile(self.path)
+
+    def open(self):
+        with open(self.path, "w") as f:
+            os.fsync(f.fileno())
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def record(self, op, **kwargs):
+        entry = {"time": time.time(), "op": op, "args": kwargs}
+        with self._lock:
+            if not self.active:
+                return
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def entries(self):
+        if not self.active:
+            return list()
+        entries = list()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Last line may be incomplete if we crashed while writing it
+                    logger.warning("Skipping broken journal line: " + line.strip())
+        return entries
+
+
+class JournalingVMMController(VMMController):
+    def __init__(self, vmm_controller: VMMController, journal: Journal):
+        self.vmmc = vmm_controller
+        self.journal = journal
+
+    @property
+    def max_parallel_operations(self):
+        return self.vmmc.max_parallel_operations
+
+    def get_vms(self):
+        return self.vmmc.get_vms()
+
+    def start(self, vm):
+        self.journal.record("start", vm=vm)
+        self.vmmc.start(vm)
+
+    def poweroff(self, vm):
+        self.journal.record("poweroff", vm=vm)
+        self.vmmc.poweroff(vm)
+
+    def delete(self, vm):
+        self.journal.record("delete", vm=vm)
+        self.vmmc.delete(vm)
+
+    def is_running(self, vm):
+        return self.vmmc.is_running(vm)
+
+    def get_inventory(self):
+        return self.vmmc.get_inventory()
+
+    def get_macs(self, vm):
+        return self.vmmc.get_macs(vm)
+
+    def get_mac(self, vm, if_id=1):
+        return self.vmmc.get_mac(vm, if_id=if_id)
+
+    def get_vm_info(self, vm):
+        return self.vmmc.get_vm_info(vm)
+
+    def get_vm_infos(self, vms):
+        return self.vmmc.get_vm_infos(vms)
+
+    def get_host_info(self):
+        return self.vmmc.get_host_info()
+
+    def set_mac(self, vm, mac, if_id=1):
+        self.journal.record("set_mac", vm=vm, mac=mac, if_id=if_id)
+        self.vmmc.set_mac(vm, mac, if_id=if_id)
+
+    def get_snapshots(self, vm):
+        return self.vmmc.get_snapshots(vm)
+
+    def get_snapshots_many(self, vms):
+        return self.vmmc.get_snapshots_many(vms)
+
+    def create_snapshot(self, vm, snapshot):
+        self.journal.record("create_snapshot", vm=vm, snapshot=snapshot)
+        self.vmmc.create_snapshot(vm, snapshot)
+
+    def create_snapshots(self, snapshots):
+        for vm, snapshot in snapshots.items():
+            self.journal.record("create_snapshot", vm=vm, snapshot=snapshot)
+        self.vmmc.create_snapshots(snapshots)
+
+    def delete_snapshot(self, vm, snapshot):
+        self.journal.record("delete_snapshot", vm=vm, snapshot=snapshot)
+        self.vmmc.delete_snapshot(vm, snapshot)
+
+    def restore_snapshot(self, vm, snapshot):
+        self.journal.record("restore_snapshot", vm=vm, snapshot=snapshot)
+        self.vmmc.restore_snapshot(vm, snapshot)
+
+    def clone(self, vm, snapshot, clone, linked=True):
+        self.journal.record("clone", vm=vm, snapshot=snapshot, clone=clone, linked=linked)
+        self.vmmc.clone(vm, snapshot, clone, linked=linked)
+
+    def set_credentials(self, vm, user, password, domain):
+        self.vmmc.set_credentials(vm, user, password, domain)
+
+    def set_credentials_many(self, credentials, timeout=None):
+        self.vmmc.set_credentials_many(credentials, timeout=timeout)
+
+    def set_vrde_port(self, vm, port):
+        self.journal.record("set_vrde_port", vm=vm, port=port)
+        self.vmmc.set_vrde_port(vm, port)
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        self.journal.record("configure_clone", vm=vm, macs=macs, vrde_port=vrde_port)
+        self.vmmc.configure_clone(vm, macs=macs, vrde_port=vrde_port)
+
+    def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        self.journal.record("clone", vm=vm, snapshot=snapshot, clone=clone, linked=linked)
+        self.vmmc.clone_and_configure(vm, snapshot, clone, linked=linked, macs=macs, vrde_port=vrde_port)
+
+
+class JournalRecovery:
+    # Entries are written before the hypervisor call, so every undo step first checks whether the
+    # recorded mutation actually took effect (and was not already undone by a later entry).
+    # Snapshots named in keep_snapshots (golden images, warm pool snapshots) are meant to outlive the session.
+    def __init__(self, entries, vmm_controller: VMMController, max_parallel=1, retries=3, keep_snapshots=()):
+        self.entries = entries
+        self.vmmc = vmm_controller
+        self.max_parallel = max_parallel
+        self.retries = retries
+        self.keep_snapshots = set(keep_snapshots)
+
+    def plan(self):
+        created_clones = [entry["args"]["clone"] for entry in self.entries if entry["op"] == "clone"]
+        started_vms = [entry["args"]["vm"] for entry in self.entries if entry["op"] == "start"]
+        snapshots = dict()
+        for entry in self.entries:
+            vm = entry["args"].get("vm")
+            if entry["op"] == "create_snapshot" and vm not in created_clones and \
+                    entry["args"]["snapshot"] not in self.keep_snapshots:
+                snapshots.setdefault(vm, list()).append(entry["args"]["snapshot"])
+        current_vms = self.vmmc.get_inventory()
+        poweroff = [vm for vm in unique(started_vms) if current_vms.get(vm)]
+        # Newest first, linked clones have to go before the clones they were made from
+        delete = [vm for vm in reversed(unique(created_clones)) if vm in current_vms]
+        existing_snapshots = self.vmmc.get_snapshots_many([vm for vm in snapshots if vm in current_vms])
+        restore = {
+            vm: [snapshot for snapshot in reversed(vm_snapshots) if snapshot in existing_snapshots[vm]]
+            for vm, vm_snapshots in snapshots.items() if vm in existing_snapshots
+        }
+        restore = {vm: vm_snapshots for vm, vm_snapshots in restore.items() if vm_snapshots}
+        return {"poweroff": poweroff, "delete": delete, "restore": restore}
+
+    def undo(self):
+        plan = self.plan()
+        logger.info("Undoing journaled steps: {plan}".format(plan=plan))
+        failing = dict()
+        failing["poweroff"] = self._run(self.vmmc.poweroff, plan["poweroff"])
+        failing["delete"] = self._run(self.vmmc.delete, plan["delete"])
+        failing["restore"] = self._run(
+            lambda vm: self._restore_delete(vm, plan["restore"][vm]), list(plan["restore"])
+        )
+        return {step: vms for step, vms in failing.items() if vms}
+
+    def _restore_delete(self, vm, snapshots):
+        for snapshot in snapshots:
+            if snapshot in self.vmmc.get_snapshots(vm):
+                self.vmmc.restore_snapshot(vm, snapshot)
+                self.vmmc.delete_snapshot(vm, snapshot)
+
+    def _run(self, func, vms):
+        results = run_parallel(
+            func, vms, max_workers=self.max_parallel, exceptions=(VMMControllerException,), retries=self.retries
+        )
+        return failed_keys(results)
+
+
+def unique(items):
+    return list(dict.fromkeys(items))
@@ -0,0 +1,105 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+
+from vmcontrol.sessionhandler.sessionhandler import SessionHandlerException
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRegistry:
+    # Named sessions get their own clones, MACs and VRDE ports. Server VMs are never shared either, but clones
+    # of all sessions still get their management IP 192.168.56.(100 + clone id) inside the guest.
+    state_file_suffix = ".sessionstate"
+    lock_file_name = ".lock"
+    # The fourth MAC byte separates sessions, VMware only allows 00:50:56:00 to 00:50:56:3F for manual MACs
+    max_slots = 0x40
+    # Unnamed sessions do not register and always use the MACs and VRDE ports of slot 0
+    reserved_slots = {0}
+
+    def __init__(self, directory, max_sessions=None, max_clones=None):
+        self.directory = directory
+        self.max_sessions = max_sessions
+        self.max_clones = max_clones
+        os.makedirs(self.directory, exist_ok=True)
+
+    def state_file(self, session_id):
+        if not re.fullmatch(r"[A-Za-z0-9_.]+", session_id):
+            raise SessionHandlerException(
+                "Invalid session id {id}, only letters, digits, '_' and '.' are allowed".format(id=session_id))
+        return os.path.join(self.directory, session_id + self.state_file_suffix)
+
+    @contextlib.contextmanager
+    def lock(self):
+        # Held by admitting and releasing sessions, so that concurrently starting consoles never pick the same slot
+        with open(os.path.join(self.directory, self.lock_file_name), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def sessions(self):
+        sessions = dict()
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(self.state_file_suffix):
+                continue
+            session_id = file_name[:-len(self.state_file_suffix)]
+            try:
+                with open(os.path.join(self.directory, file_name)) as f:
+                    sessions[session_id] = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Cannot read state of session {id}: {e}".format(id=session_id, e=e))
+        return sessions
+
+    def admit(self, config):
+        others = {
+            session_id: state for session_id, state in self.sessions().items() if session_id != config.session_id
+        }
+        used_vms = set()
+        for state in others.values():
+            used_vms.update(state["config"]["server_vms"] + [state["config"]["client_vm"]])
+            used_vms.update(clone["vm"] for clone in state["clones"])
+        shared_vms = used_vms.intersection(config.server_vms + [config.client_vm])
+        if shared_vms:
+            raise SessionHandlerException(
+                "VMs {vms} are already used by another session".format(vms=sorted(shared_vms)))
+        if self.max_sessions is not None and len(others) >= self.max_sessions:
+            raise SessionHandlerException(
+                "Host is full: {n} sessions already registered".format(n=len(others)))
+        used_clones = sum(len(state["clones"]) for state in others.values())
+        if self.max_clones is not None and used_clones + config.number_of_clones > self.max_clones:
+            raise SessionHandlerException(
+                "Host is full: {used} of {max} clones in use, {n} more requested".format(
+                    used=used_clones, max=self.max_clones, n=config.number_of_clones))
+        config.session_slot = self.free_slot(config, others)
+
+    def free_slot(self, config, others):
+        used_slots = {state["config"].get("session_slot", 0) for state in others.values()} | self.reserved_slots
+        if config.session_slot not in used_slots:
+            return config.session_slot
+        for slot in range(self.max_slots):
+            if slot not in used_slots:
+                return slot
+        raise SessionHandlerException("No free MAC and VRDE port range left")
@@ -16,39 +16,177 @@
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
 
 
-from vmcontrol.sessionhandler.sessionhandler import SessionHandler, SessionHandlerException
+from vmcontrol.sessionhandler.clonebenchmark import CloneBenchmark
+from vmcontrol.sessionhandler.sessionhandler import SessionHandler, SessionHandlerException, clone_strategies
 from vmcontrol.vmmcontroller import VMMConsole
+from vmcontrol.vmmcontroller.vmmconsole import Parser
 
 
 class SessionConsole(VMMConsole):
     # intro = ""
     prompt = "SessionConsole> "
+    # Commands that only read the session state, all others change it and must not overlap in batch mode
+    shared_commands = (
+        "get_vms", "is_running", "get_inventory", "get_macs", "get_mac", "get_snapshots", "get_info", "verify_clones",
+        "wait_until_ready", "wait_for_state", "list_sessions", "show_trace", "export_trace")
 
     def __init__(self, session_handler: SessionHandler):
         super().__init__(session_handler.vmmc)
         self.session_handler = session_handler
 
+    def is_exclusive(self, command):
+        return command not in self.shared_commands
+
     def do_get_info(self, arg):
         print("Current SessionConfig is:")
         config_dict = vars(self.session_handler.config)
         for field, value in config_dict.items():
             print("{field}\n\t{value}".format(field=field, value=value))
+        print("Predicted host capacity:")
+        try:
+            print(self.session_handler.estimate_capacity())
+        except SessionHandlerException as e:
+            print(e)
 
     def do_start_session(self, arg):
+        args = Parser().parse(arg)
         try:
-            self.session_handler.start_session()
+            self.session_handler.start_session(wait_ready="wait_ready" in args)
         except SessionHandlerException as e:
-            print(e)
+            self.print_error(e)
+
+    def do_wait_until_ready(self, arg):
+        try:
+            self.session_handler.wait_until_ready()
+        except SessionHandlerException as e:
+            self.print_error(e)
+
+    def do_verify_clones(self, arg):
+        try:
+            problems = self.session_handler.verify_clones()
+        except SessionHandlerException as e:
+            self.print_error(e)
+        else:
+            print("\n".join(problems) if problems else "All clones are configured as expected")
+
+    def do_wait_for_state(self, arg):
+        args = Parser().parse(arg)
+        try:
+            timeout = float(args[2]) if len(args) > 2 else None
+            self.session_handler.wait_for_state(args[0], args[1], timeout=timeout)
+        except (SessionHandlerException, IndexError, ValueError) as e:
+            self.print_error(e)
 
     def do_close_session(self, arg):
         try:
-            self.session_handler.close_session()
+            report = self.session_handler.close_session()
         except SessionHandlerException as e:
-            print(e)
+            self.print_error(e)
+        else:
+            print(report)
+
+    def do_scale_clones(self, arg):
+        args = Parser().parse(arg)
+        try:
+            self.session_handler.scale_clones(int(args[0]))
+        except (SessionHandlerException, IndexError, ValueError) as e:
+            self.print_error(e)
+
+    def do_discard_warm_pool(self, arg):
+        try:
+            report = self.session_handler.discard_warm_pool()
+        except SessionHandlerException as e:
+            self.print_error(e)
+        else:
+            print(report)
+
+    def do_recover_session(self, arg):
+        try:
+            self.session_handler.recover_session()
+        except SessionHandlerException as e:
+            self.print_error(e)
+
+    def do_build_golden_images(self, arg):
+        try:
+            self.session_handler.build_golden_images()
+        except SessionHandlerException as e:
+            self.print_error(e)
+
+    def do_benchmark_clone_strategies(self, arg):
+        if self.session_handler.session_running or self.session_handler.warm_pool_available:
+            self.print_error("Close the session and discard the warm pool before benchmarking")
+            return
+        args = Parser().parse(arg)
+        wait_ready = "no_wait_ready" not in args
+        strategies = [strategy for strategy in args if strategy != "no_wait_ready"] or clone_strategies
+        benchmark = CloneBenchmark(
+            self.session_handler.vmmc, self.session_handler.config, strategies=strategies, wait_ready=wait_ready,
+            session_state_file=self.session_handler.session_state_file, registry=self.session_handler.registry)
+        try:
+            results = benchmark.run()
+        except SessionHandlerException as e:
+            self.print_error(e)
+            return
+        for result in results:
+            print(result)
+
+    def do_cleanup_failed_session(self, arg):
+        args = Parser().parse(arg)
+        dry_run = "dry_run" in args
+        try:
+            plan = self.session_handler.cleanup_failed_session(dry_run=dry_run)
+        except SessionHandlerException as e:
+            self.print_error(e)
+        else:
+            print(plan)
+            if dry_run:
+                print("Dry run, nothing changed")
+
+    def do_list_sessions(self, arg):
+        registry = self.session_handler.registry
+        if registry is None:
+            self.print_error("No session registry in use")
+            return
+        for session_id, state in registry.sessions().items():
+            print("{id}\n\trunning: {running}\n\tclones: {clones}".format(
+                id=session_id, running=state["session_running"], clones=len(state["clones"])))
+
+    def do_show_trace(self, arg):
+        tracer = self.session_handler.tracer
+        if tracer is None:
+            self.print_error("Tracing is not enabled")
+            return
+        args = Parser().parse(arg)
+        try:
+            n = int(args[0]) if args else 10
+        except ValueError as e:
+            self.print_error(e)
+            return
+        print("Operations by total time:")
+        for op in tracer.summary():
+            print("\t{op:<32} {count:>5}x  total {total:8.1f}s  max {max:7.1f}s  errors {errors}".format(
+                **vars(op)))
+        print("Slowest VM operations:")
+        for span in tracer.slowest(n, category="vmm"):
+            print("\t{span}".format(span=span))
+
+    def do_export_trace(self, arg):
+        tracer = self.session_handler.tracer
+        if tracer is None:
+            self.print_error("Tracing is not enabled")
+            return
+        args = Parser().parse(arg)
+        if not args or (len(args) > 1 and args[1] not in ("jsonl", "chrome")):
+            self.print_error("Usage: export_trace FILE [jsonl|chrome]")
+            return
+        if len(args) > 1 and args[1] == "chrome":
+            tracer.export_chrome_trace(args[0])
+        else:
+            tracer.export_jsonl(args[0])
 
     def do_remove_session_state_file(self, arg):
         if self.session_handler.session_state_file is not None:
             self.session_handler.remove_session_state_file()
             print("Session state file deleted. Reload shell to start a new session.")
         else:
-            print("No session state file given")
+            self.print_error("No session state file given")
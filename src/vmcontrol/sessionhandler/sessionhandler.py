@@ -16,16 +16,40 @@
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
 
 
+import contextlib
+import functools
 import json
 import logging
 import os
 import time
 from types import SimpleNamespace
 
-from vmcontrol.vmmcontroller import VMMController, VMMControllerException
+from vmcontrol.capacity import CapacityModel, capacity_policies, start_batches
+from vmcontrol.parallel import run_parallel, failed_keys
+from vmcontrol.sessionhandler.cleanup import SessionCleanup
+from vmcontrol.sessionhandler.journal import Journal, JournalingVMMController, JournalRecovery
+from vmcontrol.readiness import ReadinessChecker, ReadinessException, server_probes, client_probe
+from vmcontrol.statewatcher import StateWatcherException
+from vmcontrol.tracing import TracingVMMController
+from vmcontrol.vmmcontroller import VMMController, VMMControllerException, VMInfo
 
 logger = logging.getLogger(__name__)
 
+# linked: linked clones of the client snapshot, full: independent full copies, hybrid: linked clones spread over
+# a few full clones of the client so that not all clones read from one parent disk
+clone_strategies = ("linked", "full", "hybrid")
+
+
+def session_phase(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.tracer is None:
+            return func(self, *args, **kwargs)
+        with self.tracer.span(func.__name__, category="session"):
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
 
 class DictNamespace(SimpleNamespace):
     def _asdict(self):
@@ -45,6 +69,26 @@ class SessionConfig(DictNamespace):
     client_vm = "Client"
     number_of_clones = 3
     vm_start_timeout = 0
+    max_parallel_starts = 1
+    max_parallel_clones = 1
+    max_parallel_teardown = 1
+    warm_pool = False
+    ready_timeout = 600
+    login_timeout = 600
+    session_id = None
+    session_slot = 0
+    ordered_start = False
+    router_vms = ["Internet Router", "Company Router"]
+    clone_strategy = "linked"
+    hybrid_base_clones = 2
+    golden_server_vms = ["Internal Server"]
+    # Readiness probes of golden image builds have to succeed this long without a reboot in between
+    golden_stable_time = 300
+    # ignore, refuse (sessions that do not fit the host) or stagger (starts if only the CPUs are overcommitted)
+    capacity_policy = "ignore"
+    host_memory_reserve = 2048
+    max_cpu_overcommit = 4.0
+    stagger_interval = 30
 
 
 class Clone(DictNamespace):
@@ -56,25 +100,96 @@ class Clone(DictNamespace):
     password = None
     domain = None
     vrde_port = None
+    snapshot = None
+
+
+class TeardownReport:
+    def __init__(self):
+        self.steps = dict()
+
+    def add(self, step, results):
+        self.steps.setdefault(step, list()).extend(results)
+
+    def vms(self, step, status):
+        return [result.key for result in self.steps.get(step, list()) if self.status(result) == status]
+
+    def succeeded(self, step):
+        return self.vms(step, "succeeded")
+
+    def retried(self, step):
+        return self.vms(step, "retried")
+
+    def failed(self, step):
+        return self.vms(step, "failed")
+
+    @staticmethod
+    def status(result):
+        if not result.succeeded:
+            return "failed"
+        elif result.retried:
+            return "retried"
+        else:
+            return "succeeded"
+
+    def _asdict(self):
+        return {
+            step: {
+                result.key: {
+                    "status": self.status(result),
+                    "attempts": result.attempts,
+                    "error": None if result.succeeded else str(result.error),
+                }
+                for result in results
+            }
+            for step, results in self.steps.items()
+        }
+
+    def __str__(self):
+        lines = list()
+        for step in self.steps:
+            lines.append(
+                "{step}: {succeeded} succeeded, {retried} retried, {failed} failed".format(
+                    step=step, succeeded=len(self.succeeded(step)), retried=len(self.retried(step)),
+                    failed=len(self.failed(step)))
+            )
+            for status in ("retried", "failed"):
+                for vm in self.vms(step, status):
+                    lines.append("\t{status}: {vm}".format(status=status, vm=vm))
+        return "\n".join(lines)
 
 
 class CloneCreator:
     def __init__(
-        self, parent_vm, base_snapshot, number_of_clones, vmm_controller: VMMController, vrde_port_start=5000
+        self, parent_vm, base_snapshot, number_of_clones, vmm_controller: VMMController, vrde_port_start=5000,
+        max_parallel=1, mac_base=0x005056000000, name_prefix="", linked=True, sources=None
     ):
         self.parent_vm = parent_vm
         self.base_snapshot = base_snapshot
         self.number_of_clones = number_of_clones
         self.vmmc = vmm_controller
         self.vrde_port_start = vrde_port_start
+        self.mac_base = mac_base
+        self.name_prefix = name_prefix
+        self.max_parallel = max_parallel
+        self.linked = linked
+        # (vm, snapshot) pairs the clones are made from in turn
+        self.sources = sources or [(parent_vm, base_snapshot)]
         self._current_vms = self.vmmc.get_vms()
         self._clones = None
 
-    def create(self):
-        self._clones = [Clone(id=i + 1) for i in range(self.number_of_clones)]
+    def create(self, ids=None):
+        if ids is None:
+            ids = range(1, self.number_of_clones + 1)
+        self._clones = [Clone(id=id_) for id_ in ids]
         for clone in self._clones:
             self.set_data(clone)
-            self.create_vm(clone)
+        results = run_parallel(
+            self.create_vm, self._clones, max_workers=self.max_parallel, exceptions=(VMMControllerException,)
+        )
+        failing_vms = [clone.vm for clone in failed_keys(results)]
+        if failing_vms:
+            self.rollback()
+            raise SessionHandlerException("Could not create all clones. Failing: {vms}".format(vms=failing_vms))
         return self._clones
 
     def set_data(self, clone):
@@ -84,16 +199,27 @@ class CloneCreator:
         self.set_credentials(clone)
         self.set_vrde_port(clone)
 
+    def update(self, clone):
+        macs_and_port = (clone.internal_mac, clone.management_mac, clone.vrde_port)
+        self.set_management_mac(clone)
+        self.set_internal_mac(clone)
+        self.set_credentials(clone)
+        self.set_vrde_port(clone)
+        changed = macs_and_port != (clone.internal_mac, clone.management_mac, clone.vrde_port)
+        if changed:
+            self.configure_vm(clone)
+        return changed
+
     def set_vm_name(self, clone):
-        clone.vm = self.parent_vm + "Clone" + str(clone.id)
+        clone.vm = self.name_prefix + self.parent_vm + "Clone" + str(clone.id)
         while clone.vm in self._current_vms:
             clone.vm += "a"
 
     def set_management_mac(self, clone):
-        clone.management_mac = 0x005056000000 + 0x100 * self.number_of_clones + clone.id
+        clone.management_mac = self.mac_base + 0x100 * self.number_of_clones + clone.id
 
     def set_internal_mac(self, clone):
-        clone.internal_mac = 0x005056000000 + clone.id
+        clone.internal_mac = self.mac_base + clone.id
 
     def set_credentials(self, clone):
         clone.user = "client" + str(clone.id)
@@ -103,24 +229,66 @@ class CloneCreator:
     def set_vrde_port(self, clone):
         clone.vrde_port = self.vrde_port_start + clone.id - 1
 
+    def source(self, clone):
+        return self.sources[(clone.id - 1) % len(self.sources)]
+
     def create_vm(self, clone):
-        self.vmmc.clone(self.parent_vm, self.base_snapshot, clone.vm)
-        self.vmmc.set_mac(clone.vm, clone.management_mac, if_id=2)
-        self.vmmc.set_mac(clone.vm, clone.internal_mac, if_id=1)
-        self.vmmc.set_vrde_port(clone.vm, clone.vrde_port)
+        vm, snapshot = self.source(clone)
+        self.vmmc.clone_and_configure(
+            vm, snapshot, clone.vm, linked=self.linked, macs={1: clone.internal_mac, 2: clone.management_mac},
+            vrde_port=clone.vrde_port
+        )
+
+    def configure_vm(self, clone):
+        self.vmmc.configure_clone(
+            clone.vm, macs={1: clone.internal_mac, 2: clone.management_mac}, vrde_port=clone.vrde_port
+        )
+
+    def rollback(self):
+        current_vms = self.vmmc.get_vms()
+        created_vms = [clone.vm for clone in self._clones if clone.vm in current_vms]
+        logger.info("Rolling back created clones " + str(created_vms))
+        results = run_parallel(
+            self.vmmc.delete, created_vms, max_workers=self.max_parallel, exceptions=(VMMControllerException,),
+            retries=3
+        )
+        for vm in failed_keys(results):
+            logger.warning('Could not delete clone "{vm}" during rollback'.format(vm=vm))
 
 
 class SessionHandler:
     clone_creator_class = CloneCreator
+    readiness_checker_class = ReadinessChecker
+    teardown_retries = 10
+    teardown_backoff = 0.01
+    warm_snapshot = "WarmBase"
+    backup_snapshot = "Backup"
+    clone_base_snapshot = "CloneBase"
+    golden_snapshot = "Golden"
+    vrde_ports_per_session = 1000
 
-    def __init__(self, vmm_controller: VMMController, session_config=None, session_state_file=None):
+    def __init__(self, vmm_controller: VMMController, session_config=None, session_state_file=None, registry=None,
+                 tracer=None, state_watcher=None):
         self.backup_snapshots = dict()
+        self.registry = registry
+        self.tracer = tracer
+        self.state_watcher = state_watcher
         self.vmmc = vmm_controller
+        if isinstance(self.vmmc, JournalingVMMController):
+            self.vmmc = self.vmmc.vmmc
+        if self.tracer is not None:
+            self.vmmc = TracingVMMController(self.vmmc, self.tracer)
         self.config = session_config or self.default_config()
         self.session_running = False
         self.clones = list()
+        self.clone_bases = list()
+        self.golden_snapshots = dict()
+        self.staggered_start = False
         self.session_state_file = session_state_file
+        self.journal = None
         if self.session_state_file is not None:
+            self.journal = Journal(self.session_state_file + ".journal")
+            self.vmmc = JournalingVMMController(self.vmmc, self.journal)
             self.load_session_state()
 
     @staticmethod
@@ -138,170 +306,741 @@ class SessionHandler:
                 logger.info("Found and loaded old session state")
 
     def save_session_state(self):
-        with open(self.session_state_file, "w+") as f:
+        tmp_file = self.session_state_file + ".tmp"
+        with open(tmp_file, "w") as f:
             json.dump(self.get_state(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.session_state_file)
 
     def remove_session_state_file(self):
-        if os.path.isfile(self.session_state_file):
-            os.remove(self.session_state_file)
+        with self.registry_lock():
+            if os.path.isfile(self.session_state_file):
+                os.remove(self.session_state_file)
+
+    def registry_lock(self):
+        return contextlib.nullcontext() if self.registry is None else self.registry.lock()
 
     def get_state(self):
         state = DictNamespace()
         state.backup_snapshots = self.backup_snapshots.copy()
         state.config = self.config._asdict()
         state.clones = [clone._asdict() for clone in self.clones]
+        state.clone_bases = list(self.clone_bases)
+        state.golden_snapshots = self.golden_snapshots.copy()
         state.session_running = self.session_running
         return state._asdict()
 
     def set_state(self, dict_):
         state = DictNamespace(**dict_)
         self.backup_snapshots = state.backup_snapshots.copy()
-        self.config = SessionConfig(**state.config)
+        if state.session_running:
+            # A stopped session only leaves a warm pool behind, the next session uses the given config
+            self.config = SessionConfig(**state.config)
         self.clones = [Clone(**clone_dict) for clone_dict in state.clones]
+        self.clone_bases = list(dict_.get("clone_bases", list()))
+        self.golden_snapshots = dict(dict_.get("golden_snapshots", dict()))
         self.session_running = state.session_running
 
+    def session_prefix(self):
+        return "" if self.config.session_id is None else self.config.session_id + "-"
+
+    def session_snapshot(self, snapshot):
+        return snapshot if self.config.session_id is None else snapshot + "-" + self.config.session_id
+
+    @property
+    def warm_pool_available(self):
+        return not self.session_running and bool(self.clones)
+
     def server_and_client_vms(self):
         return self.config.server_vms + [self.config.client_vm]
 
-    def start_session(self):
+    @session_phase
+    def start_session(self, wait_ready=False):
         if self.session_running:
             raise SessionHandlerException("Session already running")
-        logger.info("Starting TBF Session")
-        self.create_backup_snapshots(self.server_and_client_vms())
-        self.create_clones()
-        self.start_all_vms()
+        if self.journal is not None and self.journal.entries():
+            raise SessionHandlerException("Found journal of an unfinished session, run recover_session first")
+        if self.config.clone_strategy not in clone_strategies:
+            raise SessionHandlerException("Unknown clone strategy {strategy}, use one of {strategies}".format(
+                strategy=self.config.clone_strategy, strategies=clone_strategies))
+        with self.registry_lock():
+            # Under the registry lock, so that concurrently starting sessions count each other
+            self.admit_capacity(self.config.number_of_clones)
+            if self.registry is not None:
+                self.registry.admit(self.config)
+                if self.session_state_file is not None:
+                    # Register right away so that concurrently starting sessions see us
+                    self.save_session_state()
+        try:
+            if self.journal is not None:
+                self.journal.open()
+            logger.info("Starting TBF Session")
+            if self.warm_pool_available and not self.config.warm_pool:
+                self.discard_warm_pool()
+            if self.warm_pool_available:
+                self.create_backup_snapshots(self.config.server_vms)
+                self.restore_golden_snapshots()
+                self.reconcile_clones()
+            else:
+                self.create_backup_snapshots(self.server_and_client_vms())
+                self.create_clones()
+                if self.config.warm_pool:
+                    self.create_warm_snapshots(self.clones)
+        except Exception:
+            # Like closing the session: only clones that are still around keep it registered
+            if self.session_state_file is not None:
+                if self.clones or self.clone_bases:
+                    self.save_session_state()
+                else:
+                    self.remove_session_state_file()
+            raise
         self.session_running = True
-        if self.session_state_file is not None:
-            self.save_session_state()
+        try:
+            self.start_all_vms()
+        finally:
+            if self.session_state_file is not None:
+                self.save_session_state()
         logger.info("TBF Session started")
+        if wait_ready:
+            self.wait_until_ready()
+
+    def estimate_capacity(self, number_of_clones=None):
+        if number_of_clones is None:
+            number_of_clones = self.config.number_of_clones
+        model = CapacityModel(
+            memory_reserve=self.config.host_memory_reserve, max_cpu_overcommit=self.config.max_cpu_overcommit)
+        try:
+            vm_infos = self.vmmc.get_vm_infos(self.server_and_client_vms())
+            host_info = self.vmmc.get_host_info()
+        except VMMControllerException as e:
+            raise SessionHandlerException(str(e))
+        other_vms = self.other_session_vms()
+        try:
+            other_infos = self.vmmc.get_vm_infos(list(dict.fromkeys(other_vms)))
+        except VMMControllerException as e:
+            logger.warning("Cannot get the size of the VMs of other sessions: {e}".format(e=e))
+            other_infos = {vm: VMInfo(name=vm) for vm in other_vms}
+        server_infos = [vm_infos[vm] for vm in self.config.server_vms]
+        return model.estimate(
+            host_info,
+            server_infos + [vm_infos[self.config.client_vm]] * number_of_clones + [other_infos[vm] for vm in other_vms])
+
+    def other_session_vms(self):
+        # VMs of the other running sessions of the registry, which share the host. Their clones are represented by
+        # their parent.
+        if self.registry is None:
+            return list()
+        vms = list()
+        for session_id, state in self.registry.sessions().items():
+            if session_id == self.config.session_id or not state.get("session_running"):
+                continue
+            config = state["config"]
+            vms += config["server_vms"] + [config["client_vm"]] * config["number_of_clones"]
+        return vms
+
+    def admit_capacity(self, number_of_clones):
+        policy = self.config.capacity_policy
+        if policy not in capacity_policies:
+            raise SessionHandlerException("Unknown capacity policy {policy}, use one of {policies}".format(
+                policy=policy, policies=capacity_policies))
+        self.staggered_start = False
+        if policy == "ignore":
+            return
+        estimate = self.estimate_capacity(number_of_clones)
+        if estimate.unknown_vms:
+            logger.warning("Cannot check capacity for VMs of unknown size: {vms}".format(vms=estimate.unknown_vms))
+        # Staggering only softens the boot load, overcommitted memory would still slow down every VM
+        if not estimate.memory_fits or (not estimate.cpus_fit and policy == "refuse"):
+            raise SessionHandlerException("{n} clones exceed the host capacity:\n{estimate}".format(
+                n=number_of_clones, estimate=estimate))
+        if not estimate.cpus_fit:
+            logger.warning("CPUs are overcommitted, starting VMs in batches:\n{estimate}".format(estimate=estimate))
+            self.staggered_start = True
+
+    def verify_clones(self):
+        try:
+            vm_infos = self.vmmc.get_vm_infos(self.clone_vms)
+        except VMMControllerException as e:
+            raise SessionHandlerException(str(e))
+        problems = list()
+        for clone in self.clones:
+            vm_info = vm_infos[clone.vm]
+            for if_id, mac in ((1, clone.internal_mac), (2, clone.management_mac)):
+                if vm_info.macs.get(if_id) != mac:
+                    problems.append('"{vm}" interface {if_id}: MAC {actual} instead of {expected}'.format(
+                        vm=clone.vm, if_id=if_id, actual=format_mac(vm_info.macs.get(if_id)), expected=format_mac(mac)))
+            if vm_info.vrde_port is not None and vm_info.vrde_port != clone.vrde_port:
+                problems.append('"{vm}": VRDE port {actual} instead of {expected}'.format(
+                    vm=clone.vm, actual=vm_info.vrde_port, expected=clone.vrde_port))
+        return problems
+
+    def readiness_probes(self):
+        probes = [probe for probe in server_probes if probe.vm in self.config.server_vms]
+        probes += [client_probe(clone.vm, clone.id) for clone in self.clones]
+        return probes
+
+    @session_phase
+    def wait_until_ready(self, stable_time=0):
+        if not self.session_running:
+            raise SessionHandlerException("No session running")
+        checker = self.readiness_checker_class(
+            self.readiness_probes(), timeout=self.config.ready_timeout, is_running=self.vm_is_running,
+            stable_time=stable_time
+        )
+        try:
+            checker.wait()
+        except ReadinessException as e:
+            raise SessionHandlerException(str(e))
+
+    def vm_is_running(self, vm):
+        # A polling watcher has not seen VMs started since its last poll, so the controller confirms a stopped VM
+        if self.state_watcher is not None and self.state_watcher.is_running(vm):
+            return True
+        return self.vmmc.is_running(vm)
+
+    def wait_for_state(self, vm, state, timeout=None):
+        if self.state_watcher is None:
+            raise SessionHandlerException("No state watcher available")
+        try:
+            self.state_watcher.wait_for_state(vm, state, timeout=timeout)
+        except StateWatcherException as e:
+            raise SessionHandlerException(str(e))
 
+    @session_phase
     def close_session(self):
         if not self.session_running:
             raise SessionHandlerException("No session running")
         logger.info("Closing TBF Session")
-        self.poweroff_all_vms()
-        self.delete_clones()
-        self.restore_delete_backup_snapshots()
+        report = TeardownReport()
+        self.poweroff_all_vms(report)
+        if self.config.warm_pool:
+            self.revert_clones(report)
+            self.restore_delete_backup_snapshots(report, keep_vms=[self.config.client_vm])
+        else:
+            self.delete_clones(report)
+            self.delete_clone_bases(report)
+            self.restore_delete_backup_snapshots(report)
         self.session_running = False
         if self.session_state_file is not None:
-            self.remove_session_state_file()
+            if self.clones or self.clone_bases:
+                self.save_session_state()
+            else:
+                self.remove_session_state_file()
+        if self.journal is not None:
+            self.journal.clear()
         logger.info("TBF Session closed")
+        return report
+
+    @session_phase
+    def recover_session(self):
+        if self.journal is None or not self.journal.entries():
+            raise SessionHandlerException("No journal to recover from")
+        logger.info("Recovering session from journal")
+        vmmc = self.vmmc.vmmc
+        recovery = JournalRecovery(
+            self.journal.entries(), vmmc, max_parallel=self.config.max_parallel_teardown,
+            keep_snapshots=[self.session_snapshot(self.golden_snapshot), self.session_snapshot(self.warm_snapshot)])
+        failing = recovery.undo()
+        current_vms = vmmc.get_vms()
+        self.clones = [clone for clone in self.clones if clone.vm in current_vms]
+        self.clone_bases = [vm for vm in self.clone_bases if vm in current_vms]
+        current_snapshots = vmmc.get_snapshots_many(
+            [vm for vm in set(self.backup_snapshots) | set(self.golden_snapshots) if vm in current_vms])
+        self.backup_snapshots = {
+            vm: snapshot for vm, snapshot in self.backup_snapshots.items()
+            if snapshot in current_snapshots.get(vm, list())
+        }
+        self.golden_snapshots = {
+            vm: snapshot for vm, snapshot in self.golden_snapshots.items()
+            if snapshot in current_snapshots.get(vm, list())
+        }
+        self.session_running = False
+        if self.clones:
+            self.poweroff_vms(self.clone_vms)
+            self.revert_clones()
+            self.save_session_state()
+        else:
+            self.remove_session_state_file()
+        self.journal.clear()
+        if failing:
+            raise SessionHandlerException("Could not undo all journaled steps. Failing: {f}".format(f=failing))
+
+    @session_phase
+    def cleanup_failed_session(self, dry_run=False):
+        # Last resort if neither close_session nor recover_session work, e.g. without a state file or journal
+        vmmc = self.vmmc.vmmc if isinstance(self.vmmc, JournalingVMMController) else self.vmmc
+        cleanup = SessionCleanup(
+            vmmc, self.config.server_vms, self.config.client_vm, session_id=self.config.session_id,
+            backup_snapshot=self.backup_snapshot, max_parallel=vmmc.max_parallel_operations)
+        try:
+            plan = cleanup.plan()
+            if dry_run:
+                return plan
+            failing = cleanup.execute(plan)
+        except VMMControllerException as e:
+            raise SessionHandlerException(str(e))
+        self.session_running = False
+        self.clones = list()
+        self.clone_bases = list()
+        self.backup_snapshots = dict()
+        if self.session_state_file is not None:
+            self.remove_session_state_file()
+        if self.journal is not None:
+            self.journal.clear()
+        if failing:
+            raise SessionHandlerException("Could not clean up everything. Failing: {f}".format(f=failing))
+        return plan
 
+    @session_phase
+    def scale_clones(self, number_of_clones):
+        if not self.session_running:
+            raise SessionHandlerException("No session running")
+        if number_of_clones < 0:
+            raise SessionHandlerException("Number of clones must not be negative")
+        if number_of_clones > len(self.clones):
+            self.admit_capacity(number_of_clones)
+        logger.info("Scaling clones from {old} to {new}".format(old=len(self.clones), new=number_of_clones))
+        self.clones.sort(key=lambda clone: clone.id)
+        try:
+            if number_of_clones < len(self.clones):
+                self.remove_clones(self.clones[number_of_clones:])
+            elif number_of_clones > len(self.clones):
+                self.add_clones(number_of_clones - len(self.clones))
+        finally:
+            self.config.number_of_clones = len(self.clones)
+            if self.session_state_file is not None:
+                self.save_session_state()
+
+    def add_clones(self, count):
+        used_ids = {clone.id for clone in self.clones}
+        new_ids = list()
+        id_ = 1
+        while len(new_ids) < count:
+            if id_ not in used_ids:
+                new_ids.append(id_)
+            id_ += 1
+        new_clones = self.clone_creator(number_of_clones=len(self.clones) + count).create(ids=new_ids)
+        # Tracked before anything else can fail, so that closing the session deletes them
+        self.clones.extend(new_clones)
+        self.clones.sort(key=lambda clone: clone.id)
+        if self.session_state_file is not None:
+            self.save_session_state()
+        if self.config.warm_pool:
+            self.create_warm_snapshots(new_clones)
+        self.start_vms([clone.vm for clone in new_clones])
+
+    def remove_clones(self, clones):
+        clone_vms = [clone.vm for clone in clones]
+        logger.info("Removing clones " + str(clone_vms))
+        report = TeardownReport()
+        try:
+            self.poweroff_vms(clone_vms, report=report)
+        except SessionHandlerException as e:
+            logger.warning("Exception: {e}".format(e=e))
+        try:
+            self.delete_vms(clone_vms, report=report)
+        finally:
+            remaining_vms = self.vmmc.get_vms()
+            self.clones = [
+                clone for clone in self.clones if clone not in clones or clone.vm in remaining_vms
+            ]
+        return report
+
+    @session_phase
+    def discard_warm_pool(self):
+        if self.session_running:
+            raise SessionHandlerException("Cannot discard the warm pool of a running session")
+        logger.info("Discarding warm pool")
+        report = TeardownReport()
+        self.delete_clones(report)
+        self.delete_clone_bases(report)
+        self.delete_golden_snapshots(report)
+        self.restore_delete_backup_snapshots(report)
+        if self.session_state_file is not None:
+            self.remove_session_state_file()
+        return report
+
+    @session_phase
+    def build_golden_images(self):
+        # Boots the clones through their provisioning (renaming, domain join, auto-logon) once and keeps the result
+        # as their warm pool snapshots. The domain controller has to remember the joins, so golden_server_vms get a
+        # snapshot at the same time which later sessions restore before starting.
+        if not self.session_running:
+            raise SessionHandlerException("No session running")
+        if not self.config.warm_pool:
+            raise SessionHandlerException("Golden images are kept in the warm pool, enable warm_pool first")
+        logger.info("Building golden images")
+        # Readiness probes already succeed before the reboots for renaming and joining the domain, so they have to
+        # keep succeeding through a whole golden_stable_time
+        self.wait_until_ready(stable_time=self.config.golden_stable_time)
+        server_vms = [vm for vm in self.config.golden_server_vms if vm in self.config.server_vms]
+        vms = server_vms + self.clone_vms
+        self.poweroff_vms(vms)
+        snapshot = self.session_snapshot(self.golden_snapshot)
+        old_snapshots = {clone.vm: clone.snapshot for clone in self.clones if clone.snapshot is not None}
+        old_snapshots.update({vm: self.golden_snapshots[vm] for vm in server_vms if vm in self.golden_snapshots})
+
+        def replace_snapshot(vm):
+            if vm in old_snapshots and old_snapshots[vm] in self.vmmc.get_snapshots(vm):
+                self.vmmc.delete_snapshot(vm, old_snapshots[vm])
+            self.vmmc.create_snapshot(vm, snapshot)
+
+        results = run_parallel(
+            replace_snapshot, vms, max_workers=self.config.max_parallel_clones, exceptions=(VMMControllerException,)
+        )
+        failing_vms = failed_keys(results)
+        for clone in self.clones:
+            clone.snapshot = snapshot if clone.vm not in failing_vms else None
+        for vm in server_vms:
+            if vm in failing_vms:
+                self.golden_snapshots.pop(vm, None)
+            else:
+                self.golden_snapshots[vm] = snapshot
+        if self.session_state_file is not None:
+            self.save_session_state()
+        self.start_vms(vms)
+        if failing_vms:
+            raise SessionHandlerException("Could not create all golden snapshots. Failing: {vms}".format(
+                vms=failing_vms))
+
+    @session_phase
+    def restore_golden_snapshots(self):
+        snapshots = {vm: snapshot for vm, snapshot in self.golden_snapshots.items() if vm in self.config.server_vms}
+        if not snapshots:
+            return
+        logger.info("Restoring golden snapshots of " + str(list(snapshots)))
+        results = run_parallel(
+            lambda vm: self.vmmc.restore_snapshot(vm, snapshots[vm]), list(snapshots),
+            max_workers=self.config.max_parallel_starts, exceptions=(VMMControllerException,)
+        )
+        failing_vms = failed_keys(results)
+        if failing_vms:
+            raise SessionHandlerException("Could not restore golden snapshots. Failing: {vms}".format(
+                vms=failing_vms))
+
+    @session_phase
+    def delete_golden_snapshots(self, report=None):
+        if not self.golden_snapshots:
+            return
+        logger.info("Deleting golden snapshots")
+        snapshots = self.golden_snapshots
+        results = self.run_teardown_step(
+            "delete_golden", lambda vm: self.vmmc.delete_snapshot(vm, snapshots[vm]), list(snapshots), report)
+        failing_vms = failed_keys(results)
+        for vm in failing_vms:
+            logger.warning('Could not delete golden snapshot of "{vm}"'.format(vm=vm))
+        self.golden_snapshots = {vm: snapshot for vm, snapshot in snapshots.items() if vm in failing_vms}
+
+    @session_phase
     def create_backup_snapshots(self, vms):
         logger.info("Creating backup snapshots for " + str(vms))
-        snapshot_trunc = "Backup"
+        snapshot_trunc = self.session_snapshot(self.backup_snapshot)
+        existing_snapshots = self.vmmc.get_snapshots_many(vms)
+        backup_snapshots = dict()
         for vm in vms:
-            snapshots = self.vmmc.get_snapshots(vm)
             unique_snapshot_name = snapshot_trunc
             i = 0
-            while unique_snapshot_name in snapshots:
+            while unique_snapshot_name in existing_snapshots[vm]:
                 unique_snapshot_name = snapshot_trunc + str(i)
                 i += 1
-            self.vmmc.create_snapshot(vm, unique_snapshot_name)
-            self.backup_snapshots[vm] = unique_snapshot_name
+            backup_snapshots[vm] = unique_snapshot_name
+        try:
+            self.vmmc.create_snapshots(backup_snapshots)
+        except VMMControllerException as e:
+            created_snapshots = self.vmmc.get_snapshots_many(vms)
+            for vm, snapshot in backup_snapshots.items():
+                if snapshot in created_snapshots[vm]:
+                    self.backup_snapshots[vm] = snapshot
+            raise SessionHandlerException("Could not create all backup snapshots: {e}".format(e=e))
+        self.backup_snapshots.update(backup_snapshots)
 
+    @session_phase
     def create_clones(self):
         logger.info("Creating clones")
+        if self.config.clone_strategy == "hybrid":
+            self.create_clone_bases()
+        self.clones = self.clone_creator().create()
+
+    def clone_creator(self, number_of_clones=None):
         parent_vm = self.config.client_vm
         base_snapshot = self.backup_snapshots[parent_vm]
-        clone_creator = self.clone_creator_class(parent_vm, base_snapshot, self.config.number_of_clones, self.vmmc)
-        self.clones = clone_creator.create()
+        if number_of_clones is None:
+            number_of_clones = self.config.number_of_clones
+        sources = None
+        if self.config.clone_strategy == "hybrid" and self.clone_bases:
+            sources = [(vm, self.clone_base_snapshot) for vm in self.clone_bases]
+        return self.clone_creator_class(
+            parent_vm, base_snapshot, number_of_clones, self.vmmc,
+            vrde_port_start=5000 + self.vrde_ports_per_session * self.config.session_slot,
+            max_parallel=self.config.max_parallel_clones,
+            mac_base=0x005056000000 + 0x10000 * self.config.session_slot,
+            name_prefix=self.session_prefix(), linked=self.config.clone_strategy != "full", sources=sources
+        )
+
+    @session_phase
+    def create_clone_bases(self):
+        current_vms = self.vmmc.get_vms()
+        self.clone_bases = [vm for vm in self.clone_bases if vm in current_vms]
+        parent_vm = self.config.client_vm
+        base_vms = list()
+        i = 1
+        while len(self.clone_bases) + len(base_vms) < self.config.hybrid_base_clones:
+            vm = self.session_prefix() + parent_vm + "Base" + str(i)
+            if vm not in current_vms and vm not in self.clone_bases:
+                base_vms.append(vm)
+            i += 1
+        if not base_vms:
+            return
+        logger.info("Creating full clones {vms} as bases for linked clones".format(vms=base_vms))
+
+        def create_clone_base(vm):
+            self.vmmc.clone(parent_vm, self.backup_snapshots[parent_vm], vm, linked=False)
+            self.vmmc.create_snapshot(vm, self.clone_base_snapshot)
 
+        results = run_parallel(
+            create_clone_base, base_vms, max_workers=self.config.max_parallel_clones,
+            exceptions=(VMMControllerException,)
+        )
+        failing_vms = failed_keys(results)
+        self.clone_bases.extend(vm for vm in base_vms if vm not in failing_vms)
+        if failing_vms:
+            try:
+                self.delete_vms(failing_vms)
+            except SessionHandlerException as e:
+                logger.warning("Exception: {e}".format(e=e))
+            raise SessionHandlerException("Could not create all clone bases. Failing: {vms}".format(vms=failing_vms))
+
+    @session_phase
+    def delete_clone_bases(self, report=None):
+        # Must run after delete_clones, linked clones depend on the disks of their base
+        if not self.clone_bases:
+            return
+        logger.info("Deleting clone bases")
+        try:
+            self.delete_vms(self.clone_bases, report=report)
+        except SessionHandlerException as e:
+            logger.warning("Exception: {e}".format(e=e))
+        current_vms = self.vmmc.get_vms()
+        self.clone_bases = [vm for vm in self.clone_bases if vm in current_vms]
+
+    @session_phase
+    def reconcile_clones(self):
+        logger.info("Reconciling warm pool to {n} clones".format(n=self.config.number_of_clones))
+        self.clones.sort(key=lambda clone: clone.id)
+        surplus_clones = self.clones[self.config.number_of_clones:]
+        if surplus_clones:
+            self.delete_vms([clone.vm for clone in surplus_clones])
+            del self.clones[self.config.number_of_clones:]
+        if self.config.clone_strategy == "hybrid":
+            self.create_clone_bases()
+        clone_creator = self.clone_creator()
+        changed_clones = [clone for clone in self.clones if clone_creator.update(clone)]
+        for clone in changed_clones:
+            if clone.snapshot == self.session_snapshot(self.golden_snapshot):
+                logger.warning('"{vm}" got a new configuration, its golden snapshot is replaced by a plain warm pool '
+                               'snapshot. Run build_golden_images again.'.format(vm=clone.vm))
+            if clone.snapshot is not None:
+                # A failed golden build leaves clones without a snapshot
+                self.vmmc.delete_snapshot(clone.vm, clone.snapshot)
+        self.create_warm_snapshots(changed_clones)
+        used_ids = {clone.id for clone in self.clones}
+        missing_ids = [id_ for id_ in range(1, self.config.number_of_clones + 1) if id_ not in used_ids]
+        if missing_ids:
+            new_clones = clone_creator.create(ids=missing_ids)
+            self.clones.extend(new_clones)
+            self.clones.sort(key=lambda clone: clone.id)
+            self.create_warm_snapshots(new_clones)
+
+    @session_phase
+    def create_warm_snapshots(self, clones):
+        if not clones:
+            return
+        logger.info("Creating warm pool snapshots")
+        for clone in clones:
+            clone.snapshot = self.session_snapshot(self.warm_snapshot)
+        results = run_parallel(
+            lambda clone: self.vmmc.create_snapshot(clone.vm, clone.snapshot), clones,
+            max_workers=self.config.max_parallel_clones, exceptions=(VMMControllerException,)
+        )
+        failing_vms = [clone.vm for clone in failed_keys(results)]
+        if failing_vms:
+            raise SessionHandlerException(
+                "Could not create warm pool snapshots. Failing: {vms}".format(vms=failing_vms))
+
+    @session_phase
+    def revert_clones(self, report=None):
+        logger.info("Reverting clones to their warm pool snapshots")
+        snapshots = {clone.vm: clone.snapshot for clone in self.clones if clone.snapshot is not None}
+        results = self.run_teardown_step(
+            "revert", lambda vm: self.vmmc.restore_snapshot(vm, snapshots[vm]), list(snapshots), report)
+        failing_vms = failed_keys(results)
+        if failing_vms:
+            logger.warning("Could not revert {vms}, removing them from the warm pool".format(vms=failing_vms))
+            try:
+                self.delete_vms(failing_vms, report=report)
+            except SessionHandlerException as e:
+                logger.warning("Exception: {e}".format(e=e))
+            self.clones = [clone for clone in self.clones if clone.vm not in failing_vms]
+
+    @session_phase
     def start_all_vms(self):
         logger.info("Starting all VMs")
+        stages = self.start_stages()
+        if self.staggered_start:
+            stages = self.stagger_stages(stages)
+        results = list()
+        for i, stage in enumerate(stages):
+            if i > 0 and self.staggered_start:
+                time.sleep(self.config.stagger_interval)
+            results.extend(self.start_vms(stage, raise_on_failure=False))
+        self.raise_on_start_failures(results)
+        return results
+
+    def stagger_stages(self, stages):
+        # At most as many virtual CPUs as the host has boot at the same time
+        try:
+            vm_infos = self.vmmc.get_vm_infos([vm for stage in stages for vm in stage])
+            host_cpus = self.vmmc.get_host_info().cpus or 1
+        except VMMControllerException as e:
+            logger.warning("Cannot stagger starts: {e}".format(e=e))
+            return stages
+        cpus = {vm: vm_info.cpus for vm, vm_info in vm_infos.items()}
+        return [batch for stage in stages for batch in start_batches(stage, cpus, host_cpus)]
+
+    def start_stages(self):
         clone_vms = [clone.vm for clone in self.clones]
-        self.start_vms(self.config.server_vms + clone_vms)
+        if not self.config.ordered_start:
+            return [self.config.server_vms + clone_vms]
+        router_vms = [vm for vm in self.config.server_vms if vm in self.config.router_vms]
+        other_server_vms = [vm for vm in self.config.server_vms if vm not in self.config.router_vms]
+        return [stage for stage in (router_vms, other_server_vms, clone_vms) if stage]
 
     def start_clones(self):
         logger.info("Starting clones")
         self.start_vms(self.clone_vms)
 
+    @session_phase
     def login_clones(self):
         logger.info("Login clones")
-        for clone in self.clones:
-            self.vmmc.set_credentials(clone.vm, clone.user, clone.password, clone.domain)
+        credentials = {clone.vm: (clone.user, clone.password, clone.domain) for clone in self.clones}
+        try:
+            self.vmmc.set_credentials_many(credentials, timeout=self.config.login_timeout)
+        except VMMControllerException as e:
+            raise SessionHandlerException("Could not log in all clones: {e}".format(e=e))
 
-    def poweroff_all_vms(self):
+    @session_phase
+    def poweroff_all_vms(self, report=None):
         logger.info("Poweroff all VMs")
         clone_vms = [clone.vm for clone in self.clones]
         try:
-            self.poweroff_vms(self.config.server_vms + clone_vms)
+            self.poweroff_vms(self.config.server_vms + clone_vms, report=report)
         except SessionHandlerException as e:
             logger.warning("Exception: {e}".format(e=e))
 
-    def delete_clones(self):
+    @session_phase
+    def delete_clones(self, report=None):
         logger.info("Deleting clones")
         clone_vms = [clone.vm for clone in self.clones]
         try:
-            self.delete_vms(clone_vms)
+            self.delete_vms(clone_vms, report=report)
         except SessionHandlerException as e:
             logger.warning("Exception: {e}".format(e=e))
         self.clones.clear()
 
-    def restore_delete_backup_snapshots(self):
+    @session_phase
+    def restore_delete_backup_snapshots(self, report=None, keep_vms=()):
         logger.info("Restoring and deleting backup snapshots")
+        snapshots = {vm: snapshot for vm, snapshot in self.backup_snapshots.items() if vm not in keep_vms}
         try:
-            self.restore_delete_snapshots(self.backup_snapshots)
+            self.restore_delete_snapshots(snapshots, report=report)
         except SessionHandlerException as e:
             logger.warning("Exception: {e}".format(e=str(e)))
-        self.backup_snapshots.clear()
+        for vm in snapshots:
+            del self.backup_snapshots[vm]
 
-    def start_vms(self, vms):
-        for vm in vms:
-            self.vmmc.start(vm)
-            self.take_vm_start_timeout()
-
-    def restore_delete_snapshots(self, snapshots):
-        fails, max_fails, timeout = 0, 100, 0.01
-        snaps = snapshots.copy()
-        while snaps and fails < max_fails:
-            vm, snap = snaps.popitem()
-            try:
-                self.vmmc.restore_snapshot(vm, snap)
-                self.vmmc.delete_snapshot(vm, snap)
-            except VMMControllerException:
-                fails += 1
-                snaps[vm] = snap
-                time.sleep(timeout)
-        if snaps:
+    def start_vms(self, vms, raise_on_failure=True):
+        # Powering on a running VM fails, so VMs that already run are left alone
+        inventory = self.vmmc.get_inventory()
+        running_vms = [vm for vm in vms if inventory.get(vm)]
+        if running_vms:
+            logger.info("Already running: {vms}".format(vms=running_vms))
+        results = run_parallel(
+            self.start_vm, [vm for vm in vms if vm not in running_vms], max_workers=self.config.max_parallel_starts,
+            exceptions=(VMMControllerException,)
+        )
+        for result in results:
+            if result.succeeded:
+                logger.info('Started "{vm}" in {duration:.1f}s'.format(vm=result.key, duration=result.value))
+            else:
+                logger.warning('Could not start "{vm}": {e}'.format(vm=result.key, e=result.error))
+        if raise_on_failure:
+            self.raise_on_start_failures(results)
+        return results
+
+    def start_vm(self, vm):
+        start = time.perf_counter()
+        self.vmmc.start(vm)
+        duration = time.perf_counter() - start
+        self.take_vm_start_timeout()
+        return duration
+
+    @staticmethod
+    def raise_on_start_failures(results):
+        failing_vms = failed_keys(results)
+        if failing_vms:
+            raise SessionHandlerException("Could not start all machines. Failing: {vms}".format(vms=failing_vms))
+
+    def restore_delete_snapshots(self, snapshots, report=None):
+        def restore_delete_snapshot(vm):
+            self.vmmc.restore_snapshot(vm, snapshots[vm])
+            self.vmmc.delete_snapshot(vm, snapshots[vm])
+
+        results = self.run_teardown_step("restore", restore_delete_snapshot, list(snapshots), report)
+        failing_snaps = {vm: snapshots[vm] for vm in failed_keys(results)}
+        if failing_snaps:
             raise SessionHandlerException(
-                "Could not restore and delete all snapshots. Failing: {snaps}".format(snaps=snaps)
+                "Could not restore and delete all snapshots. Failing: {snaps}".format(snaps=failing_snaps)
             )
 
-    def poweroff_vms(self, vms):
-        fails, max_fails, timeout = 0, 100, 0.01
-        running_vms = [vm for vm in vms if self.vmmc.is_running(vm)]
-        while running_vms and fails < max_fails:
-            vm = running_vms.pop()
-            try:
-                self.vmmc.poweroff(vm)
-            except VMMControllerException:
-                fails += 1
-                running_vms.append(vm)
-                time.sleep(timeout)
-        if running_vms:
+    def poweroff_vms(self, vms, report=None):
+        inventory = self.vmmc.get_inventory()
+        running_vms = [vm for vm in vms if inventory.get(vm)]
+        results = self.run_teardown_step("poweroff", self.vmmc.poweroff, running_vms, report)
+        failing_vms = failed_keys(results)
+        if failing_vms:
             raise SessionHandlerException(
-                "Could not poweroff all machines. Still alive: {vms}".format(vms=running_vms)
+                "Could not poweroff all machines. Still alive: {vms}".format(vms=failing_vms)
             )
 
-    def delete_vms(self, vms):
-        fails, max_fails, timeout = 0, 100, 0.01
+    def delete_vms(self, vms, report=None):
         current_vms = self.vmmc.get_vms()
         existing_vms = [vm for vm in vms if vm in current_vms]
-        while existing_vms and fails < max_fails:
-            vm = existing_vms.pop()
-            try:
-                self.vmmc.delete(vm)
-            except VMMControllerException:
-                fails += 1
-                existing_vms.append(vm)
-                time.sleep(timeout)
-        if existing_vms:
-            raise SessionHandlerException("Could not delete all machines. Still there: {vms}".format(vms=existing_vms))
+        results = self.run_teardown_step("delete", self.vmmc.delete, existing_vms, report)
+        failing_vms = failed_keys(results)
+        if failing_vms:
+            raise SessionHandlerException("Could not delete all machines. Still there: {vms}".format(vms=failing_vms))
+
+    def run_teardown_step(self, step, func, vms, report=None):
+        def log_progress(done, total, result):
+            logger.info("{step}: {done}/{total} ({vm}: {status})".format(
+                step=step, done=done, total=total, vm=result.key, status=TeardownReport.status(result)))
+
+        results = run_parallel(
+            func, vms, max_workers=self.config.max_parallel_teardown, exceptions=(VMMControllerException,),
+            retries=self.teardown_retries, backoff=self.teardown_backoff, progress=log_progress
+        )
+        if report is not None:
+            report.add(step, results)
+        return results
 
     def take_vm_start_timeout(self):
         time.sleep(self.config.vm_start_timeout)
 
 
+def format_mac(mac):
+    return None if mac is None else hex(mac)[2:].rjust(12, "0")
+
+
 class SessionHandlerException(Exception):
     pass
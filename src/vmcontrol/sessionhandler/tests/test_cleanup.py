@@ -0,0 +1,194 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import pytest
+
+from vmcontrol.sessionhandler import SessionHandler, SessionHandlerException
+from vmcontrol.sessionhandler.cleanup import SessionCleanup, CleanupPlan, clone_pattern, backup_pattern
+from vmcontrol.sessionhandler.tests.test_sessionhandler import build_session_handler, \
+    build_session_handler_with_state_file
+from vmcontrol.vmmcontroller import VMMControllerException
+
+
+@pytest.fixture()
+def sh():
+    return build_session_handler()
+
+
+def crashed_session(sh: SessionHandler):
+    # Leave everything behind as if the process had been killed during a session
+    sh.start_session()
+    sh.session_running = False
+    sh.clones = list()
+    sh.backup_snapshots = dict()
+    return sh
+
+
+def session_vms(sh: SessionHandler):
+    return sh.config.server_vms + [sh.config.client_vm]
+
+
+def clone_vms(sh: SessionHandler):
+    return ["ClientClone{i}".format(i=i) for i in range(1, sh.config.number_of_clones + 1)]
+
+
+class TestPatterns:
+    def test_clone_pattern(self):
+        pattern = clone_pattern("Client")
+        assert pattern.match("ClientClone1")
+        assert pattern.match("ClientClone12aa")
+        assert pattern.match("ClientBase0")
+        assert not pattern.match("Client")
+        assert not pattern.match("OtherClone1")
+        assert not pattern.match("s1-ClientClone1")
+
+    def test_clone_pattern_with_session_id(self):
+        pattern = clone_pattern("Client", "s1")
+        assert pattern.match("s1-ClientClone1")
+        assert not pattern.match("ClientClone1")
+        assert not pattern.match("s2-ClientClone1")
+
+    def test_backup_pattern(self):
+        assert backup_pattern("Backup").match("Backup3")
+        assert not backup_pattern("Backup").match("Backup-s1")
+        assert backup_pattern("Backup", "s1").match("Backup-s10")
+        assert not backup_pattern("Backup", "s1").match("Backup")
+
+
+class TestSessionCleanup:
+    def build_cleanup(self, sh: SessionHandler):
+        return SessionCleanup(sh.vmmc, sh.config.server_vms, sh.config.client_vm, session_id=sh.config.session_id)
+
+    def test_nothing_to_clean_up(self, sh: SessionHandler):
+        plan = self.build_cleanup(sh).plan()
+        assert plan.empty
+        assert str(plan) == "Nothing to clean up"
+
+    def test_plan(self, sh: SessionHandler):
+        crashed_session(sh)
+        plan = self.build_cleanup(sh).plan()
+        assert sorted(plan.poweroff) == sorted(sh.config.server_vms + clone_vms(sh))
+        assert plan.delete == clone_vms(sh)
+        assert plan.restore == {vm: ["Backup"] for vm in session_vms(sh)}
+
+    def test_plan_does_not_change_anything(self, sh: SessionHandler):
+        crashed_session(sh)
+        self.build_cleanup(sh).plan()
+        assert "ClientClone1" in sh.vmmc.get_vms()
+        assert all(sh.vmmc.is_running(vm) for vm in sh.config.server_vms)
+
+    def test_execute(self, sh: SessionHandler):
+        crashed_session(sh)
+        failing = self.build_cleanup(sh).execute()
+        assert failing == {}
+        assert not set(clone_vms(sh)) & set(sh.vmmc.get_vms())
+        assert not any(sh.vmmc.is_running(vm) for vm in session_vms(sh))
+        for vm in session_vms(sh):
+            assert sh.vmmc.get_snapshots(vm) == []
+        assert self.build_cleanup(sh).plan().empty
+
+    def test_multiple_backups_are_restored_to_oldest(self, sh: SessionHandler):
+        vm = sh.config.client_vm
+        sh.vmmc.create_snapshot(vm, "Backup")
+        sh.vmmc.create_snapshot(vm, "Backup0")
+        sh.vmmc.restore_snapshot = lambda vm, snapshot: restored.append(snapshot)
+        restored = list()
+        plan = self.build_cleanup(sh).plan()
+        assert plan.restore == {vm: ["Backup", "Backup0"]}
+        assert self.build_cleanup(sh).execute(plan) == {}
+        assert restored == ["Backup"]
+        assert sh.vmmc.get_snapshots(vm) == []
+
+    def test_clone_bases_are_deleted_last(self, sh: SessionHandler):
+        sh.vmmc.create_snapshot(sh.config.client_vm, "Snapshot")
+        sh.vmmc.clone(sh.config.client_vm, "Snapshot", "ClientBase0")
+        sh.vmmc.create_snapshot("ClientBase0", "CloneBase")
+        sh.vmmc.clone("ClientBase0", "CloneBase", "ClientClone1")
+        deleted = list()
+        delete = sh.vmmc.delete
+        sh.vmmc.delete = lambda vm: deleted.append(vm) or delete(vm)
+        cleanup = self.build_cleanup(sh)
+        assert cleanup.plan().delete == ["ClientClone1", "ClientBase0"]
+        cleanup.execute()
+        assert deleted == ["ClientClone1", "ClientBase0"]
+
+    def test_other_sessions_are_left_alone(self, sh: SessionHandler):
+        sh.config.session_id = "s1"
+        crashed_session(sh)
+        sh.vmmc.create_snapshot(sh.config.client_vm, "Snapshot")
+        sh.vmmc.clone(sh.config.client_vm, "Snapshot", "s2-ClientClone1")
+        sh.vmmc.create_snapshot(sh.config.client_vm, "Backup-s2")
+        plan = self.build_cleanup(sh).plan()
+        assert plan.delete == ["s1-" + vm for vm in clone_vms(sh)]
+        assert plan.restore[sh.config.client_vm] == ["Backup-s1"]
+
+    def test_failures_are_reported(self, sh: SessionHandler):
+        crashed_session(sh)
+
+        def fail(vm):
+            raise VMMControllerException()
+
+        sh.vmmc.delete = fail
+        cleanup = self.build_cleanup(sh)
+        cleanup.retries = 0
+        assert cleanup.execute() == {"delete": clone_vms(sh)}
+
+
+class TestCleanupFailedSession:
+    def test_dry_run(self, sh: SessionHandler):
+        crashed_session(sh)
+        plan = sh.cleanup_failed_session(dry_run=True)
+        assert isinstance(plan, CleanupPlan)
+        assert plan.delete == clone_vms(sh)
+        assert "ClientClone1" in sh.vmmc.get_vms()
+
+    def test_cleanup_without_state(self, tmpdir):
+        session_state_file = os.path.join(str(tmpdir), "sessionstate")
+        sh = build_session_handler_with_state_file(session_state_file)
+        sh.start_session()
+        # A new process without state file and journal still finds the leftovers
+        os.remove(session_state_file)
+        sh.journal.clear()
+        sh_2 = SessionHandler(sh.vmmc.vmmc, sh.config, session_state_file)
+        assert not sh_2.session_running
+        plan = sh_2.cleanup_failed_session()
+        assert plan.delete == clone_vms(sh_2)
+        assert "ClientClone1" not in sh_2.vmmc.get_vms()
+        assert not os.path.isfile(session_state_file)
+        sh_2.start_session()
+        sh_2.close_session()
+
+    def test_cleanup_resets_session(self):
+        sh = build_session_handler()
+        sh.start_session()
+        sh.cleanup_failed_session()
+        assert not sh.session_running
+        assert sh.clones == []
+        assert sh.backup_snapshots == {}
+
+    def test_failure_raises(self, sh: SessionHandler):
+        crashed_session(sh)
+
+        def fail(vm):
+            raise VMMControllerException()
+
+        sh.vmmc.poweroff = fail
+        with pytest.raises(SessionHandlerException):
+            sh.cleanup_failed_session()
@@ -0,0 +1,120 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+from unittest.mock import Mock
+
+import pytest
+
+from vmcontrol.sessionhandler import CloneBenchmark, SessionHandler, SessionHandlerException
+from vmcontrol.sessionhandler.clonebenchmark import read_disk_stats, StrategyResult
+from vmcontrol.sessionhandler.tests.test_sessionhandler import mock_vmm_controller_from_session_handler_config
+from vmcontrol.vmmcontroller import VMMControllerException
+
+
+class FakeDiskStats:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return 1000 * self.calls, 3000 * self.calls
+
+
+@pytest.fixture()
+def benchmark():
+    config = SessionHandler.default_config()
+    vmmc = mock_vmm_controller_from_session_handler_config(config)
+    return CloneBenchmark(vmmc, config, wait_ready=False, disk_stats=FakeDiskStats())
+
+
+class TestCloneBenchmark:
+    def test_run_all_strategies(self, benchmark: CloneBenchmark):
+        vms_before = benchmark.vmmc.get_vms()
+        results = benchmark.run()
+        assert [result.strategy for result in results] == ["linked", "full", "hybrid"]
+        for result in results:
+            assert result.error is None
+            assert result.clone_time is not None and result.start_time is not None
+            assert result.ready_time is None
+            assert (result.read_bytes, result.written_bytes) == (1000, 3000)
+        assert benchmark.vmmc.get_vms() == vms_before
+        assert benchmark.config.clone_strategy == "linked"
+        for vm in vms_before:
+            assert not benchmark.vmmc.is_running(vm)
+
+    def test_failing_strategy_is_cleaned_up(self, benchmark: CloneBenchmark):
+        vms_before = benchmark.vmmc.get_vms()
+        create_snapshot = benchmark.vmmc.create_snapshot
+
+        def fail_for_clone_bases(vm, snapshot):
+            if snapshot == SessionHandler.clone_base_snapshot:
+                raise VMMControllerException()
+            create_snapshot(vm, snapshot)
+
+        benchmark.vmmc.create_snapshot = fail_for_clone_bases
+        benchmark.strategies = ["hybrid"]
+        [result] = benchmark.run()
+        assert "clone bases" in result.error
+        assert benchmark.vmmc.get_vms() == vms_before
+
+    def test_interrupted_strategy_is_cleaned_up(self, benchmark: CloneBenchmark, tmpdir):
+        vms_before = benchmark.vmmc.get_vms()
+        benchmark.session_state_file = str(tmpdir.join("sessionstate"))
+        benchmark.vmmc.start = Mock(side_effect=KeyboardInterrupt)
+        with pytest.raises(KeyboardInterrupt):
+            benchmark.run()
+        assert benchmark.vmmc.get_vms() == vms_before
+        assert tmpdir.listdir() == []
+
+    def test_killed_benchmark_can_be_recovered(self, benchmark: CloneBenchmark, tmpdir):
+        vms_before = benchmark.vmmc.get_vms()
+        snapshots_before = benchmark.vmmc.get_snapshots_many(vms_before)
+        benchmark.session_state_file = str(tmpdir.join("sessionstate"))
+        benchmark.vmmc.start = Mock(side_effect=KeyboardInterrupt)
+        benchmark.clean_up = Mock()
+        with pytest.raises(KeyboardInterrupt):
+            benchmark.run()
+        assert benchmark.vmmc.get_vms() != vms_before
+        sh = SessionHandler(benchmark.vmmc, benchmark.config, benchmark.session_state_file)
+        sh.recover_session()
+        assert benchmark.vmmc.get_vms() == vms_before
+        assert benchmark.vmmc.get_snapshots_many(vms_before) == snapshots_before
+
+    def test_unknown_strategy(self, benchmark: CloneBenchmark):
+        benchmark.strategies = ["linked", "magic"]
+        with pytest.raises(SessionHandlerException):
+            benchmark.run()
+
+    def test_result_str(self):
+        result = StrategyResult(strategy="full", clone_time=12.5, read_bytes=2 ** 21, error="Boom")
+        assert str(result) == (
+            "full     clone    12.5s start        - ready        - read       2.0 MB written         - MB"
+            "\n\terror: Boom")
+
+
+def test_read_disk_stats(tmpdir):
+    diskstats = tmpdir.join("diskstats")
+    diskstats.write(
+        "   8       0 sda 100 0 8 0 50 0 16 0 0 0 0\n"
+        "   8       1 sda1 100 0 8 0 50 0 16 0 0 0 0\n"
+        "   7       0 loop0 100 0 8 0 50 0 16 0 0 0 0\n")
+    block_devices = tmpdir.mkdir("block")
+    block_devices.mkdir("sda")
+    block_devices.mkdir("loop0")
+    assert read_disk_stats(str(diskstats), str(block_devices)) == (8 * 512, 16 * 512)
+    assert read_disk_stats(str(tmpdir.join("missing")), str(block_devices)) is None
@@ -0,0 +1,171 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import pytest
+
+from vmcontrol.sessionhandler import SessionHandler, SessionHandlerException
+from vmcontrol.sessionhandler.journal import Journal, JournalingVMMController, JournalRecovery
+from vmcontrol.sessionhandler.tests.test_sessionhandler import build_session_handler_with_state_file
+from vmcontrol.vmmcontroller.tests.mocks import MockVMMController
+
+
+@pytest.fixture()
+def journal(tmpdir):
+    journal = Journal(os.path.join(str(tmpdir), "journal"))
+    journal.open()
+    return journal
+
+
+class Crash(Exception):
+    pass
+
+
+def crash(*args, **kwargs):
+    raise Crash()
+
+
+class TestJournal:
+    def test_inactive_journal_does_not_record(self, tmpdir):
+        journal = Journal(os.path.join(str(tmpdir), "journal"))
+        journal.record("start", vm="VM")
+        assert not journal.active
+        assert journal.entries() == []
+
+    def test_record(self, journal: Journal):
+        journal.record("start", vm="VM")
+        journal.record("clone", vm="VM", snapshot="Snap", clone="Clone")
+        entries = journal.entries()
+        assert [entry["op"] for entry in entries] == ["start", "clone"]
+        assert entries[1]["args"] == {"vm": "VM", "snapshot": "Snap", "clone": "Clone"}
+
+    def test_broken_last_line_is_skipped(self, journal: Journal):
+        journal.record("start", vm="VM")
+        with open(journal.path, "a") as f:
+            f.write('{"op": "sta')
+        assert [entry["op"] for entry in journal.entries()] == ["start"]
+
+    def test_clear(self, journal: Journal):
+        journal.record("start", vm="VM")
+        journal.clear()
+        assert not journal.active
+
+
+class TestJournalingVMMController:
+    def test_mutations_are_recorded(self, journal: Journal):
+        vmmc = JournalingVMMController(MockVMMController(), journal)
+        vm = vmmc.get_vms()[0]
+        vmmc.create_snapshots({vm: "Snap"})
+        vmmc.clone(vm, "Snap", "Clone")
+        vmmc.configure_clone("Clone", macs={1: 42})
+        vmmc.start("Clone")
+        assert vmmc.is_running("Clone")
+        assert [entry["op"] for entry in journal.entries()] == [
+            "create_snapshot", "clone", "configure_clone", "start"]
+
+    def test_clone_and_configure_is_recorded_as_clone(self, journal: Journal):
+        vmmc = JournalingVMMController(MockVMMController(), journal)
+        vm = vmmc.get_vms()[0]
+        vmmc.create_snapshot(vm, "Snap")
+        vmmc.clone_and_configure(vm, "Snap", "Clone", macs={1: 42})
+        assert vmmc.get_mac("Clone", if_id=1) == 42
+        assert [entry["op"] for entry in journal.entries()] == ["create_snapshot", "clone"]
+
+
+class TestJournalRecovery:
+    def test_undo(self, journal: Journal):
+        mvmmc = MockVMMController()
+        vmmc = JournalingVMMController(mvmmc, journal)
+        vm = vmmc.get_vms()[0]
+        vmmc.create_snapshot(vm, "Snap")
+        vmmc.clone(vm, "Snap", "Clone")
+        vmmc.create_snapshot("Clone", "Warm")
+        vmmc.start(vm)
+        vmmc.start("Clone")
+        recovery = JournalRecovery(journal.entries(), mvmmc)
+        assert recovery.plan() == {"poweroff": [vm, "Clone"], "delete": ["Clone"], "restore": {vm: ["Snap"]}}
+        assert recovery.undo() == {}
+        assert "Clone" not in mvmmc.get_vms()
+        assert not mvmmc.is_running(vm)
+        assert mvmmc.get_snapshots(vm) == []
+
+    def test_undone_steps_are_skipped(self, journal: Journal):
+        mvmmc = MockVMMController()
+        vmmc = JournalingVMMController(mvmmc, journal)
+        vm = vmmc.get_vms()[0]
+        vmmc.create_snapshot(vm, "Snap")
+        vmmc.start(vm)
+        vmmc.poweroff(vm)
+        vmmc.delete_snapshot(vm, "Snap")
+        recovery = JournalRecovery(journal.entries(), mvmmc)
+        assert recovery.plan() == {"poweroff": [], "delete": [], "restore": {}}
+
+
+    def test_kept_snapshots_are_not_restored(self, journal: Journal):
+        mvmmc = MockVMMController()
+        vmmc = JournalingVMMController(mvmmc, journal)
+        vm = vmmc.get_vms()[0]
+        vmmc.create_snapshot(vm, "Backup")
+        vmmc.create_snapshot(vm, "Golden")
+        recovery = JournalRecovery(journal.entries(), mvmmc, keep_snapshots=["Golden"])
+        assert recovery.plan()["restore"] == {vm: ["Backup"]}
+        recovery.undo()
+        assert mvmmc.get_snapshots(vm) == ["Golden"]
+
+
+class TestRecoverSession:
+    def test_start_needs_recovery_after_crash(self, tmpdir):
+        state_file = os.path.join(str(tmpdir), "state")
+        sh = build_session_handler_with_state_file(state_file)
+        vms_before = sh.vmmc.get_vms()
+        sh.vmmc.vmmc.start = crash
+        with pytest.raises(Crash):
+            sh.start_session()
+        sh_2 = SessionHandler(sh.vmmc.vmmc, sh.config, state_file)
+        with pytest.raises(SessionHandlerException):
+            sh_2.start_session()
+        sh_2.recover_session()
+        assert sh_2.vmmc.get_vms() == vms_before
+        for vm in sh_2.server_and_client_vms():
+            assert sh_2.vmmc.get_snapshots(vm) == []
+        assert not os.path.isfile(state_file)
+        assert not sh_2.journal.active
+
+    def test_crash_in_running_session(self, tmpdir):
+        state_file = os.path.join(str(tmpdir), "state")
+        sh = build_session_handler_with_state_file(state_file)
+        sh.start_session()
+        sh_2 = SessionHandler(sh.vmmc.vmmc, sh.config, state_file)
+        assert sh_2.session_running
+        sh_2.recover_session()
+        assert not sh_2.session_running
+        for vm in sh_2.vmmc.get_vms():
+            assert not sh_2.vmmc.is_running(vm)
+            assert "Clone" not in vm
+        sh_2.start_session()
+        sh_2.close_session()
+
+    def test_journal_is_removed_after_close(self, tmpdir):
+        sh = build_session_handler_with_state_file(os.path.join(str(tmpdir), "state"))
+        sh.start_session()
+        assert sh.journal.entries()
+        sh.close_session()
+        assert not sh.journal.active
+        with pytest.raises(SessionHandlerException):
+            sh.recover_session()
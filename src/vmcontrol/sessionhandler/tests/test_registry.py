@@ -0,0 +1,151 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from vmcontrol.sessionhandler import SessionHandler, SessionConfig, SessionHandlerException, SessionRegistry
+from vmcontrol.vmmcontroller import VMMControllerException
+from vmcontrol.vmmcontroller.tests.mocks import MockVMMController
+
+
+def session_config(session_id, suffix):
+    config = SessionConfig(session_id=session_id)
+    config.server_vms = [vm + suffix for vm in SessionConfig.server_vms]
+    config.client_vm = SessionConfig.client_vm + suffix
+    return config
+
+
+def mock_vmm_controller(configs):
+    mvmc = MockVMMController()
+    base_vm = mvmc.get_vms()[0]
+    mvmc.create_snapshot(base_vm, "BaseSnapshot")
+    for config in configs:
+        for vm in config.server_vms + [config.client_vm]:
+            mvmc.clone(base_vm, "BaseSnapshot", vm)
+    return mvmc
+
+
+@pytest.fixture()
+def registry(tmpdir):
+    return SessionRegistry(str(tmpdir))
+
+
+def build_session_handler(registry, vmmc, config):
+    return SessionHandler(vmmc, config, registry.state_file(config.session_id), registry=registry)
+
+
+class TestSessionRegistry:
+    def test_invalid_session_id(self, registry: SessionRegistry):
+        with pytest.raises(SessionHandlerException):
+            registry.state_file("../escape")
+
+    def test_two_sessions(self, registry: SessionRegistry):
+        config_a, config_b = session_config("a", " A"), session_config("b", " B")
+        vmmc = mock_vmm_controller([config_a, config_b])
+        sh_a = build_session_handler(registry, vmmc, config_a)
+        sh_b = build_session_handler(registry, vmmc, config_b)
+        sh_a.start_session()
+        sh_b.start_session()
+        assert set(registry.sessions()) == {"a", "b"}
+        assert {sh_a.config.session_slot, sh_b.config.session_slot} == {1, 2}
+        assert set(sh_a.clone_vms).isdisjoint(sh_b.clone_vms)
+        for sh in (sh_a, sh_b):
+            for clone in sh.clones:
+                assert clone.vm.startswith(sh.config.session_id + "-")
+        macs = [clone.management_mac for sh in (sh_a, sh_b) for clone in sh.clones]
+        macs += [clone.internal_mac for sh in (sh_a, sh_b) for clone in sh.clones]
+        assert len(set(macs)) == len(macs)
+        ports = [clone.vrde_port for sh in (sh_a, sh_b) for clone in sh.clones]
+        assert len(set(ports)) == len(ports)
+        assert sh_a.backup_snapshots[config_a.client_vm] == "Backup-a"
+        sh_a.close_session()
+        sh_b.close_session()
+        assert registry.sessions() == {}
+
+    def test_failed_start_releases_registration(self, registry: SessionRegistry):
+        config_a, config_b = session_config("a", " A"), session_config("b", " B")
+        vmmc = mock_vmm_controller([config_a, config_b])
+        sh_a = build_session_handler(registry, vmmc, config_a)
+        create_snapshot = vmmc.create_snapshot
+        vmmc.create_snapshot = Mock(side_effect=VMMControllerException("disk full"))
+        with pytest.raises(SessionHandlerException):
+            sh_a.start_session()
+        assert registry.sessions() == {}
+        vmmc.create_snapshot = create_snapshot
+        sh_b = build_session_handler(registry, vmmc, config_b)
+        sh_b.start_session()
+        assert sh_b.config.session_slot == 1
+
+    def test_refuse_shared_vms(self, registry: SessionRegistry):
+        config_a, config_b = session_config("a", ""), session_config("b", "")
+        vmmc = mock_vmm_controller([config_a])
+        build_session_handler(registry, vmmc, config_a).start_session()
+        with pytest.raises(SessionHandlerException) as ei:
+            build_session_handler(registry, vmmc, config_b).start_session()
+        assert "already used" in str(ei.value)
+
+    def test_refuse_too_many_sessions(self, tmpdir):
+        registry = SessionRegistry(str(tmpdir), max_sessions=1)
+        config_a, config_b = session_config("a", " A"), session_config("b", " B")
+        vmmc = mock_vmm_controller([config_a, config_b])
+        build_session_handler(registry, vmmc, config_a).start_session()
+        with pytest.raises(SessionHandlerException):
+            build_session_handler(registry, vmmc, config_b).start_session()
+
+    def test_refuse_too_many_clones(self, tmpdir):
+        registry = SessionRegistry(str(tmpdir), max_clones=5)
+        config_a, config_b = session_config("a", " A"), session_config("b", " B")
+        vmmc = mock_vmm_controller([config_a, config_b])
+        build_session_handler(registry, vmmc, config_a).start_session()
+        with pytest.raises(SessionHandlerException) as ei:
+            build_session_handler(registry, vmmc, config_b).start_session()
+        assert "3 of 5 clones" in str(ei.value)
+        config_b.number_of_clones = 2
+        build_session_handler(registry, vmmc, config_b).start_session()
+
+    def test_admission_waits_for_registry_lock(self, registry: SessionRegistry):
+        config = session_config("a", " A")
+        sh = build_session_handler(registry, mock_vmm_controller([config]), config)
+        with registry.lock():
+            thread = threading.Thread(target=sh.start_session)
+            thread.start()
+            thread.join(timeout=0.2)
+            assert thread.is_alive()
+            assert registry.sessions() == {}
+        thread.join()
+        assert set(registry.sessions()) == {"a"}
+        assert sh.config.session_slot == 1
+
+    def test_capacity_counts_other_sessions(self, registry: SessionRegistry):
+        # Mock VMs have 1024 MB each, the host 16384 MB with 2048 MB reserved: room for 14 VMs
+        config_a, config_b = session_config("a", " A"), session_config("b", " B")
+        config_b.capacity_policy = "refuse"
+        vmmc = mock_vmm_controller([config_a, config_b])
+        sh_a = build_session_handler(registry, vmmc, config_a)
+        sh_b = build_session_handler(registry, vmmc, config_b)
+        assert sh_b.estimate_capacity().memory_fits
+        sh_a.start_session()
+        assert sh_b.estimate_capacity().memory == 18 * 1024
+        with pytest.raises(SessionHandlerException) as ei:
+            sh_b.start_session()
+        assert "exceed the host capacity" in str(ei.value)
+        sh_a.close_session()
+        sh_b.start_session()
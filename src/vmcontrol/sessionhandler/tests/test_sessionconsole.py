@@ -27,6 +27,8 @@ class MockSessionHandler:
     def __init__(self):
         self.start_session = Mock()
         self.close_session = Mock()
+        self.scale_clones = Mock()
+        self.cleanup_failed_session = Mock()
         self.vmmc = Mock()
 
 
@@ -43,3 +45,30 @@ class TestTBFVMControlShell:
     def test_close_session(self, sc: SessionConsole):
         sc.do_close_session("")
         assert sc.session_handler.close_session.called
+
+    def test_close_session_prints_report(self, sc: SessionConsole, capsys):
+        sc.session_handler.close_session.return_value = "the report"
+        sc.do_close_session("")
+        assert "the report" in capsys.readouterr().out
+
+    def test_scale_clones(self, sc: SessionConsole):
+        sc.do_scale_clones("7")
+        sc.session_handler.scale_clones.assert_called_with(7)
+
+    def test_scale_clones_needs_number(self, sc: SessionConsole):
+        sc.do_scale_clones("")
+        assert not sc.session_handler.scale_clones.called
+
+    def test_start_session_wait_ready(self, sc: SessionConsole):
+        sc.do_start_session("wait_ready")
+        sc.session_handler.start_session.assert_called_with(wait_ready=True)
+
+    def test_cleanup_failed_session(self, sc: SessionConsole, capsys):
+        sc.session_handler.cleanup_failed_session.return_value = "the plan"
+        sc.do_cleanup_failed_session("")
+        sc.session_handler.cleanup_failed_session.assert_called_with(dry_run=False)
+        assert "the plan" in capsys.readouterr().out
+
+    def test_cleanup_failed_session_dry_run(self, sc: SessionConsole):
+        sc.do_cleanup_failed_session("dry_run")
+        sc.session_handler.cleanup_failed_session.assert_called_with(dry_run=True)
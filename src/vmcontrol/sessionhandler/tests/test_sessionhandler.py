@@ -16,13 +16,17 @@
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
 
 
+import logging
 import os
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, patch, call
 
 import pytest
 
-from vmcontrol.sessionhandler import SessionHandler, SessionConfig, SessionHandlerException, CloneCreator
+from vmcontrol.sessionhandler import SessionHandler, SessionConfig, SessionHandlerException, CloneCreator, \
+    TeardownReport
 from vmcontrol.sessionhandler.sessionhandler import Clone, DictNamespace
+from vmcontrol.readiness import ReadinessException
+from vmcontrol.statewatcher import PollingStateWatcher
 from vmcontrol.vmmcontroller import VMMControllerException
 from vmcontrol.vmmcontroller.tests.mocks import MockVMMController
 
@@ -79,6 +83,17 @@ def mock_vmm_controller_from_session_handler_config(config: SessionConfig):
     return mvmc
 
 
+def fail_start(vmmc, failing_vm):
+    start = vmmc.start
+
+    def failing_start(vm):
+        if vm == failing_vm:
+            raise VMMControllerException("locked")
+        start(vm)
+
+    vmmc.start = failing_start
+
+
 @pytest.fixture()
 def sh():
     return build_session_handler()
@@ -136,6 +151,59 @@ class TestSessionHandler:
             assert sh.vmmc.is_running(vm)
         assert sh.take_vm_start_timeout.call_count == len(vms)
 
+    def test_start_vms_in_parallel(self, sh: SessionHandler):
+        vms = sh.vmmc.get_vms()
+        sh.config.max_parallel_starts = 4
+        results = sh.start_vms(vms)
+        assert [result.key for result in results] == vms
+        for vm in vms:
+            assert sh.vmmc.is_running(vm)
+
+    def test_start_vms_reports_duration(self, sh: SessionHandler):
+        vms = sh.vmmc.get_vms()
+        results = sh.start_vms(vms)
+        for result in results:
+            assert result.value >= 0
+
+    def test_start_vms_collects_failures(self, sh: SessionHandler):
+        vms = sh.vmmc.get_vms()
+        sh.config.max_parallel_starts = 4
+        fail_start(sh.vmmc, vms[0])
+        with pytest.raises(SessionHandlerException) as ei:
+            sh.start_vms(vms)
+        assert vms[0] in str(ei.value)
+        for vm in vms[1:]:
+            assert sh.vmmc.is_running(vm)
+
+    def test_start_vms_skips_running_vms(self, sh: SessionHandler):
+        vms = sh.vmmc.get_vms()
+        sh.vmmc.start(vms[0])
+        results = sh.start_vms(vms)
+        assert [result.key for result in results] == vms[1:]
+        for vm in vms:
+            assert sh.vmmc.is_running(vm)
+
+    def test_start_stages(self, sh: SessionHandler):
+        sh.create_backup_snapshots([sh.config.client_vm])
+        sh.create_clones()
+        assert sh.start_stages() == [sh.config.server_vms + sh.clone_vms]
+        sh.config.ordered_start = True
+        routers, servers, clones = sh.start_stages()
+        assert set(routers) == set(sh.config.router_vms)
+        assert set(servers) == set(sh.config.server_vms) - set(sh.config.router_vms)
+        assert clones == sh.clone_vms
+
+    def test_ordered_start(self, sh: SessionHandler):
+        sh.config.ordered_start = True
+        sh.config.max_parallel_starts = 3
+        started = list()
+        start = sh.vmmc.start
+        sh.vmmc.start = lambda vm: started.append(vm) or start(vm)
+        sh.start_session()
+        stages = sh.start_stages()
+        assert set(started[:len(stages[0])]) == set(stages[0])
+        assert set(started[-len(stages[2]):]) == set(stages[2])
+
     def test_poweroff_vms(self, sh: SessionHandler):
         vms = sh.vmmc.get_vms()
         sh.start_vms(vms)
@@ -143,6 +211,13 @@ class TestSessionHandler:
         for vm in vms:
             assert not sh.vmmc.is_running(vm)
 
+    def test_poweroff_vms_queries_inventory_once(self, sh: SessionHandler):
+        sh.start_vms(sh.config.server_vms)
+        sh.vmmc.get_inventory = Mock(return_value={vm: True for vm in sh.config.server_vms})
+        sh.poweroff_vms(sh.config.server_vms)
+        assert sh.vmmc.get_inventory.call_count == 1
+        assert not any(sh.vmmc.is_running(vm) for vm in sh.config.server_vms)
+
     def test_retry_poweroff(self, sh: SessionHandler):
         vm, *_ = sh.vmmc.get_vms()
         sh.vmmc.poweroff = CallableExceptionRaiser(VMMControllerException, counter=1)
@@ -160,6 +235,46 @@ class TestSessionHandler:
         sh.vmmc.delete = CallableExceptionRaiser(VMMControllerException, counter=1)
         sh.delete_vms([vm])
 
+    def test_retry_is_per_vm(self, sh: SessionHandler):
+        vms = sh.vmmc.get_vms()
+        sh.teardown_backoff = 0
+        sh.config.max_parallel_teardown = 2
+        delete = sh.vmmc.delete
+        fails = {vms[0]: 3}
+
+        def flaky_delete(vm):
+            if fails.get(vm, 0) > 0:
+                fails[vm] -= 1
+                raise VMMControllerException()
+            delete(vm)
+
+        sh.vmmc.delete = flaky_delete
+        report = TeardownReport()
+        sh.delete_vms(vms, report=report)
+        assert report.retried("delete") == [vms[0]]
+        assert set(report.succeeded("delete")) == set(vms[1:])
+        assert not report.failed("delete")
+
+    def test_teardown_gives_up_per_vm(self, sh: SessionHandler):
+        vm, *_ = sh.vmmc.get_vms()
+        sh.teardown_retries = 2
+        sh.teardown_backoff = 0
+        sh.vmmc.delete = CallableExceptionRaiser(VMMControllerException, counter=10)
+        report = TeardownReport()
+        with pytest.raises(SessionHandlerException):
+            sh.delete_vms([vm], report=report)
+        assert report.failed("delete") == [vm]
+        assert report._asdict()["delete"][vm]["attempts"] == 3
+
+    def test_verify_clones(self, sh: SessionHandler):
+        sh.start_session()
+        assert sh.verify_clones() == []
+        sh.vmmc.set_mac(sh.clones[0].vm, 0x0800278144CB, if_id=2)
+        problems = sh.verify_clones()
+        assert len(problems) == 1
+        assert sh.clones[0].vm in problems[0]
+        assert "0800278144cb" in problems[0]
+
     def test_server_and_client_vms(self, sh: SessionHandler):
         vms = sh.server_and_client_vms()
         compare = sh.config.server_vms + [sh.config.client_vm]
@@ -182,6 +297,29 @@ class TestSessionHandler:
         for vm in vms:
             assert first_backups[vm] != second_backups[vm]
 
+    def test_create_backup_snapshots_uses_batch_api(self, sh: SessionHandler):
+        vms = sh.vmmc.get_vms()
+        sh.vmmc.get_snapshots = Mock()
+        sh.vmmc.create_snapshots = Mock()
+        sh.vmmc.get_snapshots_many = Mock(return_value={vm: ["Backup"] for vm in vms})
+        sh.create_backup_snapshots(vms)
+        sh.vmmc.create_snapshots.assert_called_once_with({vm: "Backup0" for vm in vms})
+        assert not sh.vmmc.get_snapshots.called
+
+    def test_create_backup_snapshots_records_partial_success(self, sh: SessionHandler):
+        vms = sh.vmmc.get_vms()
+        create_snapshot = sh.vmmc.create_snapshot
+
+        def fail_for_first_vm(vm, snapshot):
+            if vm == vms[0]:
+                raise VMMControllerException()
+            create_snapshot(vm, snapshot)
+
+        sh.vmmc.create_snapshot = fail_for_first_vm
+        with pytest.raises(SessionHandlerException):
+            sh.create_backup_snapshots(vms)
+        assert set(sh.backup_snapshots) == set(vms[1:])
+
     def test_restore_and_delete_backup_snapshots(self, sh: SessionHandler):
         vms = sh.vmmc.get_vms()
         sh.create_backup_snapshots(vms)
@@ -215,6 +353,17 @@ class TestSessionHandler:
         for clone in sh.clones:
             sh.vmmc.set_credentials.assert_any_call(clone.vm, clone.user, clone.password, clone.domain)
 
+    def test_login_clones_with_timeout(self, sh: SessionHandler):
+        sh.vmmc.set_credentials_many = Mock(side_effect=VMMControllerException("timeout"))
+        sh.config.login_timeout = 42
+        sh.create_backup_snapshots([sh.config.client_vm])
+        sh.create_clones()
+        with pytest.raises(SessionHandlerException):
+            sh.login_clones()
+        credentials, = sh.vmmc.set_credentials_many.call_args[0]
+        assert set(credentials) == set(sh.clone_vms)
+        assert sh.vmmc.set_credentials_many.call_args[1] == {"timeout": 42}
+
     def test_start_session(self, sh: SessionHandler):
         server_vms = sh.config.server_vms
         client_vm = sh.config.client_vm
@@ -242,6 +391,19 @@ class TestSessionHandler:
             assert snapshot not in sh.vmmc.get_snapshots(vm)
         assert not sh.session_running
 
+    def test_close_session_in_parallel(self, sh: SessionHandler):
+        sh.config.number_of_clones = 8
+        sh.config.max_parallel_teardown = 4
+        sh.start_session()
+        clones = sh.clone_vms.copy()
+        report = sh.close_session()
+        for clone in clones:
+            assert clone not in sh.vmmc.get_vms()
+        assert set(report.succeeded("delete")) == set(clones)
+        assert set(report.succeeded("poweroff")) == set(sh.config.server_vms + clones)
+        assert set(report.succeeded("restore")) == set(sh.server_and_client_vms())
+        assert "failed" not in str(report).replace("0 failed", "")
+
     def test_get_set_state(self, sh: SessionHandler):
         sh.start_session()
         state = sh.get_state()
@@ -252,6 +414,52 @@ class TestSessionHandler:
         sh_new.set_state(state)
         sh_new.close_session()
 
+    def test_start_failure_keeps_session_closable(self, sh_with_state_file: SessionHandler):
+        sh = sh_with_state_file
+        fail_start(sh.vmmc, sh.config.server_vms[0])
+        with pytest.raises(SessionHandlerException):
+            sh.start_session()
+        assert sh.session_running
+        assert os.path.isfile(sh.session_state_file)
+        for clone in sh.clones:
+            assert sh.vmmc.is_running(clone.vm)
+        sh.close_session()
+
+    def test_readiness_probes(self, sh: SessionHandler):
+        sh.start_session()
+        probes = sh.readiness_probes()
+        assert {probe.vm for probe in probes} == set(sh.config.server_vms + sh.clone_vms)
+        assert {probe.port for probe in probes if probe.vm == "Log Server"} == {22, 9200}
+
+    def test_start_session_wait_ready(self, sh: SessionHandler):
+        checker_class = Mock()
+        sh.readiness_checker_class = checker_class
+        sh.start_session(wait_ready=True)
+        assert checker_class.return_value.wait.called
+        assert checker_class.call_args.kwargs["timeout"] == sh.config.ready_timeout
+
+    def test_wait_until_ready_failure(self, sh: SessionHandler):
+        sh.readiness_checker_class = Mock()
+        sh.readiness_checker_class.return_value.wait.side_effect = ReadinessException("Log Server not ready")
+        sh.start_session()
+        with pytest.raises(SessionHandlerException) as ei:
+            sh.wait_until_ready()
+        assert "Log Server" in str(ei.value)
+
+    def test_wait_until_ready_after_scaling_with_polling_watcher(self, sh: SessionHandler):
+        sh.readiness_checker_class = Mock()
+        sh.state_watcher = PollingStateWatcher(sh.vmmc, interval=60)
+        sh.start_session()
+        sh.state_watcher.start()
+        try:
+            sh.scale_clones(5)
+            sh.wait_until_ready()
+            is_running = sh.readiness_checker_class.call_args.kwargs["is_running"]
+            assert not sh.state_watcher.is_running(sh.clone_vms[-1])
+            assert all(is_running(vm) for vm in sh.config.server_vms + sh.clone_vms)
+        finally:
+            sh.state_watcher.stop()
+
     def test_cannot_start_more_than_one_session(self, sh: SessionHandler):
         sh.start_session()
         with pytest.raises(SessionHandlerException):
@@ -285,6 +493,377 @@ class TestSessionHandler:
         assert sh_2.session_running
 
 
+class TestScaleClones:
+    def assert_clones_distinct(self, sh: SessionHandler):
+        for field in ("id", "vm", "management_mac", "internal_mac", "vrde_port", "user"):
+            values = [getattr(clone, field) for clone in sh.clones]
+            assert len(set(values)) == len(values)
+        macs = [clone.management_mac for clone in sh.clones] + [clone.internal_mac for clone in sh.clones]
+        assert len(set(macs)) == len(macs)
+
+    def test_needs_running_session(self, sh: SessionHandler):
+        with pytest.raises(SessionHandlerException):
+            sh.scale_clones(5)
+
+    def test_scale_up(self, sh: SessionHandler):
+        sh.start_session()
+        sh.scale_clones(6)
+        assert [clone.id for clone in sh.clones] == [1, 2, 3, 4, 5, 6]
+        assert sh.config.number_of_clones == 6
+        for clone in sh.clones:
+            assert sh.vmmc.is_running(clone.vm)
+            assert sh.vmmc.get_mac(clone.vm, if_id=2) == clone.management_mac
+        self.assert_clones_distinct(sh)
+
+    def test_scale_down(self, sh: SessionHandler):
+        sh.start_session()
+        removed = sh.clone_vms[1:]
+        sh.scale_clones(1)
+        assert [clone.id for clone in sh.clones] == [1]
+        for vm in removed:
+            assert vm not in sh.vmmc.get_vms()
+        sh.close_session()
+
+    def test_failed_warm_snapshots_keep_new_clones_tracked(self, warm_sh: SessionHandler):
+        warm_sh.start_session()
+        warm_sh.vmmc.create_snapshot = Mock(side_effect=VMMControllerException("disk full"))
+        with pytest.raises(SessionHandlerException):
+            warm_sh.scale_clones(5)
+        assert [clone.id for clone in warm_sh.clones] == [1, 2, 3, 4, 5]
+        assert warm_sh.config.number_of_clones == 5
+        sh_2 = SessionHandler(warm_sh.vmmc, warm_sh.config, warm_sh.session_state_file)
+        assert sh_2.clone_vms == warm_sh.clone_vms
+
+    def test_scale_down_and_up_again(self, sh: SessionHandler):
+        sh.start_session()
+        sh.scale_clones(0)
+        assert not sh.clones
+        sh.scale_clones(4)
+        assert [clone.id for clone in sh.clones] == [1, 2, 3, 4]
+        self.assert_clones_distinct(sh)
+        sh.close_session()
+        assert not [vm for vm in sh.vmmc.get_vms() if "Clone" in vm]
+
+    def test_state_file_is_updated(self, sh_with_state_file: SessionHandler):
+        sh_with_state_file.start_session()
+        sh_with_state_file.scale_clones(5)
+        sh_2 = build_session_handler_with_state_file(sh_with_state_file.session_state_file)
+        assert sh_2.clone_vms == sh_with_state_file.clone_vms
+        assert sh_2.config.number_of_clones == 5
+        assert not os.path.isfile(sh_with_state_file.session_state_file + ".tmp")
+
+
+@pytest.fixture()
+def warm_sh(tmpdir):
+    session_state_file = os.path.join(str(tmpdir), "tbfvmsessionstate")
+    sh = build_session_handler_with_state_file(session_state_file)
+    sh.config.warm_pool = True
+    return sh
+
+
+class TestWarmPool:
+    def test_close_keeps_clones(self, warm_sh: SessionHandler):
+        warm_sh.start_session()
+        clones = warm_sh.clone_vms.copy()
+        warm_sh.close_session()
+        assert not warm_sh.session_running
+        assert warm_sh.warm_pool_available
+        for clone in warm_sh.clones:
+            assert clone.vm in warm_sh.vmmc.get_vms()
+            assert clone.snapshot in warm_sh.vmmc.get_snapshots(clone.vm)
+            assert not warm_sh.vmmc.is_running(clone.vm)
+        assert warm_sh.clone_vms == clones
+        assert list(warm_sh.backup_snapshots) == [warm_sh.config.client_vm]
+        for vm in warm_sh.config.server_vms:
+            assert warm_sh.vmmc.get_snapshots(vm) == []
+        assert os.path.isfile(warm_sh.session_state_file)
+
+    def test_restart_reuses_clones(self, warm_sh: SessionHandler):
+        warm_sh.start_session()
+        clones = warm_sh.clone_vms.copy()
+        warm_sh.close_session()
+        warm_sh.vmmc.clone = Mock()
+        warm_sh.start_session()
+        assert not warm_sh.vmmc.clone.called
+        assert warm_sh.clone_vms == clones
+        for clone in clones:
+            assert warm_sh.vmmc.is_running(clone)
+
+    def test_pool_is_loaded_from_state_file(self, warm_sh: SessionHandler):
+        warm_sh.start_session()
+        clones = warm_sh.clone_vms.copy()
+        warm_sh.close_session()
+        config = SessionHandler.default_config()
+        config.warm_pool = True
+        config.number_of_clones = 5
+        sh_2 = SessionHandler(warm_sh.vmmc, config, warm_sh.session_state_file)
+        assert sh_2.warm_pool_available
+        assert sh_2.clone_vms == clones
+        assert sh_2.config.number_of_clones == 5
+
+    @pytest.mark.parametrize("number_of_clones", [1, 3, 5])
+    def test_reconcile_number_of_clones(self, warm_sh: SessionHandler, number_of_clones):
+        warm_sh.start_session()
+        warm_sh.close_session()
+        warm_sh.config.number_of_clones = number_of_clones
+        warm_sh.start_session()
+        assert [clone.id for clone in warm_sh.clones] == list(range(1, number_of_clones + 1))
+        for clone in warm_sh.clones:
+            assert warm_sh.vmmc.is_running(clone.vm)
+            assert warm_sh.vmmc.get_mac(clone.vm, if_id=2) == clone.management_mac
+            assert (clone.management_mac // 0x100) % 0x100 == number_of_clones
+            assert clone.snapshot in warm_sh.vmmc.get_snapshots(clone.vm)
+        clone_vms = [vm for vm in warm_sh.vmmc.get_vms() if "Clone" in vm]
+        assert sorted(clone_vms) == sorted(warm_sh.clone_vms)
+
+    def test_failed_reconcile_keeps_new_clones_tracked(self, warm_sh: SessionHandler):
+        warm_sh.start_session()
+        warm_sh.close_session()
+        warm_sh.config.number_of_clones = 5
+        old_vms = warm_sh.server_and_client_vms() + warm_sh.clone_vms
+        create_snapshot = warm_sh.vmmc.create_snapshot
+
+        def failing_create_snapshot(vm, snapshot):
+            if vm not in old_vms:
+                raise VMMControllerException("disk full")
+            create_snapshot(vm, snapshot)
+
+        warm_sh.vmmc.create_snapshot = failing_create_snapshot
+        with pytest.raises(SessionHandlerException):
+            warm_sh.start_session()
+        assert [clone.id for clone in warm_sh.clones] == [1, 2, 3, 4, 5]
+        warm_sh.discard_warm_pool()
+        assert not [vm for vm in warm_sh.vmmc.get_vms() if "Clone" in vm]
+
+    def test_cold_start_discards_pool(self, warm_sh: SessionHandler):
+        warm_sh.start_session()
+        clones = warm_sh.clone_vms.copy()
+        warm_sh.close_session()
+        warm_sh.config.warm_pool = False
+        warm_sh.start_session()
+        warm_sh.close_session()
+        for clone in clones:
+            assert clone not in warm_sh.vmmc.get_vms()
+        for vm in warm_sh.server_and_client_vms():
+            assert warm_sh.vmmc.get_snapshots(vm) == []
+        assert not os.path.isfile(warm_sh.session_state_file)
+
+    def test_discard_warm_pool(self, warm_sh: SessionHandler):
+        warm_sh.start_session()
+        with pytest.raises(SessionHandlerException):
+            warm_sh.discard_warm_pool()
+        clones = warm_sh.clone_vms.copy()
+        warm_sh.close_session()
+        warm_sh.discard_warm_pool()
+        assert not warm_sh.warm_pool_available
+        for clone in clones:
+            assert clone not in warm_sh.vmmc.get_vms()
+        assert warm_sh.vmmc.get_snapshots(warm_sh.config.client_vm) == []
+        assert not os.path.isfile(warm_sh.session_state_file)
+
+
+class TestCloneStrategies:
+    def clone_calls(self, sh: SessionHandler):
+        sh.vmmc.clone = Mock(wraps=sh.vmmc.clone)
+        sh.start_session()
+        return [(c.args[0], c.args[2], c.kwargs["linked"]) for c in sh.vmmc.clone.call_args_list]
+
+    def test_linked(self, sh: SessionHandler):
+        calls = self.clone_calls(sh)
+        assert calls == [("Client", clone.vm, True) for clone in sh.clones]
+
+    def test_full(self, sh: SessionHandler):
+        sh.config.clone_strategy = "full"
+        calls = self.clone_calls(sh)
+        assert calls == [("Client", clone.vm, False) for clone in sh.clones]
+
+    def test_hybrid(self, sh: SessionHandler):
+        sh.config.clone_strategy = "hybrid"
+        calls = self.clone_calls(sh)
+        assert sh.clone_bases == ["ClientBase1", "ClientBase2"]
+        assert calls[:2] == [("Client", "ClientBase1", False), ("Client", "ClientBase2", False)]
+        assert calls[2:] == [
+            ("ClientBase1", "ClientClone1", True), ("ClientBase2", "ClientClone2", True),
+            ("ClientBase1", "ClientClone3", True)]
+        for vm in sh.clone_bases:
+            assert sh.vmmc.get_snapshots(vm) == [sh.clone_base_snapshot]
+            assert not sh.vmmc.is_running(vm)
+        sh.close_session()
+        assert not sh.clone_bases
+        assert "ClientBase1" not in sh.vmmc.get_vms()
+
+    def test_unknown_strategy(self, sh: SessionHandler):
+        sh.config.clone_strategy = "magic"
+        with pytest.raises(SessionHandlerException):
+            sh.start_session()
+        assert not sh.backup_snapshots
+
+    def test_warm_pool_keeps_clone_bases(self, warm_sh: SessionHandler):
+        warm_sh.config.clone_strategy = "hybrid"
+        warm_sh.start_session()
+        warm_sh.close_session()
+        clone_bases = warm_sh.clone_bases.copy()
+        sh_2 = SessionHandler(warm_sh.vmmc, warm_sh.config, warm_sh.session_state_file)
+        assert sh_2.clone_bases == clone_bases
+        sh_2.config.number_of_clones = 5
+        sh_2.start_session()
+        assert sh_2.clone_bases == clone_bases
+        sh_2.close_session()
+        sh_2.discard_warm_pool()
+        for vm in clone_bases:
+            assert vm not in sh_2.vmmc.get_vms()
+
+
+class TestCapacity:
+    # Mock VMs have 1024 MB and 1 CPU each, the host 16384 MB and 8 CPUs
+    def test_estimate(self, sh: SessionHandler):
+        estimate = sh.estimate_capacity(number_of_clones=10)
+        assert (estimate.memory, estimate.cpus) == (16 * 1024, 16)
+        assert estimate.memory_headroom == 16384 - 2048 - 16 * 1024
+
+    def test_ignore(self, sh: SessionHandler):
+        sh.config.number_of_clones = 20
+        sh.start_session()
+        assert not sh.staggered_start
+
+    def test_refuse(self, sh: SessionHandler):
+        sh.config.capacity_policy = "refuse"
+        sh.config.number_of_clones = 9
+        with pytest.raises(SessionHandlerException) as ei:
+            sh.start_session()
+        assert "exceed the host capacity" in str(ei.value)
+        assert not sh.backup_snapshots
+        sh.config.number_of_clones = 8
+        sh.start_session()
+
+    def test_refuse_overcommitted_cpus(self, sh: SessionHandler):
+        sh.config.capacity_policy = "refuse"
+        sh.config.max_cpu_overcommit = 1.0
+        with pytest.raises(SessionHandlerException):
+            sh.start_session()
+
+    def test_stagger(self, sh: SessionHandler):
+        sh.config.capacity_policy = "stagger"
+        sh.config.max_cpu_overcommit = 1.0
+        sh.vmmc.host_info.cpus = 4
+        sleep_mock = Mock()
+        with patch("time.sleep", sleep_mock):
+            sh.start_session()
+        assert sh.staggered_start
+        # 9 VMs with 1 CPU each in batches of 4
+        assert sleep_mock.call_args_list.count(call(sh.config.stagger_interval)) == 2
+        for vm in sh.config.server_vms + sh.clone_vms:
+            assert sh.vmmc.is_running(vm)
+
+    def test_stagger_does_not_help_memory(self, sh: SessionHandler):
+        sh.config.capacity_policy = "stagger"
+        sh.vmmc.host_info.memory = 4096
+        with pytest.raises(SessionHandlerException):
+            sh.start_session()
+
+    def test_scale_up_is_admitted(self, sh: SessionHandler):
+        sh.config.capacity_policy = "refuse"
+        sh.start_session()
+        with pytest.raises(SessionHandlerException):
+            sh.scale_clones(10)
+        assert len(sh.clones) == 3
+        sh.scale_clones(5)
+        assert len(sh.clones) == 5
+
+
+@pytest.fixture()
+def golden_sh(warm_sh: SessionHandler):
+    warm_sh.readiness_checker_class = Mock()
+    warm_sh.config.golden_stable_time = 0
+    return warm_sh
+
+
+class TestGoldenImages:
+    def test_needs_warm_pool(self, golden_sh: SessionHandler):
+        golden_sh.config.warm_pool = False
+        golden_sh.start_session()
+        with pytest.raises(SessionHandlerException):
+            golden_sh.build_golden_images()
+
+    def test_build(self, golden_sh: SessionHandler):
+        golden_sh.start_session()
+        golden_sh.build_golden_images()
+        assert golden_sh.readiness_checker_class.return_value.wait.call_count == 1
+        assert golden_sh.readiness_checker_class.call_args[1]["stable_time"] == golden_sh.config.golden_stable_time
+        for clone in golden_sh.clones:
+            assert clone.snapshot == "Golden"
+            assert golden_sh.vmmc.get_snapshots(clone.vm) == ["Golden"]
+            assert golden_sh.vmmc.is_running(clone.vm)
+        assert golden_sh.golden_snapshots == {"Internal Server": "Golden"}
+        assert "Golden" in golden_sh.vmmc.get_snapshots("Internal Server")
+        golden_sh.close_session()
+        assert golden_sh.vmmc.get_snapshots("Internal Server") == ["Golden"]
+        assert golden_sh.vmmc.get_snapshots("Log Server") == []
+
+    def test_restart_restores_golden_snapshots(self, golden_sh: SessionHandler):
+        golden_sh.start_session()
+        golden_sh.build_golden_images()
+        golden_sh.close_session()
+        sh_2 = SessionHandler(golden_sh.vmmc, golden_sh.config, golden_sh.session_state_file)
+        assert sh_2.golden_snapshots == {"Internal Server": "Golden"}
+        sh_2.vmmc.restore_snapshot = Mock(wraps=sh_2.vmmc.restore_snapshot)
+        sh_2.start_session()
+        sh_2.vmmc.restore_snapshot.assert_called_once_with("Internal Server", "Golden")
+        assert sh_2.vmmc.get_snapshots("Internal Server") == ["Golden", sh_2.backup_snapshots["Internal Server"]]
+        sh_2.close_session()
+        sh_2.discard_warm_pool()
+        assert not sh_2.golden_snapshots
+        assert sh_2.vmmc.get_snapshots("Internal Server") == []
+
+    def test_rebuild_replaces_snapshots(self, golden_sh: SessionHandler):
+        golden_sh.start_session()
+        golden_sh.build_golden_images()
+        golden_sh.build_golden_images()
+        assert golden_sh.vmmc.get_snapshots("Internal Server").count("Golden") == 1
+        for clone in golden_sh.clones:
+            assert golden_sh.vmmc.get_snapshots(clone.vm) == ["Golden"]
+
+    def test_reconcile_after_failed_build(self, golden_sh: SessionHandler):
+        golden_sh.start_session()
+        failing_vm = golden_sh.clone_vms[0]
+        create_snapshot = golden_sh.vmmc.create_snapshot
+
+        def failing_create_snapshot(vm, snapshot):
+            if vm == failing_vm:
+                raise VMMControllerException("disk full")
+            create_snapshot(vm, snapshot)
+
+        golden_sh.vmmc.create_snapshot = failing_create_snapshot
+        with pytest.raises(SessionHandlerException):
+            golden_sh.build_golden_images()
+        assert golden_sh.clones[0].snapshot is None
+        golden_sh.vmmc.create_snapshot = create_snapshot
+        golden_sh.close_session()
+        golden_sh.config.number_of_clones = 4
+        golden_sh.start_session()
+        assert golden_sh.vmmc.get_snapshots(failing_vm) == [golden_sh.clones[0].snapshot]
+
+    def test_recovery_keeps_golden_images(self, golden_sh: SessionHandler):
+        golden_sh.start_session()
+        golden_sh.build_golden_images()
+        sh_2 = SessionHandler(golden_sh.vmmc.vmmc, golden_sh.config, golden_sh.session_state_file)
+        sh_2.recover_session()
+        assert sh_2.vmmc.get_snapshots("Internal Server") == ["Golden"]
+        assert sh_2.golden_snapshots == {"Internal Server": "Golden"}
+        assert sh_2.vmmc.get_snapshots("Log Server") == []
+
+    def test_reconfigured_golden_clones_are_reported(self, golden_sh: SessionHandler, caplog):
+        golden_sh.start_session()
+        golden_sh.build_golden_images()
+        golden_sh.close_session()
+        golden_sh.config.number_of_clones = 4
+        with caplog.at_level(logging.WARNING):
+            golden_sh.start_session()
+        assert "golden snapshot is replaced" in caplog.text
+        for clone in golden_sh.clones:
+            assert clone.snapshot == "WarmBase"
+
+
 class CallableExceptionRaiser:
     def __init__(self, exception_class, counter=1):
         self.exception_class = exception_class
@@ -373,6 +952,50 @@ class TestCloneCreator:
             assert cc.vmmc.get_mac(clone.vm, if_id=2) == clone.management_mac
             assert cc.vmmc.get_mac(clone.vm, if_id=1) == clone.internal_mac
 
+    def test_create_in_parallel(self, cc: CloneCreator):
+        cc.max_parallel = 4
+        clones = cc.create()
+        assert [clone.id for clone in clones] == [i + 1 for i in range(cc.number_of_clones)]
+        for clone in clones:
+            assert clone.vm == cc.parent_vm + "Clone" + str(clone.id)
+            assert clone.vrde_port == cc.vrde_port_start + clone.id - 1
+            assert cc.vmmc.get_mac(clone.vm, if_id=2) == clone.management_mac
+            assert cc.vmmc.get_mac(clone.vm, if_id=1) == clone.internal_mac
+
+    def test_configure_clone_is_called_once_per_clone(self, cc: CloneCreator):
+        cc.vmmc.configure_clone = Mock()
+        clones = cc.create()
+        assert cc.vmmc.configure_clone.call_count == len(clones)
+        for clone in clones:
+            cc.vmmc.configure_clone.assert_any_call(
+                clone.vm, macs={1: clone.internal_mac, 2: clone.management_mac}, vrde_port=clone.vrde_port
+            )
+
+    def test_rollback_on_failure(self, cc: CloneCreator):
+        cc.max_parallel = 2
+        vms_before = cc.vmmc.get_vms()
+        configure_clone = cc.vmmc.configure_clone
+
+        def fail_for_third_clone(vm, **kwargs):
+            if vm.endswith("Clone3"):
+                raise VMMControllerException()
+            configure_clone(vm, **kwargs)
+
+        cc.vmmc.configure_clone = fail_for_third_clone
+        with pytest.raises(SessionHandlerException) as ei:
+            cc.create()
+        assert "Clone3" in str(ei.value)
+        assert cc.vmmc.get_vms() == vms_before
+
+    def test_create_from_sources(self, cc: CloneCreator):
+        cc.vmmc.create_snapshot("VM_One", "Base")
+        cc.sources = [("Client", "CloneShot"), ("VM_One", "Base")]
+        cc.vmmc.clone = Mock(wraps=cc.vmmc.clone)
+        clones = cc.create(ids=[1, 2, 3])
+        cc.vmmc.clone.assert_any_call("Client", "CloneShot", clones[0].vm, linked=True)
+        cc.vmmc.clone.assert_any_call("VM_One", "Base", clones[1].vm, linked=True)
+        cc.vmmc.clone.assert_any_call("Client", "CloneShot", clones[2].vm, linked=True)
+
     def test_create(self, cc: CloneCreator):
         clones = cc.create()
         for clone in clones:
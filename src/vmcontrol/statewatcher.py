@@ -0,0 +1,170 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StateWatcher:
+    # Keeps the power state of every VM ("running", "poweroff", ... or None once a VM is gone) in one place.
+    # Subclasses feed it from a single background thread, everybody else reads or waits.
+    startup_timeout = 60
+
+    def __init__(self):
+        self.states = dict()
+        self.error = None
+        self._condition = threading.Condition()
+        self._subscribers = list()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._ready = threading.Event()
+
+    def watch(self):
+        raise NotImplementedError()
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._stopping.clear()
+                self._ready.clear()
+                self.error = None
+                self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+                self._thread.start()
+        if not self._ready.wait(self.startup_timeout):
+            raise StateWatcherException("No VM states received within {}s".format(self.startup_timeout))
+        self._raise_on_error()
+
+    def stop(self):
+        with self._condition:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def subscribe(self, callback):
+        # callback(vm, state, old_state) is called from the watcher thread for every change
+        with self._condition:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._condition:
+            self._subscribers.remove(callback)
+
+    def get_state(self, vm):
+        self.start()
+        with self._condition:
+            return self.states.get(vm)
+
+    def is_running(self, vm):
+        return self.get_state(vm) == "running"
+
+    def wait_for_state(self, vm, state, timeout=None):
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.states.get(vm) != state:
+                self._raise_on_error()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise StateWatcherException('Timeout waiting for "{vm}" to be {state}, it is {current}'.format(
+                        vm=vm, state=state, current=self.states.get(vm)))
+                self._condition.wait(remaining)
+
+    def update(self, vm, state):
+        with self._condition:
+            old_state = self.states.get(vm)
+            if old_state == state:
+                return
+            if state is None:
+                self.states.pop(vm, None)
+            else:
+                self.states[vm] = state
+            subscribers = list(self._subscribers)
+            self._condition.notify_all()
+        logger.debug('"{vm}" changed from {old} to {new}'.format(vm=vm, old=old_state, new=state))
+        for callback in subscribers:
+            callback(vm, state, old_state)
+
+    def update_all(self, states):
+        # Full picture of all VMs, VMs that are not part of it anymore are gone
+        with self._condition:
+            gone_vms = [vm for vm in self.states if vm not in states]
+        for vm in gone_vms:
+            self.update(vm, None)
+        for vm, state in states.items():
+            self.update(vm, state)
+        self._ready.set()
+
+    def _run(self):
+        try:
+            self.watch()
+        except Exception as e:
+            logger.warning("{cls} stopped: {e}".format(cls=type(self).__name__, e=e))
+            with self._condition:
+                self.error = e
+                self._thread = None
+                self._condition.notify_all()
+        finally:
+            self._ready.set()
+
+    def _raise_on_error(self):
+        if self.error is not None:
+            raise StateWatcherException("State watcher failed: {e}".format(e=self.error))
+
+
+class PollingStateWatcher(StateWatcher):
+    # Fallback for backends without change notifications: one inventory query per interval for all VMs
+    def __init__(self, vmm_controller, interval=2):
+        super().__init__()
+        self.vmmc = vmm_controller
+        self.interval = interval
+
+    def watch(self):
+        while not self.stopping:
+            try:
+                inventory = self.vmmc.get_inventory()
+            except Exception as e:
+                # A failing poll must not end the watcher, the next one may succeed
+                logger.warning("Cannot poll VM states, retrying in {interval}s: {e}".format(
+                    interval=self.interval, e=e))
+            else:
+                self.update_all({vm: "running" if running else "poweroff" for vm, running in inventory.items()})
+            self._stopping.wait(self.interval)
+
+
+def create_state_watcher(vmm_controller):
+    # Imported here as the backends themselves import this module
+    from vmcontrol.vmmcontroller import VBoxAPIController, VMWareController
+    from vmcontrol.vmmcontroller.vboxapicontroller import VBoxEventStateWatcher
+    from vmcontrol.vmmcontroller.vmwarecontroller import VSphereStateWatcher
+    if isinstance(vmm_controller, VBoxAPIController):
+        return VBoxEventStateWatcher(vmm_controller)
+    if isinstance(vmm_controller, VMWareController):
+        return VSphereStateWatcher(vmm_controller)
+    return PollingStateWatcher(vmm_controller)
+
+
+class StateWatcherException(Exception):
+    pass
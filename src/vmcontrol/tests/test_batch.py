@@ -0,0 +1,133 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import threading
+import time
+
+import pytest
+
+from vmcontrol.batch import BatchRunner, parse_batch
+from vmcontrol.sessionhandler import SessionConsole
+from vmcontrol.vmmcontroller import VMMConsole
+from vmcontrol.vmmcontroller.tests.mocks import MockVMMController
+
+
+class BarrierConsole(VMMConsole):
+    # "meet" only returns once two commands wait in it at the same time
+    def __init__(self):
+        super().__init__(MockVMMController())
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def do_meet(self, arg):
+        self.barrier.wait()
+        print("met " + arg)
+
+
+class OverlapSessionHandler:
+    # Records how many handler calls run at the same time
+    def __init__(self):
+        self.vmmc = MockVMMController()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.started = threading.Event()
+
+    def _call(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+
+    def start_session(self, wait_ready=False):
+        self._call()
+        self.started.set()
+
+    def scale_clones(self, number):
+        self._call()
+
+    def wait_for_state(self, vm, state, timeout=None):
+        assert self.started.wait(5)
+
+
+@pytest.fixture()
+def runner():
+    return BatchRunner(BarrierConsole(), out=io.StringIO())
+
+
+def test_parse_batch():
+    commands = parse_batch(["# comment", "", "start VM &", "  wait", "get_vms"])
+    assert [(c.line_number, c.command, c.background) for c in commands] == [
+        (3, "start VM", True), (4, "wait", False), (5, "get_vms", False)]
+
+
+class TestBatchRunner:
+    def test_run(self, runner: BatchRunner):
+        commands = runner.run(["start VM", "is_running VM"])
+        assert [command.succeeded for command in commands] == [True, True]
+        assert commands[1].output == "True\n"
+        assert commands[0].duration >= 0
+        assert "2 of 2 commands run, 0 failed" in runner.out.getvalue()
+
+    def test_background_commands_run_concurrently(self, runner: BatchRunner):
+        commands = runner.run(["meet A &", "meet B &", "wait", "get_vms"])
+        assert all(command.succeeded for command in commands)
+        assert sorted(command.output for command in commands[:2]) == ["met A\n", "met B\n"]
+
+    def test_stop_at_first_failure(self, runner: BatchRunner):
+        commands = runner.run(["start VM", "start VM", "poweroff VM"])
+        assert [command.succeeded for command in commands] == [True, False]
+        assert "VMMControllerException" in commands[1].output
+        assert runner.console.vmmc.is_running("VM")
+        assert "2 of 3 commands run, 1 failed" in runner.out.getvalue()
+
+    def test_keep_going(self, runner: BatchRunner):
+        runner.keep_going = True
+        commands = runner.run(["start VM", "start VM", "poweroff VM"])
+        assert [command.succeeded for command in commands] == [True, False, True]
+        assert not runner.console.vmmc.is_running("VM")
+
+    def test_failing_background_command_stops_batch(self, runner: BatchRunner):
+        commands = runner.run(["start VM", "start VM &", "get_vms"])
+        assert [command.succeeded for command in commands] == [True, False]
+
+    @pytest.mark.parametrize("line", ["unknown_command", "start"])
+    def test_invalid_commands_fail(self, runner: BatchRunner, line):
+        [command] = runner.run([line])
+        assert not command.succeeded
+        assert command.output
+
+    def test_exit(self, runner: BatchRunner):
+        commands = runner.run(["get_vms", "exit", "start VM"])
+        assert len(commands) == 1
+        assert not runner.console.vmmc.is_running("VM")
+
+    def test_session_changing_commands_are_serialized(self):
+        handler = OverlapSessionHandler()
+        runner = BatchRunner(SessionConsole(handler), out=io.StringIO())
+        commands = runner.run(["start_session &", "scale_clones 2 &", "scale_clones 3 &"])
+        assert all(command.succeeded for command in commands)
+        assert handler.max_active == 1
+
+    def test_read_only_commands_run_next_to_session_changes(self):
+        handler = OverlapSessionHandler()
+        runner = BatchRunner(SessionConsole(handler), out=io.StringIO())
+        commands = runner.run(["wait_for_state Client running &", "start_session &"])
+        assert all(command.succeeded for command in commands)
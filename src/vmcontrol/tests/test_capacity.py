@@ -0,0 +1,47 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+from vmcontrol.capacity import CapacityModel, start_batches
+from vmcontrol.vmmcontroller import VMInfo, HostInfo
+
+
+class TestCapacityModel:
+    def test_estimate(self):
+        model = CapacityModel(memory_reserve=1000, max_cpu_overcommit=2.0)
+        vm_infos = [VMInfo(name="A", memory=4000, cpus=2), VMInfo(name="B", memory=2000, cpus=4),
+                    VMInfo(name="C")]
+        estimate = model.estimate(HostInfo(memory=8000, cpus=2), vm_infos)
+        assert (estimate.memory, estimate.cpus) == (6000, 6)
+        assert estimate.memory_headroom == 1000
+        assert estimate.cpu_headroom == -2
+        assert estimate.memory_fits and not estimate.cpus_fit
+        assert estimate.unknown_vms == ["C"]
+        assert "Unknown size: ['C']" in str(estimate)
+
+    def test_unknown_host_always_fits(self):
+        estimate = CapacityModel().estimate(HostInfo(), [VMInfo(name="A", memory=4000, cpus=2)])
+        assert estimate.memory_headroom is None and estimate.cpu_headroom is None
+        assert estimate.memory_fits and estimate.cpus_fit
+
+
+def test_start_batches():
+    cpus = {"A": 2, "B": 2, "C": 4, "D": 1}
+    assert start_batches(["A", "B", "C", "D"], cpus, 4) == [["A", "B"], ["C"], ["D"]]
+    assert start_batches(["C", "A"], cpus, 2) == [["C"], ["A"]]
+    assert start_batches(["X", "Y", "Z"], cpus, 2) == [["X", "Y"], ["Z"]]
+    assert start_batches([], cpus, 2) == []
@@ -0,0 +1,92 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from vmcontrol.parallel import run_parallel, failed_keys
+
+
+class Flaky:
+    def __init__(self, fails):
+        self.fails = dict(fails)
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        with self.lock:
+            if self.fails.get(key, 0) > 0:
+                self.fails[key] -= 1
+                raise ValueError(key)
+        return key * 2
+
+
+class TestRunParallel:
+    def test_results_keep_order(self):
+        results = run_parallel(lambda key: key * 2, [3, 1, 2], max_workers=3)
+        assert [result.key for result in results] == [3, 1, 2]
+        assert [result.value for result in results] == [6, 2, 4]
+        assert all(result.succeeded for result in results)
+
+    def test_empty(self):
+        assert run_parallel(Mock(), [], max_workers=4) == []
+
+    def test_failures_are_collected(self):
+        results = run_parallel(Flaky({2: 1}), [1, 2, 3], max_workers=2)
+        assert failed_keys(results) == [2]
+        assert isinstance(results[1].error, ValueError)
+        assert results[0].value == 2 and results[2].value == 6
+
+    def test_unexpected_exceptions_are_raised(self):
+        with pytest.raises(ValueError):
+            run_parallel(Flaky({1: 1}), [1], exceptions=(KeyError,))
+
+    def test_retries(self):
+        results = run_parallel(Flaky({1: 2, 2: 5}), [1, 2], retries=2, backoff=0)
+        assert results[0].succeeded and results[0].retried
+        assert results[0].attempts == 3
+        assert not results[1].succeeded
+        assert results[1].attempts == 3
+
+    def test_runs_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+        results = run_parallel(lambda key: barrier.wait(), [1, 2, 3], max_workers=3)
+        assert all(result.succeeded for result in results)
+
+    def test_bounded_worker_count(self):
+        lock = threading.Lock()
+        active, peak = [0], [0]
+
+        def func(key):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+
+        run_parallel(func, range(10), max_workers=2)
+        assert peak[0] <= 2
+
+    def test_progress(self):
+        progress = Mock()
+        run_parallel(lambda key: key, [1, 2, 3], max_workers=2, progress=progress)
+        assert sorted(call.args[0] for call in progress.call_args_list) == [1, 2, 3]
+        assert all(call.args[1] == 3 for call in progress.call_args_list)
@@ -0,0 +1,109 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import socket
+import threading
+
+import pytest
+
+from vmcontrol.readiness import Probe, ReadinessChecker, ReadinessException, client_probe
+
+
+@pytest.fixture()
+def server():
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.bind(("127.0.0.1", 0))
+    listening_socket.listen(5)
+
+    def serve():
+        while True:
+            try:
+                connection, _ = listening_socket.accept()
+            except OSError:
+                break
+            connection.sendall(b"SSH-2.0-OpenSSH_8.2\r\n")
+            connection.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield listening_socket.getsockname()
+    listening_socket.close()
+
+
+def closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class FastReadinessChecker(ReadinessChecker):
+    connect_timeout = 0.5
+    interval = 0.01
+
+
+class TestReadinessChecker:
+    def test_client_probe(self):
+        probe = client_probe("ClientClone2", 2)
+        assert probe.host == "192.168.56.102"
+        assert probe.port == 22
+
+    def test_ready(self, server):
+        host, port = server
+        probes = [Probe(vm="A", host=host, port=port, banner=b"SSH-"), Probe(vm="B", host=host, port=port)]
+        results = FastReadinessChecker(probes, timeout=5).wait()
+        assert all(result.succeeded for result in results)
+
+    def test_wrong_banner(self, server):
+        host, port = server
+        probes = [Probe(vm="A", host=host, port=port, banner=b"HTTP")]
+        with pytest.raises(ReadinessException) as ei:
+            FastReadinessChecker(probes, timeout=0.1).wait()
+        assert "A (" in str(ei.value)
+        assert "banner" in str(ei.value)
+
+    def test_timeout_names_failing_vms(self, server):
+        host, port = server
+        probes = [Probe(vm="Ready", host=host, port=port), Probe(vm="Down", host="127.0.0.1", port=closed_port())]
+        with pytest.raises(ReadinessException) as ei:
+            FastReadinessChecker(probes, timeout=0.1).wait()
+        assert "Down" in str(ei.value)
+        assert "Ready" not in str(ei.value)
+
+    def test_fail_fast_if_vm_not_running(self):
+        probes = [Probe(vm="Off", host="127.0.0.1", port=closed_port())]
+        checker = FastReadinessChecker(probes, timeout=60, is_running=lambda vm: False)
+        with pytest.raises(ReadinessException) as ei:
+            checker.wait()
+        assert "not running" in str(ei.value)
+
+    def test_stable_time_sees_through_reboots(self):
+        results = [None, OSError("rebooting")] + [None] * 1000
+
+        class RebootingChecker(FastReadinessChecker):
+            def check(self, probe):
+                result = results.pop(0)
+                if result is not None:
+                    raise result
+
+        checker = RebootingChecker([Probe(vm="A", host="127.0.0.1")], timeout=5, stable_time=0.05)
+        [result] = checker.wait()
+        # Up, down again and then up for the whole stable time
+        assert len(results) < 1000
+        assert result.value >= 0.05
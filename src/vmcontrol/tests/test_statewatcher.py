@@ -0,0 +1,127 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from vmcontrol.sessionhandler import SessionHandler, SessionHandlerException
+from vmcontrol.sessionhandler.tests.test_sessionhandler import mock_vmm_controller_from_session_handler_config
+from vmcontrol.statewatcher import StateWatcher, PollingStateWatcher, StateWatcherException, create_state_watcher
+from vmcontrol.vmmcontroller import VMMControllerException
+from vmcontrol.vmmcontroller.tests.mocks import MockVMMController
+
+
+class ManualStateWatcher(StateWatcher):
+    def __init__(self, states):
+        super().__init__()
+        self.initial_states = states
+
+    def watch(self):
+        self.update_all(self.initial_states)
+        self._stopping.wait()
+
+
+class FailingStateWatcher(StateWatcher):
+    def watch(self):
+        raise ConnectionError("lost connection")
+
+
+@pytest.fixture()
+def watcher():
+    watcher = ManualStateWatcher({"VM": "poweroff", "VM_One": "running"})
+    yield watcher
+    watcher.stop()
+
+
+class TestStateWatcher:
+    def test_get_state(self, watcher: StateWatcher):
+        assert watcher.get_state("VM") == "poweroff"
+        assert watcher.is_running("VM_One")
+        assert watcher.get_state("Missing") is None
+
+    def test_subscribers(self, watcher: StateWatcher):
+        changes = list()
+        watcher.start()
+        watcher.subscribe(lambda *change: changes.append(change))
+        watcher.update("VM", "running")
+        watcher.update("VM", "running")
+        watcher.update_all({"VM": "poweroff"})
+        assert changes == [("VM", "running", "poweroff"), ("VM_One", None, "running"), ("VM", "poweroff", "running")]
+
+    def test_wait_for_state(self, watcher: StateWatcher):
+        watcher.start()
+        timer = threading.Timer(0.05, watcher.update, ["VM", "running"])
+        timer.start()
+        watcher.wait_for_state("VM", "running", timeout=5)
+        timer.join()
+
+    def test_wait_for_state_timeout(self, watcher: StateWatcher):
+        with pytest.raises(StateWatcherException) as ei:
+            watcher.wait_for_state("VM", "running", timeout=0.01)
+        assert "poweroff" in str(ei.value)
+
+    def test_watcher_failure(self):
+        watcher = FailingStateWatcher()
+        with pytest.raises(StateWatcherException) as ei:
+            watcher.wait_for_state("VM", "running", timeout=1)
+        assert "lost connection" in str(ei.value)
+
+
+class TestPollingStateWatcher:
+    def test_follow_vmm_controller(self):
+        mvmc = MockVMMController()
+        watcher = PollingStateWatcher(mvmc, interval=0.01)
+        assert watcher.get_state("VM") == "poweroff"
+        mvmc.start("VM")
+        watcher.wait_for_state("VM", "running", timeout=5)
+        mvmc.delete("VM_Two")
+        watcher.wait_for_state("VM_Two", None, timeout=5)
+        watcher.stop()
+
+    def test_failing_polls_are_retried(self):
+        mvmc = MockVMMController()
+        inventory = mvmc.get_inventory()
+        mvmc.get_inventory = Mock(side_effect=[VMMControllerException("busy"), VMMControllerException("busy")] +
+                                  [inventory] * 1000)
+        watcher = PollingStateWatcher(mvmc, interval=0.01)
+        assert watcher.get_state("VM") == "poweroff"
+        assert watcher.error is None
+        watcher.stop()
+
+    def test_create_state_watcher(self):
+        assert isinstance(create_state_watcher(MockVMMController()), PollingStateWatcher)
+
+
+class TestSessionHandlerWithStateWatcher:
+    def test_wait_for_state(self):
+        config = SessionHandler.default_config()
+        mvmc = mock_vmm_controller_from_session_handler_config(config)
+        watcher = PollingStateWatcher(mvmc, interval=0.01)
+        sh = SessionHandler(mvmc, config, state_watcher=watcher)
+        sh.start_session()
+        sh.wait_for_state(sh.clone_vms[0], "running", timeout=5)
+        with pytest.raises(SessionHandlerException):
+            sh.wait_for_state(sh.clone_vms[0], "poweroff", timeout=0.01)
+        watcher.stop()
+
+    def test_without_state_watcher(self):
+        sh = SessionHandler(MockVMMController())
+        with pytest.raises(SessionHandlerException):
+            sh.wait_for_state("VM", "running")
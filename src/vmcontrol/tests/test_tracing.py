@@ -0,0 +1,119 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+
+import pytest
+
+from vmcontrol.tracing import Tracer, TracingVMMController
+from vmcontrol.sessionhandler import SessionHandler
+from vmcontrol.sessionhandler.tests.test_sessionhandler import mock_vmm_controller_from_session_handler_config
+from vmcontrol.vmmcontroller import VMMControllerException
+from vmcontrol.vmmcontroller.tests.mocks import MockVMMController
+
+
+@pytest.fixture()
+def tracer():
+    return Tracer()
+
+
+class TestTracer:
+    def test_span(self, tracer: Tracer):
+        with tracer.span("start", "VM"):
+            pass
+        span = tracer.spans[0]
+        assert (span.op, span.vm, span.outcome, span.retries) == ("start", "VM", "ok", 0)
+        assert span.duration >= 0
+
+    def test_failed_span(self, tracer: Tracer):
+        with pytest.raises(ValueError):
+            with tracer.span("start", "VM"):
+                raise ValueError("boom")
+        assert tracer.spans[0].outcome == "error"
+        assert tracer.spans[0].error == "ValueError: boom"
+
+    def test_count_retries(self, tracer: Tracer):
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                with tracer.span("delete", "VM"):
+                    raise ValueError()
+        with tracer.span("delete", "VM_One"):
+            pass
+        with tracer.span("delete", "VM"):
+            pass
+        with tracer.span("delete", "VM"):
+            pass
+        assert [span.retries for span in tracer.spans] == [0, 1, 0, 2, 0]
+
+    def test_slowest_and_summary(self, tracer: Tracer):
+        for op, vm, duration in [("clone", "A", 5), ("start", "A", 1), ("clone", "B", 3), ("start", "B", 2)]:
+            with tracer.span(op, vm) as span:
+                pass
+            span.duration = duration
+        assert [(span.op, span.vm) for span in tracer.slowest(2)] == [("clone", "A"), ("clone", "B")]
+        summary = tracer.summary()
+        assert [(op.op, op.count, op.total, op.max) for op in summary] == [("clone", 2, 8, 5), ("start", 2, 3, 2)]
+
+    def test_export_and_load_jsonl(self, tracer: Tracer, tmpdir):
+        path = os.path.join(str(tmpdir), "trace.jsonl")
+        with tracer.span("start", "VM"):
+            pass
+        tracer.export_jsonl(path)
+        tracer.export_jsonl(path, append=True)
+        loaded = Tracer.load_jsonl(path)
+        assert len(loaded.spans) == 2
+        assert loaded.spans[0]._asdict() == tracer.spans[0]._asdict()
+
+    def test_load_missing_file(self, tmpdir):
+        assert Tracer.load_jsonl(os.path.join(str(tmpdir), "missing")).spans == []
+
+    def test_export_chrome_trace(self, tracer: Tracer, tmpdir):
+        path = os.path.join(str(tmpdir), "trace.json")
+        with tracer.span("start", "VM"):
+            pass
+        tracer.export_chrome_trace(path)
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+        assert events[0]["name"] == "start VM"
+        assert events[0]["ph"] == "X"
+        assert events[0]["args"]["outcome"] == "ok"
+
+
+class TestTracingVMMController:
+    def test_trace_calls(self, tracer: Tracer):
+        vmmc = TracingVMMController(MockVMMController(), tracer)
+        vmmc.create_snapshot("VM", "Base")
+        vmmc.clone("VM", "Base", "Clone")
+        vmmc.start("Clone")
+        with pytest.raises(VMMControllerException):
+            vmmc.start("Clone")
+        assert [(span.op, span.vm, span.outcome) for span in tracer.spans] == [
+            ("create_snapshot", "VM", "ok"), ("clone", "Clone", "ok"), ("start", "Clone", "ok"), ("start", "Clone", "error")]
+
+    def test_trace_session(self, tracer: Tracer):
+        config = SessionHandler.default_config()
+        sh = SessionHandler(mock_vmm_controller_from_session_handler_config(config), config, tracer=tracer)
+        sh.start_session()
+        sh.close_session()
+        session_ops = [op.op for op in tracer.summary(category="session")]
+        for op in ["start_session", "create_clones", "start_all_vms", "close_session", "delete_clones"]:
+            assert op in session_ops
+        vmm_ops = [op.op for op in tracer.summary(category="vmm")]
+        for op in ["clone", "start", "poweroff", "delete", "create_snapshots"]:
+            assert op in vmm_ops
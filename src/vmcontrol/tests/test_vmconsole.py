@@ -14,6 +14,7 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+import os
 from unittest.mock import Mock
 
 import pytest
@@ -23,6 +24,8 @@ from vmcontrol.vmconsole import Main
 
 class MainForTesting(Main):
     vmmc_classes = {name: Mock() for name, _ in Main.vmmc_classes.items()}
+    async_vmmc_classes = {name: Mock() for name, _ in Main.async_vmmc_classes.items()}
+    sync_adapter_class = Mock()
     parse_json_file = Mock(return_value=dict())
 
 
@@ -41,9 +44,53 @@ class TestMain:
         m.set_session_state_file()
         assert m.session_state_file == "my_state_file"
 
-    @pytest.mark.parametrize("vmm", ["VMWare", "VirtualBox", "Remote"])
+    @pytest.mark.parametrize("vmm", ["VMWare", "VirtualBox", "VirtualBoxAPI", "Remote"])
     def test_set_vmm_controller(self, vmm):
         m = MainForTesting(["--vmm-config", "some_file"])
         m.parse_json_file = Mock(return_value={"vmm": vmm})
         m.set_vmm_controller()
         assert m.vmmc_classes[vmm].called
+
+    def test_set_session_id(self, tmpdir):
+        m = MainForTesting(["--session-id", "exp1", "--registry-dir", str(tmpdir)])
+        m.set_session_config()
+        m.set_session_state_file()
+        assert m.session_config.session_id == "exp1"
+        assert m.session_state_file == m.registry.state_file("exp1")
+        assert m.session_state_file.startswith(str(tmpdir))
+
+    def test_set_registry_limits(self, tmpdir):
+        m = MainForTesting(["-i", "exp1", "--registry-dir", str(tmpdir), "--max-sessions", "2", "--max-clones", "9"])
+        m.set_session_config()
+        m.set_session_state_file()
+        assert (m.registry.max_sessions, m.registry.max_clones) == (2, 9)
+
+    @pytest.mark.parametrize("vmm", ["VMWare", "VirtualBox"])
+    def test_set_async_vmm_controller(self, vmm):
+        m = MainForTesting(["--vmm-config", "some_file"])
+        m.parse_json_file = Mock(return_value={"vmm": vmm, "async": True})
+        m.set_vmm_controller()
+        assert m.async_vmmc_classes[vmm].called
+        m.sync_adapter_class.assert_called_with(m.async_vmmc_classes[vmm].return_value)
+
+    def test_run_batch(self, tmpdir, capsys):
+        batch_file = tmpdir.join("batch")
+        batch_file.write("get_vms\nunknown_command\n")
+        m = MainForTesting(["--batch", str(batch_file), "--keep-going"])
+        m.console = Mock()
+        m.console.parseline.side_effect = lambda line: (line, "", line)
+        del m.console.do_unknown_command
+        assert m.run_batch() == 1
+        m.console.onecmd.assert_called_once_with("get_vms")
+        assert "2 of 2 commands run, 1 failed" in capsys.readouterr().out
+
+    def test_trace_file(self, tmpdir):
+        trace_file = os.path.join(str(tmpdir), "trace.jsonl")
+        m = MainForTesting(["--trace", trace_file])
+        m.set_tracer()
+        with m.tracer.span("start", "VM"):
+            pass
+        m.save_trace()
+        m = MainForTesting(["--trace", trace_file])
+        m.set_tracer()
+        assert len(m.tracer.spans) == 1
@@ -0,0 +1,236 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from vmcontrol.vmmcontroller import VMMController
+
+
+class Span(SimpleNamespace):
+    op = None
+    vm = None
+    category = "vmm"
+    start = None
+    duration = None
+    outcome = "ok"
+    error = None
+    retries = 0
+    thread = 0
+
+    def _asdict(self):
+        return {
+            "op": self.op, "vm": self.vm, "category": self.category, "start": self.start,
+            "duration": self.duration, "outcome": self.outcome, "error": self.error, "retries": self.retries,
+            "thread": self.thread}
+
+    def __str__(self):
+        return "{op} {vm} {duration:.2f}s {outcome}{retries}".format(
+            op=self.op, vm='"{}"'.format(self.vm) if self.vm is not None else "", duration=self.duration,
+            outcome=self.outcome, retries=" ({} retries)".format(self.retries) if self.retries else "")
+
+
+class Tracer:
+    def __init__(self, spans=None):
+        self.spans = list(spans or list())
+        self._lock = threading.Lock()
+        self._failures = dict()
+        self._threads = dict()
+
+    @contextmanager
+    def span(self, op, vm=None, category="vmm"):
+        # A failed call that is repeated for the same VM counts as a retry of that call
+        key = (op, vm)
+        with self._lock:
+            retries = self._failures.get(key, 0)
+            thread = self._threads.setdefault(threading.get_ident(), len(self._threads))
+        span = Span(op=op, vm=vm, category=category, start=time.time(), retries=retries, thread=thread)
+        perf_start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.outcome = "error"
+            span.error = "{name}: {e}".format(name=type(e).__name__, e=e)
+            raise
+        finally:
+            span.duration = time.perf_counter() - perf_start
+            with self._lock:
+                if span.outcome == "ok":
+                    self._failures.pop(key, None)
+                else:
+                    self._failures[key] = retries + 1
+                self.spans.append(span)
+
+    def slowest(self, n=10, category=None):
+        spans = [span for span in self.spans if category is None or span.category == category]
+        return sorted(spans, key=lambda span: span.duration, reverse=True)[:n]
+
+    def summary(self, category=None):
+        ops = dict()
+        for span in self.spans:
+            if category is not None and span.category != category:
+                continue
+            op = ops.setdefault(span.op, SimpleNamespace(op=span.op, count=0, total=0.0, max=0.0, errors=0))
+            op.count += 1
+            op.total += span.duration
+            op.max = max(op.max, span.duration)
+            op.errors += span.outcome != "ok"
+        return sorted(ops.values(), key=lambda op: op.total, reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+            self._failures.clear()
+
+    def export_jsonl(self, path, append=False):
+        with open(path, "a" if append else "w") as f:
+            for span in self.spans:
+                f.write(json.dumps(span._asdict()) + "\n")
+
+    def export_chrome_trace(self, path):
+        # Complete events ("ph": "X") of the Trace Event Format, readable by chrome://tracing and Perfetto
+        events = [{
+            "name": span.op if span.vm is None else "{op} {vm}".format(op=span.op, vm=span.vm),
+            "cat": span.category,
+            "ph": "X",
+            "ts": int(span.start * 1e6),
+            "dur": int(span.duration * 1e6),
+            "pid": os.getpid(),
+            "tid": span.thread,
+            "args": {"vm": span.vm, "outcome": span.outcome, "error": span.error, "retries": span.retries},
+        } for span in self.spans]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    @classmethod
+    def load_jsonl(cls, path):
+        spans = list()
+        if os.path.isfile(path):
+            with open(path) as f:
+                spans = [Span(**json.loads(line)) for line in f if line.strip()]
+        return cls(spans)
+
+
+class TracingVMMController(VMMController):
+    def __init__(self, vmm_controller: VMMController, tracer: Tracer):
+        self.vmmc = vmm_controller
+        self.tracer = tracer
+
+    @property
+    def max_parallel_operations(self):
+        return self.vmmc.max_parallel_operations
+
+    def get_vms(self):
+        with self.tracer.span("get_vms"):
+            return self.vmmc.get_vms()
+
+    def start(self, vm):
+        with self.tracer.span("start", vm):
+            self.vmmc.start(vm)
+
+    def poweroff(self, vm):
+        with self.tracer.span("poweroff", vm):
+            self.vmmc.poweroff(vm)
+
+    def delete(self, vm):
+        with self.tracer.span("delete", vm):
+            self.vmmc.delete(vm)
+
+    def is_running(self, vm):
+        with self.tracer.span("is_running", vm):
+            return self.vmmc.is_running(vm)
+
+    def get_inventory(self):
+        with self.tracer.span("get_inventory"):
+            return self.vmmc.get_inventory()
+
+    def get_macs(self, vm):
+        with self.tracer.span("get_macs", vm):
+            return self.vmmc.get_macs(vm)
+
+    def get_mac(self, vm, if_id=1):
+        with self.tracer.span("get_mac", vm):
+            return self.vmmc.get_mac(vm, if_id=if_id)
+
+    def get_vm_info(self, vm):
+        with self.tracer.span("get_vm_info", vm):
+            return self.vmmc.get_vm_info(vm)
+
+    def get_vm_infos(self, vms):
+        with self.tracer.span("get_vm_infos"):
+            return self.vmmc.get_vm_infos(vms)
+
+    def get_host_info(self):
+        with self.tracer.span("get_host_info"):
+            return self.vmmc.get_host_info()
+
+    def set_mac(self, vm, mac, if_id=1):
+        with self.tracer.span("set_mac", vm):
+            self.vmmc.set_mac(vm, mac, if_id=if_id)
+
+    def get_snapshots(self, vm):
+        with self.tracer.span("get_snapshots", vm):
+            return self.vmmc.get_snapshots(vm)
+
+    def get_snapshots_many(self, vms):
+        with self.tracer.span("get_snapshots_many"):
+            return self.vmmc.get_snapshots_many(vms)
+
+    def create_snapshot(self, vm, snapshot):
+        with self.tracer.span("create_snapshot", vm):
+            self.vmmc.create_snapshot(vm, snapshot)
+
+    def create_snapshots(self, snapshots):
+        with self.tracer.span("create_snapshots"):
+            self.vmmc.create_snapshots(snapshots)
+
+    def delete_snapshot(self, vm, snapshot):
+        with self.tracer.span("delete_snapshot", vm):
+            self.vmmc.delete_snapshot(vm, snapshot)
+
+    def restore_snapshot(self, vm, snapshot):
+        with self.tracer.span("restore_snapshot", vm):
+            self.vmmc.restore_snapshot(vm, snapshot)
+
+    def clone(self, vm, snapshot, clone, linked=True):
+        with self.tracer.span("clone", clone):
+            self.vmmc.clone(vm, snapshot, clone, linked=linked)
+
+    def set_credentials(self, vm, user, password, domain):
+        with self.tracer.span("set_credentials", vm):
+            self.vmmc.set_credentials(vm, user, password, domain)
+
+    def set_credentials_many(self, credentials, timeout=None):
+        with self.tracer.span("set_credentials_many"):
+            self.vmmc.set_credentials_many(credentials, timeout=timeout)
+
+    def set_vrde_port(self, vm, port):
+        with self.tracer.span("set_vrde_port", vm):
+            self.vmmc.set_vrde_port(vm, port)
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        with self.tracer.span("configure_clone", vm):
+            self.vmmc.configure_clone(vm, macs=macs, vrde_port=vrde_port)
+
+    def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        with self.tracer.span("clone", clone):
+            self.vmmc.clone_and_configure(vm, snapshot, clone, linked=linked, macs=macs, vrde_port=vrde_port)
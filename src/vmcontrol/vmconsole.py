@@ -22,12 +22,17 @@ import argparse
 import json
 import logging
 import os
+import sys
 from tempfile import gettempdir
 
+from vmcontrol.batch import BatchRunner
 from vmcontrol.sessionhandler import SessionHandler, SessionConsole, \
-    SessionConfig
+    SessionConfig, SessionRegistry
 from vmcontrol.vmmcontroller import ESXiServer, LoggingVMWareController, LoggingVBoxController, \
-    LoggingRemoteVMMController
+    LoggingVBoxAPIController, LoggingRemoteVMMController, LoggingSyncVMMController, AsyncVBoxController, \
+    AsyncVMWareController
+from vmcontrol.statewatcher import create_state_watcher
+from vmcontrol.tracing import Tracer
 
 
 def setup_logging(level):
@@ -37,15 +42,24 @@ def setup_logging(level):
 class Main:
     session_config_class = SessionConfig
     session_state_file = os.path.join(gettempdir(), "sessionstate")
+    registry_dir = os.path.join(gettempdir(), "socbed_sessions")
     vmmc_classes = {
         "VirtualBox": LoggingVBoxController,
+        "VirtualBoxAPI": LoggingVBoxAPIController,
         "VMWare": LoggingVMWareController,
         "Remote": LoggingRemoteVMMController}
+    async_vmmc_classes = {
+        "VirtualBox": AsyncVBoxController,
+        "VMWare": AsyncVMWareController}
+    sync_adapter_class = LoggingSyncVMMController
     vmm_config = {"vmm": "VirtualBox"}
 
     def __init__(self, argv=None):
         self.args = parse_args(argv=argv)
         self.session_config = None
+        self.registry = None
+        self.tracer = None
+        self.state_watcher = None
         self.vmm_controller = None
         self.session_handler = None
         self.console = None
@@ -55,12 +69,30 @@ class Main:
         self.set_session_config()
         self.set_session_state_file()
         self.set_vmm_controller()
+        self.set_tracer()
+        self.set_state_watcher()
         self.set_session_handler()
         self.set_console()
-        if not self.args.command:
-            self.console.cmdloop()
+        try:
+            if self.args.batch_file:
+                return self.run_batch()
+            elif not self.args.command:
+                self.console.cmdloop()
+            else:
+                self.console.onecmd(self.args.command)
+        finally:
+            self.state_watcher.stop()
+            self.save_trace()
+
+    def run_batch(self):
+        if self.args.batch_file == "-":
+            lines = sys.stdin.readlines()
         else:
-            self.console.onecmd(self.args.command)
+            with open(self.args.batch_file) as f:
+                lines = f.readlines()
+        runner = BatchRunner(self.console, max_parallel=self.args.max_parallel, keep_going=self.args.keep_going)
+        commands = runner.run(lines)
+        return 0 if all(command.succeeded for command in commands) else 1
 
     def set_session_config(self):
         if self.args.config_file:
@@ -70,6 +102,12 @@ class Main:
             self.session_config = self.session_config_class()
 
     def set_session_state_file(self):
+        if self.args.session_id:
+            self.registry = SessionRegistry(
+                self.args.registry_dir or self.registry_dir, max_sessions=self.args.max_sessions,
+                max_clones=self.args.max_clones)
+            self.session_state_file = self.registry.state_file(self.args.session_id)
+            self.session_config.session_id = self.args.session_id
         if self.args.session_state_file:
             self.session_state_file = self.args.session_state_file
 
@@ -78,8 +116,12 @@ class Main:
             self.vmm_config = self.parse_json_file(self.args.vmm_config_file)
         config = self.vmm_config.copy()
         vmm = config.pop("vmm")
-        if vmm == "VirtualBox":
+        if config.pop("async", False):
+            self.set_async_vmm_controller(vmm, config)
+        elif vmm == "VirtualBox":
             self.vmm_controller = self.vmmc_classes["VirtualBox"]()
+        elif vmm == "VirtualBoxAPI":
+            self.vmm_controller = self.vmmc_classes["VirtualBoxAPI"]()
         elif vmm == "VMWare":
             esxi = ESXiServer(**config)
             self.vmm_controller = self.vmmc_classes["VMWare"](esxi_server=esxi)
@@ -88,9 +130,32 @@ class Main:
         else:
             raise Exception("VMM {} not implemented".format(vmm))
 
+    def set_tracer(self):
+        if self.args.trace_file:
+            # Spans of earlier vmconsole runs are kept, so "-c" invocations add up to one trace
+            self.tracer = Tracer.load_jsonl(self.args.trace_file)
+
+    def save_trace(self):
+        if self.tracer is not None:
+            self.tracer.export_jsonl(self.args.trace_file)
+
+    def set_async_vmm_controller(self, vmm, config):
+        if vmm == "VirtualBox":
+            async_vmm_controller = self.async_vmmc_classes["VirtualBox"]()
+        elif vmm == "VMWare":
+            async_vmm_controller = self.async_vmmc_classes["VMWare"](esxi_server=ESXiServer(**config))
+        else:
+            raise Exception("Async VMM {} not implemented".format(vmm))
+        self.vmm_controller = self.sync_adapter_class(async_vmm_controller)
+
+    def set_state_watcher(self):
+        # Only starts watching once somebody asks for a state
+        self.state_watcher = create_state_watcher(self.vmm_controller)
+
     def set_session_handler(self):
         self.session_handler = SessionHandler(
-            self.vmm_controller, self.session_config, self.session_state_file)
+            self.vmm_controller, self.session_config, self.session_state_file, registry=self.registry,
+            tracer=self.tracer, state_watcher=self.state_watcher)
 
     def set_console(self):
         self.console = SessionConsole(session_handler=self.session_handler)
@@ -117,15 +182,41 @@ def parse_args(argv=None):
     parser.add_argument(
         "-s", "--session-state-file", dest="session_state_file", default=None,
         help="Use custom session state file")
+    parser.add_argument(
+        "-i", "--session-id", dest="session_id", default=None,
+        help="Run a named session with this id next to other named sessions, with its own clones, MACs and VRDE "
+             "ports (state file is kept in the registry directory). Clone management IPs are not separated.")
+    parser.add_argument(
+        "--registry-dir", dest="registry_dir", default=None,
+        help="Directory of the session registry used with --session-id")
+    parser.add_argument(
+        "--max-sessions", dest="max_sessions", type=int, default=None,
+        help="Refuse to start a named session if this many sessions are already registered")
+    parser.add_argument(
+        "--max-clones", dest="max_clones", type=int, default=None,
+        help="Refuse to start a named session if all registered sessions would have more clones than this")
     parser.add_argument(
         "-m", "--vmm-config", dest="vmm_config_file", default=None,
         help="Use a VMM config file.")
+    parser.add_argument(
+        "-t", "--trace", dest="trace_file", default=None,
+        help="Record timing spans of all VM operations to this JSON lines file")
+    parser.add_argument(
+        "-b", "--batch", dest="batch_file", default=None,
+        help="Run the commands of this file (\"-\" for stdin) over one controller connection, "
+             "lines ending with \"&\" run concurrently until the next command or \"wait\"")
+    parser.add_argument(
+        "--max-parallel", dest="max_parallel", type=int, default=8,
+        help="Maximum number of concurrent batch commands")
+    parser.add_argument(
+        "--keep-going", dest="keep_going", action="store_true", default=False,
+        help="Do not stop a batch at the first failing command")
     args = parser.parse_args(args=argv)
     return args
 
 
 def main(argv=None):
-    Main(argv=argv).run()
+    sys.exit(Main(argv=argv).run())
 
 
 if __name__ == '__main__':
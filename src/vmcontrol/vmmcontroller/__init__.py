@@ -16,8 +16,13 @@
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
 
 
-from vmcontrol.vmmcontroller.vboxcontroller import VBoxController, LoggingVBoxController
-from vmcontrol.vmmcontroller.vmmcontroller import VMMController, LoggingVMMController, VMMControllerException
+from vmcontrol.vmmcontroller.asyncvmmcontroller import AsyncVMMController, ThreadedAsyncVMMController, \
+    SyncVMMController, LoggingSyncVMMController
+from vmcontrol.vmmcontroller.vboxcontroller import VBoxController, LoggingVBoxController, AsyncVBoxController
+from vmcontrol.vmmcontroller.vboxapicontroller import VBoxAPIController, LoggingVBoxAPIController
+from vmcontrol.vmmcontroller.vmmcontroller import VMMController, LoggingVMMController, VMMControllerException, VMInfo, \
+    HostInfo
 from vmcontrol.vmmcontroller.vmmconsole import VMMConsole
-from vmcontrol.vmmcontroller.vmwarecontroller import VMWareController, LoggingVMWareController, ESXiServer
+from vmcontrol.vmmcontroller.vmwarecontroller import VMWareController, LoggingVMWareController, ESXiServer, \
+    AsyncVMWareController
 from vmcontrol.vmmcontroller.remotevmmcontroller import RemoteVMMController, LoggingRemoteVMMController, VMMControlDaemon
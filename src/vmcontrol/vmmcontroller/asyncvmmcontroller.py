@@ -0,0 +1,305 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+
+from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController, VMInfo, \
+    local_host_info
+
+
+class AsyncVMMController:
+    # Same contract as VMMController, but every method is a coroutine
+    max_parallel_operations = 16
+
+    async def get_vms(self):
+        raise NotImplementedError()
+
+    async def start(self, vm):
+        raise NotImplementedError()
+
+    async def poweroff(self, vm):
+        raise NotImplementedError()
+
+    async def delete(self, vm):
+        raise NotImplementedError()
+
+    async def is_running(self, vm):
+        raise NotImplementedError()
+
+    async def get_macs(self, vm):
+        raise NotImplementedError()
+
+    async def get_mac(self, vm, if_id=1):
+        raise NotImplementedError()
+
+    async def set_mac(self, vm, mac, if_id=1):
+        raise NotImplementedError()
+
+    async def get_snapshots(self, vm):
+        raise NotImplementedError()
+
+    async def create_snapshot(self, vm, snapshot):
+        raise NotImplementedError()
+
+    async def delete_snapshot(self, vm, snapshot):
+        raise NotImplementedError()
+
+    async def restore_snapshot(self, vm, snapshot):
+        raise NotImplementedError()
+
+    async def clone(self, vm, snapshot, clone, linked=True):
+        raise NotImplementedError()
+
+    async def set_credentials(self, vm, user, password, domain):
+        raise NotImplementedError()
+
+    async def set_vrde_port(self, vm, port):
+        raise NotImplementedError()
+
+    async def configure_clone(self, vm, macs=None, vrde_port=None):
+        for if_id, mac in sorted((macs or dict()).items()):
+            await self.set_mac(vm, mac, if_id=if_id)
+        if vrde_port is not None:
+            await self.set_vrde_port(vm, vrde_port)
+
+    async def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        await self.clone(vm, snapshot, clone, linked=linked)
+        await self.configure_clone(clone, macs=macs, vrde_port=vrde_port)
+
+    async def get_inventory(self):
+        vms = await self.get_vms()
+        running = await asyncio.gather(*(self.is_running(vm) for vm in vms))
+        return dict(zip(vms, running))
+
+    async def get_vm_info(self, vm):
+        running, macs = await asyncio.gather(self.is_running(vm), self.get_macs(vm))
+        return VMInfo(name=vm, state="running" if running else "poweroff", running=running,
+                      macs={if_id: mac for if_id, mac in enumerate(macs, start=1)})
+
+    async def get_vm_infos(self, vms):
+        return await self._for_each_vm(self.get_vm_info, vms)
+
+    async def get_host_info(self):
+        return local_host_info()
+
+    async def get_snapshots_many(self, vms):
+        return await self._for_each_vm(self.get_snapshots, vms)
+
+    async def create_snapshots(self, snapshots):
+        await self._for_each_vm(lambda vm: self.create_snapshot(vm, snapshots[vm]), list(snapshots))
+
+    async def set_credentials_many(self, credentials, timeout=None):
+        try:
+            await asyncio.wait_for(
+                self._for_each_vm(lambda vm: self.set_credentials(vm, *credentials[vm]), list(credentials)), timeout)
+        except asyncio.TimeoutError:
+            raise VMMControllerException("Credentials not set within {timeout}s".format(timeout=timeout))
+
+    async def _for_each_vm(self, func, vms):
+        semaphore = asyncio.Semaphore(self.max_parallel_operations)
+
+        async def run(vm):
+            async with semaphore:
+                return await func(vm)
+
+        results = await asyncio.gather(*(run(vm) for vm in vms), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, VMMControllerException):
+                raise result
+        errors = ["{vm}: {e}".format(vm=vm, e=result) for vm, result in zip(vms, results)
+                  if isinstance(result, VMMControllerException)]
+        if errors:
+            raise VMMControllerException("Operation failed for some VMs:\n" + "\n".join(errors))
+        return dict(zip(vms, results))
+
+
+class ThreadedAsyncVMMController(AsyncVMMController):
+    # Makes any blocking VMMController usable from asyncio by running its calls in worker threads
+    def __init__(self, vmm_controller: VMMController):
+        self.vmmc = vmm_controller
+
+    @property
+    def max_parallel_operations(self):
+        return self.vmmc.max_parallel_operations
+
+    async def get_vms(self):
+        return await asyncio.to_thread(self.vmmc.get_vms)
+
+    async def start(self, vm):
+        await asyncio.to_thread(self.vmmc.start, vm)
+
+    async def poweroff(self, vm):
+        await asyncio.to_thread(self.vmmc.poweroff, vm)
+
+    async def delete(self, vm):
+        await asyncio.to_thread(self.vmmc.delete, vm)
+
+    async def is_running(self, vm):
+        return await asyncio.to_thread(self.vmmc.is_running, vm)
+
+    async def get_inventory(self):
+        return await asyncio.to_thread(self.vmmc.get_inventory)
+
+    async def get_macs(self, vm):
+        return await asyncio.to_thread(self.vmmc.get_macs, vm)
+
+    async def get_mac(self, vm, if_id=1):
+        return await asyncio.to_thread(self.vmmc.get_mac, vm, if_id=if_id)
+
+    async def set_mac(self, vm, mac, if_id=1):
+        await asyncio.to_thread(self.vmmc.set_mac, vm, mac, if_id=if_id)
+
+    async def get_vm_info(self, vm):
+        return await asyncio.to_thread(self.vmmc.get_vm_info, vm)
+
+    async def get_host_info(self):
+        return await asyncio.to_thread(self.vmmc.get_host_info)
+
+    async def get_snapshots(self, vm):
+        return await asyncio.to_thread(self.vmmc.get_snapshots, vm)
+
+    async def create_snapshot(self, vm, snapshot):
+        await asyncio.to_thread(self.vmmc.create_snapshot, vm, snapshot)
+
+    async def delete_snapshot(self, vm, snapshot):
+        await asyncio.to_thread(self.vmmc.delete_snapshot, vm, snapshot)
+
+    async def restore_snapshot(self, vm, snapshot):
+        await asyncio.to_thread(self.vmmc.restore_snapshot, vm, snapshot)
+
+    async def clone(self, vm, snapshot, clone, linked=True):
+        await asyncio.to_thread(self.vmmc.clone, vm, snapshot, clone, linked=linked)
+
+    async def set_credentials(self, vm, user, password, domain):
+        await asyncio.to_thread(self.vmmc.set_credentials, vm, user, password, domain)
+
+    async def set_credentials_many(self, credentials, timeout=None):
+        await asyncio.to_thread(self.vmmc.set_credentials_many, credentials, timeout=timeout)
+
+    async def set_vrde_port(self, vm, port):
+        await asyncio.to_thread(self.vmmc.set_vrde_port, vm, port)
+
+    async def configure_clone(self, vm, macs=None, vrde_port=None):
+        await asyncio.to_thread(self.vmmc.configure_clone, vm, macs=macs, vrde_port=vrde_port)
+
+    async def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        await asyncio.to_thread(
+            self.vmmc.clone_and_configure, vm, snapshot, clone, linked=linked, macs=macs, vrde_port=vrde_port)
+
+
+class SyncVMMController(VMMController):
+    # Blocking VMMController on top of an AsyncVMMController. All coroutines run on one event loop in a
+    # background thread, so callers from any thread (vmconsole, SessionHandler workers) share it.
+    def __init__(self, async_vmm_controller: AsyncVMMController):
+        self.avmmc = async_vmm_controller
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def max_parallel_operations(self):
+        return self.avmmc.max_parallel_operations
+
+    def close(self):
+        with self._loop_lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+    def _run(self, coroutine):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="vmmc-event-loop", daemon=True).start()
+            loop = self._loop
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def get_vms(self):
+        return self._run(self.avmmc.get_vms())
+
+    def start(self, vm):
+        self._run(self.avmmc.start(vm))
+
+    def poweroff(self, vm):
+        self._run(self.avmmc.poweroff(vm))
+
+    def delete(self, vm):
+        self._run(self.avmmc.delete(vm))
+
+    def is_running(self, vm):
+        return self._run(self.avmmc.is_running(vm))
+
+    def get_inventory(self):
+        return self._run(self.avmmc.get_inventory())
+
+    def get_macs(self, vm):
+        return self._run(self.avmmc.get_macs(vm))
+
+    def get_mac(self, vm, if_id=1):
+        return self._run(self.avmmc.get_mac(vm, if_id=if_id))
+
+    def set_mac(self, vm, mac, if_id=1):
+        self._run(self.avmmc.set_mac(vm, mac, if_id=if_id))
+
+    def get_vm_info(self, vm):
+        return self._run(self.avmmc.get_vm_info(vm))
+
+    def get_vm_infos(self, vms):
+        return self._run(self.avmmc.get_vm_infos(vms))
+
+    def get_host_info(self):
+        return self._run(self.avmmc.get_host_info())
+
+    def get_snapshots(self, vm):
+        return self._run(self.avmmc.get_snapshots(vm))
+
+    def get_snapshots_many(self, vms):
+        return self._run(self.avmmc.get_snapshots_many(vms))
+
+    def create_snapshot(self, vm, snapshot):
+        self._run(self.avmmc.create_snapshot(vm, snapshot))
+
+    def create_snapshots(self, snapshots):
+        self._run(self.avmmc.create_snapshots(snapshots))
+
+    def delete_snapshot(self, vm, snapshot):
+        self._run(self.avmmc.delete_snapshot(vm, snapshot))
+
+    def restore_snapshot(self, vm, snapshot):
+        self._run(self.avmmc.restore_snapshot(vm, snapshot))
+
+    def clone(self, vm, snapshot, clone, linked=True):
+        self._run(self.avmmc.clone(vm, snapshot, clone, linked=linked))
+
+    def set_credentials(self, vm, user, password, domain):
+        self._run(self.avmmc.set_credentials(vm, user, password, domain))
+
+    def set_credentials_many(self, credentials, timeout=None):
+        self._run(self.avmmc.set_credentials_many(credentials, timeout=timeout))
+
+    def set_vrde_port(self, vm, port):
+        self._run(self.avmmc.set_vrde_port(vm, port))
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        self._run(self.avmmc.configure_clone(vm, macs=macs, vrde_port=vrde_port))
+
+    def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        self._run(self.avmmc.clone_and_configure(vm, snapshot, clone, linked=linked, macs=macs, vrde_port=vrde_port))
+
+
+class LoggingSyncVMMController(LoggingVMMController, SyncVMMController):
+    pass
@@ -20,10 +20,12 @@ import json
 import os
 import socket
 import ssl
+import threading
 
 import time
 
-from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController
+from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController, VMInfo, \
+    HostInfo
 
 import logging
 
@@ -36,6 +38,8 @@ class RemoteVMMController(VMMController):
         self.messenger = Messenger(local_address=address)
         self.messenger.listen()
         self.local_address = self.messenger.listening_socket.getsockname()
+        # One connection for all threads, a request and its response must not interleave with others
+        self._call_lock = threading.Lock()
         logger.info("RemoteVMMController listening at {add}".format(add=self.local_address))
 
     def __del__(self):
@@ -43,8 +47,9 @@ class RemoteVMMController(VMMController):
 
     def _remote_call(self, vmc_cmd, kwargs):
         call_d = self._wrap_cmd_dict(vmc_cmd, kwargs)
-        self.messenger.send(call_d)
-        received_d = self.messenger.receive()
+        with self._call_lock:
+            self.messenger.send(call_d)
+            received_d = self.messenger.receive()
         if received_d:
             if received_d["type"] == "return":
                 return received_d["value"]
@@ -59,8 +64,8 @@ class RemoteVMMController(VMMController):
     def _wrap_cmd_dict(vmc_cmd, kwargs):
         return {"type": "vmc_cmd", "vmc_cmd": vmc_cmd, "kwargs": kwargs}
 
-    def clone(self, vm, snapshot, clone):
-        kwargs = {"vm": vm, "snapshot": snapshot, "clone": clone}
+    def clone(self, vm, snapshot, clone, linked=True):
+        kwargs = {"vm": vm, "snapshot": snapshot, "clone": clone, "linked": linked}
         ret = self._remote_call("clone", kwargs)
         return ret
 
@@ -84,11 +89,42 @@ class RemoteVMMController(VMMController):
         ret = self._remote_call("set_mac", kwargs)
         return ret
 
+    def set_vrde_port(self, vm, port):
+        kwargs = {"vm": vm, "port": port}
+        ret = self._remote_call("set_vrde_port", kwargs)
+        return ret
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        kwargs = {"vm": vm, "macs": macs, "vrde_port": vrde_port}
+        ret = self._remote_call("configure_clone", kwargs)
+        return ret
+
+    def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        kwargs = {"vm": vm, "snapshot": snapshot, "clone": clone, "linked": linked, "macs": macs,
+                  "vrde_port": vrde_port}
+        ret = self._remote_call("clone_and_configure", kwargs)
+        return ret
+
     def get_macs(self, vm):
         kwargs = {"vm": vm}
         ret = self._remote_call("get_macs", kwargs)
         return ret
 
+    def get_vm_info(self, vm):
+        kwargs = {"vm": vm}
+        ret = self._remote_call("get_vm_info", kwargs)
+        return VMInfo.from_dict(ret)
+
+    def get_vm_infos(self, vms):
+        kwargs = {"vms": vms}
+        ret = self._remote_call("get_vm_infos", kwargs)
+        return {vm: VMInfo.from_dict(info) for vm, info in ret.items()}
+
+    def get_host_info(self):
+        kwargs = {}
+        ret = self._remote_call("get_host_info", kwargs)
+        return HostInfo.from_dict(ret)
+
     def restore_snapshot(self, vm, snapshot):
         kwargs = {"vm": vm, "snapshot": snapshot}
         ret = self._remote_call("restore_snapshot", kwargs)
@@ -99,6 +135,11 @@ class RemoteVMMController(VMMController):
         ret = self._remote_call("is_running", kwargs)
         return ret
 
+    def get_inventory(self):
+        kwargs = {}
+        ret = self._remote_call("get_inventory", kwargs)
+        return ret
+
     def poweroff(self, vm):
         kwargs = {"vm": vm}
         ret = self._remote_call("poweroff", kwargs)
@@ -119,6 +160,11 @@ class RemoteVMMController(VMMController):
         ret = self._remote_call("set_credentials", kwargs)
         return ret
 
+    def set_credentials_many(self, credentials, timeout=None):
+        kwargs = {"credentials": credentials, "timeout": timeout}
+        ret = self._remote_call("set_credentials_many", kwargs)
+        return ret
+
     def delete_snapshot(self, vm, snapshot):
         kwargs = {"vm": vm, "snapshot": snapshot}
         ret = self._remote_call("delete_snapshot", kwargs)
@@ -129,6 +175,16 @@ class RemoteVMMController(VMMController):
         ret = self._remote_call("get_snapshots", kwargs)
         return ret
 
+    def get_snapshots_many(self, vms):
+        kwargs = {"vms": vms}
+        ret = self._remote_call("get_snapshots_many", kwargs)
+        return ret
+
+    def create_snapshots(self, snapshots):
+        kwargs = {"snapshots": snapshots}
+        ret = self._remote_call("create_snapshots", kwargs)
+        return ret
+
 
 class LoggingRemoteVMMController(LoggingVMMController, RemoteVMMController):
     pass
@@ -163,7 +219,7 @@ class VMMControlDaemon:
         logger.debug("Handle request {call_d}".format(call_d=call_d))
         vmc_method = getattr(self.vmc, call_d["vmc_cmd"])
         try:
-            return_value = vmc_method(**call_d["kwargs"])
+            return_value = vmc_method(**self._decode_kwargs(call_d["kwargs"]))
         except VMMControllerException as e:
             error_d = self._wrap_exception_dict(e)
             self.messenger.send(error_d)
@@ -171,6 +227,13 @@ class VMMControlDaemon:
             return_d = self._wrap_return_dict(return_value)
             self.messenger.send(return_d)
 
+    @staticmethod
+    def _decode_kwargs(kwargs):
+        # JSON turns the interface ids of macs into strings
+        if kwargs.get("macs") is not None:
+            kwargs = dict(kwargs, macs={int(if_id): mac for if_id, mac in kwargs["macs"].items()})
+        return kwargs
+
     @staticmethod
     def _wrap_return_dict(return_value):
         return {"type": "return", "value": return_value}
@@ -264,7 +327,8 @@ class Messenger:
             raise ConnectionError("No data socket to receive....")
 
     def _pack(self, data):
-        return bytes(json.dumps(data), "utf-8")
+        # Records like VMInfo are sent as their dicts
+        return bytes(json.dumps(data, default=lambda obj: obj._asdict()), "utf-8")
 
     def _unpack(self, packed_data):
         return json.loads(str(packed_data, encoding="utf-8"))
@@ -16,7 +16,7 @@
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
 
 
-from vmcontrol.vmmcontroller import VMMController, VMMControllerException
+from vmcontrol.vmmcontroller import VMMController, VMMControllerException, HostInfo
 
 
 def mock_print_decorator():
@@ -44,6 +44,8 @@ class VM:
         self.name = name or ""
         self.snapshots = list()
         self.macs = [int("0080123456AA", 16) + self.mac_count, int("00801BB456AA", 16) + self.mac_count]
+        self.memory = 1024
+        self.cpus = 1
         VM.mac_count += 1
 
 
@@ -52,6 +54,7 @@ class MockVMMController(VMMController):
         self.printing = printing
         self.vms = [VM("VM"), VM("VM_One"), VM("VM_Two")]
         self.running_vms = set()
+        self.host_info = HostInfo(memory=16384, cpus=8)
 
     def _get_vm_by_name(self, name):
         for vm in self.vms:
@@ -114,13 +117,25 @@ class MockVMMController(VMMController):
             raise VMMControllerException()
 
     @mock_print_decorator()
-    def clone(self, vm, snapshot, clone):
+    def clone(self, vm, snapshot, clone, linked=True):
         vm_obj = self._get_vm_by_name(vm)
         if snapshot not in vm_obj.snapshots:
             raise VMMControllerException()
         else:
             self.vms.append(VM(clone))
 
+    @mock_print_decorator()
+    def get_vm_info(self, vm):
+        vm_info = super().get_vm_info(vm)
+        vm_obj = self._get_vm_by_name(vm)
+        vm_info.memory = vm_obj.memory
+        vm_info.cpus = vm_obj.cpus
+        return vm_info
+
+    @mock_print_decorator()
+    def get_host_info(self):
+        return self.host_info
+
     @mock_print_decorator()
     def get_macs(self, vm):
         vm_obj = self._get_vm_by_name(vm)
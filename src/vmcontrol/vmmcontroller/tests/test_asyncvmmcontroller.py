@@ -0,0 +1,210 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from pyVmomi import vim
+
+from vmcontrol.sessionhandler import SessionHandler
+from vmcontrol.sessionhandler.tests.test_sessionhandler import mock_vmm_controller_from_session_handler_config
+from vmcontrol.vmmcontroller import AsyncVBoxController, AsyncVMMController, ThreadedAsyncVMMController, \
+    SyncVMMController, VMMControllerException
+from vmcontrol.vmmcontroller.tests.test_vmwarecontroller import network_adapter
+from vmcontrol.vmmcontroller.vmwarecontroller import AsyncVMWareController, ESXiServer, TaskStartingVMWareController, \
+    VSphereInventory
+
+
+class SleepingAsyncVMMController(AsyncVMMController):
+    def __init__(self, delay, failing_vms=()):
+        self.delay = delay
+        self.failing_vms = failing_vms
+        self.snapshots = dict()
+        self.threads = set()
+
+    async def create_snapshot(self, vm, snapshot):
+        self.threads.add(threading.get_ident())
+        await asyncio.sleep(self.delay)
+        if vm in self.failing_vms:
+            raise VMMControllerException("locked")
+        self.snapshots[vm] = snapshot
+
+
+@pytest.fixture()
+def avbc():
+    avbc = AsyncVBoxController()
+    avbc._vboxmanage_execute = AsyncMock(return_value="")
+    return avbc
+
+
+def assert_call(avbc: AsyncVBoxController, vbox_vector):
+    avbc._vboxmanage_execute.assert_called_with(vbox_vector)
+
+
+class TestAsyncVMMController:
+    def test_batch_runs_concurrently_on_one_thread(self):
+        avmmc = SleepingAsyncVMMController(delay=0.05)
+        vms = ["VM{}".format(i) for i in range(avmmc.max_parallel_operations)]
+        start = time.perf_counter()
+        asyncio.run(avmmc.create_snapshots({vm: "Backup" for vm in vms}))
+        assert time.perf_counter() - start < 0.05 * len(vms) / 2
+        assert len(avmmc.snapshots) == len(vms)
+        assert len(avmmc.threads) == 1
+
+    def test_batch_collects_failures(self):
+        avmmc = SleepingAsyncVMMController(delay=0, failing_vms=["VM2"])
+        with pytest.raises(VMMControllerException) as ei:
+            asyncio.run(avmmc.create_snapshots({"VM1": "Backup", "VM2": "Backup", "VM3": "Backup"}))
+        assert "VM2: locked" in str(ei.value)
+        assert set(avmmc.snapshots) == {"VM1", "VM3"}
+
+
+class TestAsyncVBoxController:
+    def test_start(self, avbc: AsyncVBoxController):
+        asyncio.run(avbc.start("VM"))
+        assert_call(avbc, ["startvm", "VM", "--type", "headless"])
+
+    def test_get_inventory(self, avbc: AsyncVBoxController):
+        outputs = {
+            "vms": '"VM1" {8451900b-320a-43b4-9eb9-9bd6656f33ad}\n"VM2" {4d0986c7-eabc-4cd3-a2f3-e28111a66ac1}',
+            "runningvms": '"VM2" {4d0986c7-eabc-4cd3-a2f3-e28111a66ac1}',
+        }
+        avbc._vboxmanage_execute = AsyncMock(side_effect=lambda vbox_vector: outputs[vbox_vector[1]])
+        assert asyncio.run(avbc.get_inventory()) == {"VM1": False, "VM2": True}
+
+    def test_get_mac(self, avbc: AsyncVBoxController):
+        avbc._vboxmanage_execute.return_value = 'name="VM"\nmacaddress1="080027CA0E5D"'
+        assert asyncio.run(avbc.get_mac("VM")) == 0x080027CA0E5D
+        with pytest.raises(VMMControllerException):
+            asyncio.run(avbc.get_mac("VM", if_id=2))
+
+    def test_configure_clone(self, avbc: AsyncVBoxController):
+        asyncio.run(avbc.configure_clone("VM", macs={1: 0x005056000001}, vrde_port=5000))
+        assert_call(avbc, ["modifyvm", "VM", "--macaddress1", "005056000001", "--vrdeport", "5000"])
+
+    def test_get_snapshots_when_no_snapshots(self, avbc: AsyncVBoxController):
+        async def execute(vbox_vector):
+            if vbox_vector[0] == "snapshot":
+                raise VMMControllerException()
+            return '"VM" {8451900b-320a-43b4-9eb9-9bd6656f33ad}'
+
+        avbc._vboxmanage_execute = AsyncMock(side_effect=execute)
+        assert asyncio.run(avbc.get_snapshots("VM")) == []
+        with pytest.raises(VMMControllerException):
+            asyncio.run(avbc.get_snapshots("Missing"))
+
+    def test_vboxmanage_error(self, monkeypatch):
+        process = SimpleNamespace(returncode=1, communicate=AsyncMock(return_value=(b"", b"not found")))
+        create = AsyncMock(return_value=process)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", create)
+        with pytest.raises(VMMControllerException) as ei:
+            asyncio.run(AsyncVBoxController._vboxmanage_execute(["startvm", "VM"]))
+        assert "not found" in str(ei.value)
+        assert create.call_args[0][:3] == ("vboxmanage", "startvm", "VM")
+
+
+class TestAsyncVMWareController:
+    def build_controller(self, future):
+        avmwc = AsyncVMWareController.__new__(AsyncVMWareController)
+        avmwc.vmmc = Mock()
+        avmwc.vmmc.task_tracker.return_value.track.return_value = future
+        return avmwc
+
+    def test_wait_for_task(self):
+        future = Future()
+        future.set_result("done")
+        avmwc = self.build_controller(future)
+        assert asyncio.run(avmwc._wait_for_task("task")) == "done"
+        avmwc.vmmc.task_tracker.return_value.track.assert_called_with("task")
+
+    def test_wait_for_failed_task(self):
+        future = Future()
+        future.set_exception(VMMControllerException("disk full"))
+        avmwc = self.build_controller(future)
+        with pytest.raises(VMMControllerException) as ei:
+            asyncio.run(avmwc._wait_for_task("task"))
+        assert "disk full" in str(ei.value)
+
+    def build_indexed_controller(self, task_result=None, task_error=None):
+        # Tasks are started by a real TaskStartingVMWareController and finish with task_result or task_error
+        vmwc = TaskStartingVMWareController.__new__(TaskStartingVMWareController)
+        vmwc.si = None
+        vmwc._started = threading.local()
+        vmwc.esxi = ESXiServer(resource_pool="SOCBED", data_center="DC", data_store="DS", vm_folder="SOCBED")
+        inventory = VSphereInventory(content=None, container=None, types=[vim.VirtualMachine])
+        self.vm_obj = Mock(_moId="vm-1")
+        self.vm_obj.config.hardware.device = [network_adapter(1)]
+        inventory.add(self.vm_obj, "Client")
+        vmwc._inventories = lambda: (None, inventory)
+        vmwc._vm_obj = Mock(return_value=self.vm_obj)
+        vmwc._vm_folder_obj = Mock(return_value=vim.Folder("group-v2"))
+        vmwc._data_store_obj = Mock(return_value=vim.Datastore("datastore-1"))
+        vmwc._resource_pool_obj = Mock(return_value=vim.ResourcePool("resgroup-1"))
+        vmwc._snapshot_obj = Mock(return_value=vim.vm.Snapshot("snapshot-1"))
+        vmwc._snapshot_devices = Mock(return_value=[network_adapter(1)])
+        future = Future()
+        if task_error is not None:
+            future.set_exception(task_error)
+        else:
+            future.set_result(task_result)
+        vmwc.task_tracker = Mock()
+        vmwc.task_tracker.return_value.track.return_value = future
+        avmwc = AsyncVMWareController.__new__(AsyncVMWareController)
+        avmwc.vmmc = vmwc
+        return avmwc, inventory
+
+    def test_delete_updates_index(self):
+        avmwc, inventory = self.build_indexed_controller()
+        asyncio.run(avmwc.delete("Client"))
+        assert inventory.entry(self.vm_obj) is None
+
+    def test_failed_delete_keeps_index(self):
+        avmwc, inventory = self.build_indexed_controller(task_error=VMMControllerException("locked"))
+        with pytest.raises(VMMControllerException):
+            asyncio.run(avmwc.delete("Client"))
+        assert inventory.entry(self.vm_obj).name == "Client"
+
+    def test_clone_updates_index(self):
+        clone_obj = vim.VirtualMachine("vm-2")
+        avmwc, inventory = self.build_indexed_controller(clone_obj)
+        asyncio.run(avmwc.clone_and_configure("Client", "Snap", "ClientClone1", macs={1: 0x005056000001}))
+        assert inventory.names(vim.VirtualMachine)["ClientClone1"] == clone_obj
+
+
+class TestSyncVMMController:
+    def test_session_over_async_controller(self):
+        config = SessionHandler.default_config()
+        config.max_parallel_starts = 4
+        mvmc = mock_vmm_controller_from_session_handler_config(config)
+        sh = SessionHandler(SyncVMMController(ThreadedAsyncVMMController(mvmc)), config)
+        sh.start_session()
+        assert all(mvmc.is_running(vm) for vm in config.server_vms + sh.clone_vms)
+        assert sh.verify_clones() == []
+        sh.close_session()
+        assert not any(mvmc.is_running(vm) for vm in config.server_vms)
+        sh.vmmc.close()
+
+    def test_exceptions_pass_through(self):
+        vmmc = SyncVMMController(SleepingAsyncVMMController(delay=0, failing_vms=["VM"]))
+        with pytest.raises(VMMControllerException):
+            vmmc.create_snapshot("VM", "Backup")
+        vmmc.close()
@@ -0,0 +1,359 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import threading
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from vmcontrol.vmmcontroller import VBoxAPIController, VBoxController, VMMController, VMMControllerException, \
+    HostInfo
+from vmcontrol.vmmcontroller.vboxapicontroller import VBoxEventStateWatcher
+
+constants = SimpleNamespace(
+    LockType_Shared=1, LockType_Write=2, CleanupMode_DetachAllReturnHardDisksOnly=3, CloneMode_MachineState=1,
+    CloneOptions_Link=1, MachineState_PoweredOff=1, MachineState_Running=5, MachineState_FirstOnline=5,
+    MachineState_LastOnline=17, VBoxEventType_OnMachineStateChanged=32, VBoxEventType_OnMachineRegistered=35)
+
+
+class EventSource:
+    def __init__(self):
+        self.events = queue.Queue()
+        self.listeners = list()
+
+    def createListener(self):
+        return object()
+
+    def registerListener(self, listener, event_types, active):
+        self.listeners.append(listener)
+
+    def unregisterListener(self, listener):
+        self.listeners.remove(listener)
+
+    def getEvent(self, listener, timeout_ms):
+        try:
+            return self.events.get(timeout=timeout_ms / 1000)
+        except queue.Empty:
+            return None
+
+    def eventProcessed(self, listener, event):
+        pass
+
+
+class Progress:
+    def __init__(self, result_code=0, text=""):
+        self.resultCode = result_code
+        self.errorInfo = SimpleNamespace(text=text)
+        self.waitForCompletion = Mock()
+
+
+class Snapshot:
+    def __init__(self, name, machine, children=()):
+        self.name = name
+        self.id = name + "-id"
+        self.machine = machine
+        self.children = list(children)
+
+
+class Machine:
+    def __init__(self, name, macs=("080027CA0E5D", "0800279104ED")):
+        self.name = name
+        self.id = name + "-id"
+        self.accessible = True
+        self.OSTypeId = "Linux"
+        self.memorySize = 2048
+        self.CPUCount = 2
+        self.chipsetType = 1
+        self.state = constants.MachineState_PoweredOff
+        self.adapters = [SimpleNamespace(enabled=True, MACAddress=mac) for mac in macs]
+        self.adapters += [SimpleNamespace(enabled=False, MACAddress="080027000000") for _ in range(8 - len(macs))]
+        self.VRDEServer = Mock()
+        self.root_snapshot = None
+        self.saveSettings = Mock()
+        self.lockMachine = Mock(side_effect=lambda session, lock_type: session.lock(self, lock_type))
+
+    @property
+    def snapshotCount(self):
+        return 0 if self.root_snapshot is None else 1
+
+    def getNetworkAdapter(self, slot):
+        return self.adapters[slot]
+
+    def findSnapshot(self, name):
+        pending = [self.root_snapshot] if self.root_snapshot else []
+        while pending:
+            snapshot = pending.pop(0)
+            if name in ("", snapshot.name):
+                return snapshot
+            pending.extend(snapshot.children)
+        raise Exception("Could not find a snapshot named '{}'".format(name))
+
+    def launchVMProcess(self, session, name, environment):
+        self.state = constants.MachineState_Running
+        return Progress()
+
+
+class Session:
+    def __init__(self):
+        self.machine = None
+        self.lock_type = None
+        self.console = Mock()
+        self.console.powerDown.return_value = Progress()
+
+    def lock(self, machine, lock_type):
+        self.machine = machine
+        self.lock_type = lock_type
+
+    def unlockMachine(self):
+        self.machine = None
+
+
+class VirtualBox:
+    def __init__(self, machines):
+        self.machines = machines
+        self.eventSource = EventSource()
+        self.host = SimpleNamespace(memorySize=32000, processorCount=12)
+        self.systemProperties = SimpleNamespace(getMaxNetworkAdapters=lambda chipset: 8)
+
+    def findMachine(self, name):
+        for machine in self.machines:
+            if name in (machine.name, machine.id):
+                return machine
+        raise Exception("Could not find a registered machine named '{}'".format(name))
+
+    def createMachine(self, settings_file, name, groups, os_type, flags):
+        return Machine(name, macs=())
+
+    def registerMachine(self, machine):
+        self.machines.append(machine)
+
+
+class Manager:
+    def __init__(self, machines):
+        self.constants = constants
+        self.vbox = VirtualBox(machines)
+        self.sessions = list()
+        self.initPerThread = Mock()
+        self.deinitPerThread = Mock()
+
+    def getVirtualBox(self):
+        return self.vbox
+
+    def getArray(self, obj, attribute):
+        return list(getattr(obj, attribute))
+
+    def queryInterface(self, obj, interface):
+        return obj
+
+    def getSessionObject(self):
+        session = Session()
+        self.sessions.append(session)
+        return session
+
+
+@pytest.fixture()
+def manager():
+    vm = Machine("VM")
+    vm.root_snapshot = Snapshot("clean", vm, [Snapshot("version 2", vm, [Snapshot("imdisk", vm)])])
+    return Manager([vm, Machine("VM2")])
+
+
+@pytest.fixture()
+def vbc(manager):
+    return VBoxAPIController(manager=manager)
+
+
+def machine(manager, name):
+    return manager.vbox.findMachine(name)
+
+
+class TestVBoxAPIController:
+    def test_missing_vboxapi(self, monkeypatch):
+        monkeypatch.setitem(__import__("sys").modules, "vboxapi", None)
+        with pytest.raises(VMMControllerException):
+            VBoxAPIController()
+
+    def test_get_vms(self, vbc: VBoxAPIController, manager):
+        machine(manager, "VM2").accessible = False
+        assert vbc.get_vms() == ["VM"]
+
+    def test_start(self, vbc: VBoxAPIController, manager):
+        vbc.start("VM")
+        assert vbc.is_running("VM")
+        assert manager.sessions[0].machine is None
+
+    def test_start_failure(self, vbc: VBoxAPIController, manager):
+        def launch_vm_process(session, name, environment):
+            session.lock(machine(manager, "VM"), constants.LockType_Shared)
+            return Progress(1, "locked")
+
+        machine(manager, "VM").launchVMProcess = launch_vm_process
+        with pytest.raises(VMMControllerException) as ei:
+            vbc.start("VM")
+        assert "locked" in str(ei.value)
+        assert manager.sessions[0].machine is None
+
+    def test_poweroff(self, vbc: VBoxAPIController, manager):
+        vbc.poweroff("VM")
+        session = manager.sessions[0]
+        assert session.lock_type == constants.LockType_Shared
+        assert session.console.powerDown.called
+        assert session.machine is None
+
+    def test_delete(self, vbc: VBoxAPIController, manager):
+        vm = machine(manager, "VM")
+        vm.unregister = Mock(return_value=["disk"])
+        vm.deleteConfig = Mock(return_value=Progress())
+        vbc.delete("VM")
+        vm.unregister.assert_called_with(constants.CleanupMode_DetachAllReturnHardDisksOnly)
+        vm.deleteConfig.assert_called_with(["disk"])
+
+    def test_is_running(self, vbc: VBoxAPIController, manager):
+        machine(manager, "VM").state = constants.MachineState_Running
+        assert vbc.is_running("VM")
+        assert not vbc.is_running("VM2")
+
+    def test_get_inventory(self, vbc: VBoxAPIController, manager):
+        machine(manager, "VM2").state = constants.MachineState_Running
+        assert vbc.get_inventory() == {"VM": False, "VM2": True}
+
+    def test_unknown_vm(self, vbc: VBoxAPIController):
+        with pytest.raises(VMMControllerException) as ei:
+            vbc.is_running("Missing")
+        assert "Missing" in str(ei.value)
+
+    def test_get_macs(self, vbc: VBoxAPIController):
+        assert vbc.get_macs("VM") == [0x080027CA0E5D, 0x0800279104ED]
+
+    def test_get_mac_with_if_id(self, vbc: VBoxAPIController):
+        assert vbc.get_mac("VM") == 0x080027CA0E5D
+        assert vbc.get_mac("VM", if_id=2) == 0x0800279104ED
+
+    def test_get_mac_exception(self, vbc: VBoxAPIController):
+        with pytest.raises(VMMControllerException) as ei:
+            vbc.get_mac("VM", if_id=3)
+        assert "interface 3" in str(ei.value)
+
+    def test_get_vm_info_record(self, vbc: VBoxAPIController, manager):
+        machine(manager, "VM").VRDEServer.getVRDEProperty.return_value = "5001"
+        info = vbc.get_vm_info("VM")
+        assert (info.name, info.running, info.vrde_port) == ("VM", False, 5001)
+        assert info.macs == {1: 0x080027CA0E5D, 2: 0x0800279104ED}
+        assert (info.memory, info.cpus) == (2048, 2)
+
+    def test_get_host_info(self, vbc: VBoxAPIController):
+        assert vbc.get_host_info() == HostInfo(memory=32000, cpus=12)
+
+    def test_set_mac(self, vbc: VBoxAPIController, manager):
+        vbc.set_mac("VM", 0x0800278144CB, if_id=2)
+        vm = machine(manager, "VM")
+        assert vm.adapters[1].MACAddress == "0800278144CB"
+        assert vm.saveSettings.called
+        assert manager.sessions[0].lock_type == constants.LockType_Write
+
+    def test_configure_clone(self, vbc: VBoxAPIController, manager):
+        vbc.configure_clone("VM", macs={2: 0x005056000301, 1: 0x005056000001}, vrde_port=5000)
+        vm = machine(manager, "VM")
+        assert [adapter.MACAddress for adapter in vm.adapters[:2]] == ["005056000001", "005056000301"]
+        vm.VRDEServer.setVRDEProperty.assert_called_with("TCP/Ports", "5000")
+        assert len(manager.sessions) == 1
+        assert vm.saveSettings.call_count == 1
+
+    def test_configure_clone_without_changes(self, vbc: VBoxAPIController, manager):
+        vbc.configure_clone("VM")
+        assert not manager.sessions
+
+    def test_get_snapshots(self, vbc: VBoxAPIController):
+        assert vbc.get_snapshots("VM") == ["clean", "version 2", "imdisk"]
+
+    def test_get_snapshots_when_no_snapshots(self, vbc: VBoxAPIController):
+        assert vbc.get_snapshots("VM2") == []
+
+    def test_create_snapshot(self, vbc: VBoxAPIController, manager):
+        vm = machine(manager, "VM")
+        vm.takeSnapshot = Mock(return_value=(Progress(), "new-id"))
+        vbc.create_snapshot("VM", "Backup")
+        vm.takeSnapshot.assert_called_with("Backup", "", True)
+
+    def test_delete_snapshot(self, vbc: VBoxAPIController, manager):
+        vm = machine(manager, "VM")
+        vm.deleteSnapshot = Mock(return_value=Progress())
+        vbc.delete_snapshot("VM", "imdisk")
+        vm.deleteSnapshot.assert_called_with("imdisk-id")
+
+    def test_delete_missing_snapshot(self, vbc: VBoxAPIController):
+        with pytest.raises(VMMControllerException) as ei:
+            vbc.delete_snapshot("VM2", "imdisk")
+        assert "imdisk" in str(ei.value)
+
+    def test_restore_snapshot(self, vbc: VBoxAPIController, manager):
+        vm = machine(manager, "VM")
+        vm.restoreSnapshot = Mock(return_value=Progress())
+        vbc.restore_snapshot("VM", "version 2")
+        assert vm.restoreSnapshot.call_args[0][0].name == "version 2"
+
+    def test_clone(self, vbc: VBoxAPIController, manager):
+        vm = machine(manager, "VM")
+        vm.cloneTo = Mock(return_value=Progress())
+        vbc.clone("VM", "imdisk", "VMClone")
+        vm.cloneTo.assert_called_once()
+        assert vm.cloneTo.call_args[0][2] == [constants.CloneOptions_Link]
+        assert "VMClone" in vbc.get_vms()
+
+    def test_set_credentials(self, vbc: VBoxAPIController, manager):
+        vbc.set_credentials("VM", "TheUser", "ThePassword", "TheDomain")
+        manager.sessions[0].console.guest.setCredentials.assert_called_with(
+            "TheUser", "ThePassword", "TheDomain", True)
+
+    def test_implements_full_interface(self, vbc: VBoxAPIController):
+        assert not isinstance(vbc, VBoxController)
+        abstract_methods = [
+            "get_vms", "start", "poweroff", "delete", "is_running", "get_macs", "get_mac", "set_mac", "get_snapshots",
+            "create_snapshot", "delete_snapshot", "restore_snapshot", "clone", "set_credentials", "set_vrde_port"]
+        for name in abstract_methods:
+            assert getattr(VBoxAPIController, name) is not getattr(VMMController, name)
+
+    def test_init_other_threads(self, vbc: VBoxAPIController, manager):
+        threads = [threading.Thread(target=vbc.get_vms) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        vbc.get_vms()
+        assert manager.initPerThread.call_count == 2
+
+
+class TestVBoxEventStateWatcher:
+    def test_follow_events(self, vbc: VBoxAPIController, manager):
+        machine(manager, "VM").state = constants.MachineState_Running
+        watcher = VBoxEventStateWatcher(vbc)
+        watcher.event_timeout_ms = 10
+        assert watcher.get_state("VM") == "running"
+        assert watcher.get_state("VM2") == "poweroff"
+        events = manager.vbox.eventSource.events
+        events.put(SimpleNamespace(
+            type=constants.VBoxEventType_OnMachineStateChanged, machineId="VM2-id", state=constants.MachineState_Running))
+        watcher.wait_for_state("VM2", "running", timeout=5)
+        manager.vbox.machines.append(Machine("Clone"))
+        events.put(SimpleNamespace(type=constants.VBoxEventType_OnMachineRegistered, machineId="Clone-id", registered=True))
+        watcher.wait_for_state("Clone", "poweroff", timeout=5)
+        events.put(SimpleNamespace(type=constants.VBoxEventType_OnMachineRegistered, machineId="VM-id", registered=False))
+        watcher.wait_for_state("VM", None, timeout=5)
+        watcher.stop()
+        assert not manager.vbox.eventSource.listeners
+
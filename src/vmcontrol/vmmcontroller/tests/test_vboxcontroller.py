@@ -20,7 +20,8 @@ from unittest.mock import Mock
 
 import pytest
 
-from vmcontrol.vmmcontroller import VBoxController, VMMControllerException
+from vmcontrol.vmmcontroller import VBoxController, VMMControllerException, VMInfo
+from vmcontrol.vmmcontroller.vboxcontroller import parse_vm_info
 
 
 @pytest.fixture()
@@ -81,6 +82,53 @@ class TestVBoxController:
         assert_call(vbc, ["list", "runningvms"])
         assert vms == ["Attacker", "Client", "Company Router"]
 
+    def test_cache_queries(self, vbc: VBoxController):
+        vbc._vboxmanage_execute = Mock(return_value='"VM" {8451900b-320a-43b4-9eb9-9bd6656f33ad}')
+        assert vbc.is_running("VM")
+        assert not vbc.is_running("VM2")
+        assert vbc.get_vms() == vbc.get_vms()
+        assert vbc._vboxmanage_execute.call_count == 2
+
+    def test_invalidate_cache_on_mutation(self, vbc: VBoxController):
+        vbc._vboxmanage_execute = Mock(return_value="")
+        vbc.get_vms()
+        vbc.start("VM")
+        vbc.get_vms()
+        assert vbc._vboxmanage_execute.call_count == 3
+
+    def test_invalidate_cache_on_failed_mutation(self, vbc: VBoxController):
+        def fail_on_poweroff(vbox_vector):
+            if "poweroff" in vbox_vector:
+                raise VMMControllerException()
+            return ""
+
+        vbc._vboxmanage_execute = Mock(side_effect=fail_on_poweroff)
+        vbc.get_vms()
+        with pytest.raises(VMMControllerException):
+            vbc.poweroff("VM")
+        vbc.get_vms()
+        assert vbc._vboxmanage_execute.call_count == 3
+
+    def test_cache_expires(self, vbc: VBoxController):
+        vbc.inventory_ttl = 0
+        vbc._vboxmanage_execute = Mock(return_value="")
+        vbc.get_vms()
+        vbc.get_vms()
+        assert vbc._vboxmanage_execute.call_count == 2
+
+    def test_get_inventory(self, vbc: VBoxController):
+        outputs = {
+            "vms": '"VM1" {8451900b-320a-43b4-9eb9-9bd6656f33ad}\n"VM2" {4d0986c7-eabc-4cd3-a2f3-e28111a66ac1}',
+            "runningvms": '"VM2" {4d0986c7-eabc-4cd3-a2f3-e28111a66ac1}',
+        }
+        vbc._vboxmanage_execute = Mock(side_effect=lambda vbox_vector: outputs[vbox_vector[1]])
+        vbc.get_vms()
+        assert vbc.get_inventory() == {"VM1": False, "VM2": True}
+        # The inventory is always fresh and refreshes the cache
+        assert vbc._vboxmanage_execute.call_count == 3
+        vbc.is_running("VM2")
+        assert vbc._vboxmanage_execute.call_count == 3
+
     def test_get_vm_info(self, vbc: VBoxController):
         vbc._vboxmanage_execute = Mock(return_value=self._some_vbox_info_output())
         info = vbc._get_vm_info("VM")
@@ -89,6 +137,36 @@ class TestVBoxController:
         assert info["macaddress1"] == "080027CA0E5D"
         assert info["IDE-1-0"] == "emptydrive"
 
+    def test_get_vm_info_record(self, vbc: VBoxController):
+        vbc._vboxmanage_execute = Mock(return_value=self._some_vbox_info_output())
+        info = vbc.get_vm_info("Company Router")
+        assert_call(vbc, ["showvminfo", "Company Router", "--machinereadable"])
+        assert isinstance(info, VMInfo)
+        assert (info.name, info.state, info.running, info.vrde_port) == ("Company Router", "poweroff", False, None)
+        assert info.macs == {1: 0x080027CA0E5D, 2: 0x0800279104ED, 3: 0x080027859405, 4: 0x080027D98E94}
+
+    def test_parse_running_vm_with_vrde(self):
+        info = parse_vm_info(['name="VM"', 'VMState="running"', 'macaddress1="080027CA0E5D"', 'vrde="on"',
+                              'vrdeport=5002', 'vrdeports="5002"', 'memory=4096', 'cpus=2'])
+        assert info.running
+        assert info.vrde_port == 5002
+        assert (info.memory, info.cpus) == (4096, 2)
+        assert info.macs == {1: 0x080027CA0E5D}
+
+    def test_get_vm_infos(self, vbc: VBoxController):
+        vbc._vboxmanage_execute = Mock(side_effect=lambda vbox_vector: 'name="{}"\nVMState="running"'.format(
+            vbox_vector[1]))
+        infos = vbc.get_vm_infos(["VM1", "VM2"])
+        assert {vm: info.name for vm, info in infos.items()} == {"VM1": "VM1", "VM2": "VM2"}
+        assert vbc._vboxmanage_execute.call_count == 2
+
+    def test_vm_info_from_dict(self):
+        info = VMInfo(name="VM", state="running", running=True, macs={1: 0x080027CA0E5D}, vrde_port=5000)
+        as_json = {"name": "VM", "state": "running", "running": True, "macs": {"1": 0x080027CA0E5D},
+                   "vrde_port": 5000}
+        assert VMInfo.from_dict(as_json) == info
+        assert VMInfo.from_dict(info._asdict())._asdict() == info._asdict()
+
     def test_get_macs(self, vbc: VBoxController):
         return_value = {
             "macaddress1": "0800278144CB",
@@ -144,6 +222,17 @@ class TestVBoxController:
         vbc.set_mac("VM", new_mac, if_id=2)
         assert_call(vbc, ["modifyvm", "VM", "--macaddress2", "0800278144cb"])
 
+    def test_configure_clone(self, vbc: VBoxController):
+        vbc.configure_clone("VM", macs={2: 0x005056000301, 1: 0x005056000001}, vrde_port=5000)
+        assert_call(
+            vbc,
+            ["modifyvm", "VM", "--macaddress1", "005056000001", "--macaddress2", "005056000301", "--vrdeport", "5000"]
+        )
+
+    def test_configure_clone_without_changes(self, vbc: VBoxController):
+        vbc.configure_clone("VM")
+        assert not vbc._vboxmanage_execute.called
+
     def test_get_snapshots(self, vbc: VBoxController):
         return_value = self._some_snapshot_output()
         vbc._vboxmanage_execute = Mock(return_value=return_value)
@@ -167,6 +256,30 @@ class TestVBoxController:
         snapshots = vbc.get_snapshots(vm_without_snapshot)
         assert snapshots == []
 
+    def test_get_snapshots_many(self, vbc: VBoxController):
+        vbc._vboxmanage_execute = Mock(return_value=self._some_snapshot_output())
+        snapshots = vbc.get_snapshots_many(["VM1", "VM2"])
+        vbc._vboxmanage_execute.assert_any_call(["snapshot", "VM1", "list", "--machinereadable"])
+        vbc._vboxmanage_execute.assert_any_call(["snapshot", "VM2", "list", "--machinereadable"])
+        assert set(snapshots) == {"VM1", "VM2"}
+        assert "version 2" in snapshots["VM2"]
+
+    def test_create_snapshots(self, vbc: VBoxController):
+        vbc.create_snapshots({"VM1": "Backup", "VM2": "Backup0"})
+        vbc._vboxmanage_execute.assert_any_call(["snapshot", "VM1", "take", "Backup"])
+        vbc._vboxmanage_execute.assert_any_call(["snapshot", "VM2", "take", "Backup0"])
+
+    def test_create_snapshots_collects_failures(self, vbc: VBoxController):
+        def fail_for_vm2(vbox_vector):
+            if "VM2" in vbox_vector:
+                raise VMMControllerException("locked")
+
+        vbc._vboxmanage_execute = Mock(side_effect=fail_for_vm2)
+        with pytest.raises(VMMControllerException) as ei:
+            vbc.create_snapshots({"VM1": "Backup", "VM2": "Backup", "VM3": "Backup"})
+        assert "VM2: locked" in str(ei.value)
+        vbc._vboxmanage_execute.assert_any_call(["snapshot", "VM3", "take", "Backup"])
+
     def test_create_snapshot(self, vbc: VBoxController):
         vbc.create_snapshot("VM", "Snapshot")
         assert_call(vbc, ["snapshot", "VM", "take", "Snapshot"])
@@ -185,6 +298,10 @@ class TestVBoxController:
             vbc, ["clonevm", "VM", "--name", "VMClone", "--options", "link", "--snapshot", "Snapshot", "--register"]
         )
 
+    def test_full_clone(self, vbc: VBoxController):
+        vbc.clone("VM", "Snapshot", "VMClone", linked=False)
+        assert_call(vbc, ["clonevm", "VM", "--name", "VMClone", "--snapshot", "Snapshot", "--register"])
+
     def test_set_credentials(self, vbc: VBoxController):
         vbc.set_credentials("VM", "TheUser", "ThePassword", "TheDomain")
         assert_call(vbc, ["controlvm", "VM", "setcredentials", "TheUser", "ThePassword", "TheDomain"])
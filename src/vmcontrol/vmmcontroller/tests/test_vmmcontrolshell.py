@@ -56,6 +56,7 @@ class VMMControllerStub(VMMController):
     poweroff = Mock()
     delete = Mock()
     is_running = Mock()
+    get_inventory = Mock(return_value={"VM": True})
     get_macs = Mock()
     get_mac = Mock()
     set_mac = Mock()
@@ -77,6 +78,7 @@ class ExceptionRaisingVMMController(VMMController):
     poweroff = Mock(side_effect=raise_vm_controller_exception)
     delete = Mock(side_effect=raise_vm_controller_exception)
     is_running = Mock(side_effect=raise_vm_controller_exception)
+    get_inventory = Mock(side_effect=raise_vm_controller_exception)
     get_macs = Mock(side_effect=raise_vm_controller_exception)
     get_mac = Mock(side_effect=raise_vm_controller_exception)
     set_mac = Mock(side_effect=raise_vm_controller_exception)
@@ -119,6 +121,10 @@ class TestVMControlShell:
         shell.do_is_running(arg)
         shell.vmmc.is_running.assert_called_with(vm="VM")
 
+    def test_get_inventory(self, shell: VMMConsole):
+        shell.do_get_inventory("")
+        assert shell.vmmc.get_inventory.called
+
     def test_get_macs(self, shell: VMMConsole):
         arg = "VM"
         shell.do_get_macs(arg)
@@ -167,7 +173,9 @@ class TestVMControlShell:
     def test_clone(self, shell: VMMConsole):
         arg = "VM Snapshot CloneVM"
         shell.do_clone(arg)
-        shell.vmmc.clone.assert_called_with(vm="VM", snapshot="Snapshot", clone="CloneVM")
+        shell.vmmc.clone.assert_called_with(vm="VM", snapshot="Snapshot", clone="CloneVM", linked=True)
+        shell.do_clone(arg + " full")
+        shell.vmmc.clone.assert_called_with(vm="VM", snapshot="Snapshot", clone="CloneVM", linked=False)
 
     def test_set_credentials(self, shell: VMMConsole):
         arg = "VM \"user\" password domain"
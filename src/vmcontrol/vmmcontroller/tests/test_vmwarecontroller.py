@@ -0,0 +1,374 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+from pyVmomi import vim
+
+from vmcontrol.vmmcontroller import VMMControllerException
+from vmcontrol.vmmcontroller.vmwarecontroller import VSphereStateWatcher, VSphereInventory, VSphereTaskTracker, \
+    VMWareController, ESXiServer
+
+
+def object_update(obj, kind="modify", **changes):
+    # obj is a managed object or just its id
+    if isinstance(obj, str):
+        obj = SimpleNamespace(_moId=obj)
+    change_set = [SimpleNamespace(name=name.replace("__", "."), val=val) for name, val in changes.items()]
+    return SimpleNamespace(obj=obj, kind=kind, changeSet=change_set)
+
+
+def update_set(*object_updates):
+    return SimpleNamespace(filterSet=[SimpleNamespace(objectSet=list(object_updates))])
+
+
+class TestVSphereStateWatcher:
+    def test_apply_update_sets(self):
+        watcher = VSphereStateWatcher(vmware_controller=None)
+        watcher.apply_update_set(update_set(
+            object_update("vm-1", kind="enter", name="Attacker", runtime__powerState="poweredOn"),
+            object_update("vm-2", kind="enter", name="Client", runtime__powerState="poweredOff"),
+        ), initial=True)
+        assert watcher.states == {"Attacker": "running", "Client": "poweroff"}
+        watcher.apply_update_set(update_set(
+            object_update("vm-2", runtime__powerState="suspended"),
+            object_update("vm-1", kind="leave"),
+        ))
+        assert watcher.states == {"Client": "saved"}
+
+
+class FakeCollector:
+    def __init__(self, update_sets):
+        self.update_sets = list(update_sets)
+        self.versions = list()
+
+    def WaitForUpdatesEx(self, version, options):
+        self.versions.append(version)
+        return self.update_sets.pop(0) if self.update_sets else None
+
+
+def versioned(update_set, version, truncated=False):
+    update_set.version = version
+    update_set.truncated = truncated
+    return update_set
+
+
+class TestVSphereInventory:
+    def build_inventory(self):
+        inventory = VSphereInventory(content=None, container=None, types=[vim.Datacenter, vim.Folder])
+        self.data_center = vim.Datacenter("datacenter-1")
+        self.vm_folder = vim.Folder("group-v1")
+        inventory.apply_update_set(update_set(
+            object_update(self.data_center, kind="enter", name="DC", parent=None),
+            object_update(self.vm_folder, kind="enter", name="vm", parent=self.data_center),
+            object_update(vim.Folder("group-v2"), kind="enter", name="SOCBED", parent=self.vm_folder),
+            object_update(vim.Folder("group-v3"), kind="enter", name="SOCBED", parent=None),
+        ))
+        return inventory
+
+    def test_names(self):
+        inventory = self.build_inventory()
+        assert inventory.names(vim.Datacenter) == {"DC": self.data_center}
+        assert set(inventory.names(vim.Folder)) == {"vm", "SOCBED"}
+
+    def test_find(self):
+        inventory = self.build_inventory()
+        assert inventory.find(vim.Datacenter, "DC") == self.data_center
+        assert inventory.find(vim.Folder, "DC") is None
+        assert inventory.find(vim.Folder, "SOCBED", ancestor=self.data_center) == vim.Folder("group-v2")
+
+    def test_updates(self):
+        inventory = self.build_inventory()
+        inventory.apply_update_set(update_set(
+            object_update(vim.Folder("group-v2"), name="Renamed"),
+            object_update(vim.Folder("group-v3"), kind="leave"),
+        ))
+        assert inventory.find(vim.Folder, "SOCBED") is None
+        assert inventory.find(vim.Folder, "Renamed", ancestor=self.data_center) == vim.Folder("group-v2")
+
+    def test_add_and_remove(self):
+        inventory = self.build_inventory()
+        inventory.add(vim.Folder("group-v4"), "New", parent=self.vm_folder)
+        assert inventory.find(vim.Folder, "New", ancestor=self.data_center) == vim.Folder("group-v4")
+        inventory.remove(vim.Folder("group-v4"))
+        assert inventory.find(vim.Folder, "New") is None
+
+    def test_wait_for_property(self):
+        inventory = VSphereInventory(content=None, container=None, types=[vim.VirtualMachine],
+                                     properties=["guest.guestOperationsReady"])
+        vm_obj = vim.VirtualMachine("vm-1")
+        inventory.apply_update_set(update_set(
+            object_update(vm_obj, kind="enter", name="ClientClone1", guest__guestOperationsReady=False)))
+        assert not inventory.wait_for(vm_obj, "guest.guestOperationsReady", True, timeout=0)
+        threading.Timer(0.05, lambda: inventory.apply_update_set(update_set(
+            object_update(vm_obj, guest__guestOperationsReady=True)))).start()
+        assert inventory.wait_for(vm_obj, "guest.guestOperationsReady", True, timeout=5)
+
+    def test_truncated_update_sets_are_collected(self):
+        inventory = VSphereInventory(content=None, container=None, types=[vim.VirtualMachine])
+        inventory._collector = FakeCollector([
+            versioned(update_set(object_update(vim.VirtualMachine("vm-1"), kind="enter", name="Client")), "1",
+                      truncated=True),
+            versioned(update_set(object_update(vim.VirtualMachine("vm-2"), kind="enter", name="Attacker")), "2"),
+        ])
+        inventory._collect(maxWaitSeconds=0)
+        assert inventory._collector.versions == ["", "1"]
+        assert set(inventory.names(vim.VirtualMachine)) == {"Client", "Attacker"}
+
+
+class IdleCollector:
+    def __init__(self):
+        self.filters = list()
+
+    def CreateFilter(self, filter_spec, partialUpdates):
+        filter_ = SimpleNamespace(spec=filter_spec, destroyed=False)
+        filter_.Destroy = lambda: setattr(filter_, "destroyed", True)
+        self.filters.append(filter_)
+        return filter_
+
+    def WaitForUpdatesEx(self, version, options):
+        time.sleep(0.01)
+        return None
+
+    def Destroy(self):
+        pass
+
+
+@pytest.fixture()
+def tracker():
+    collector = IdleCollector()
+    content = SimpleNamespace(propertyCollector=SimpleNamespace(CreatePropertyCollector=lambda: collector))
+    tracker = VSphereTaskTracker(content)
+    yield tracker
+    tracker.stop()
+
+
+def task_update(moid, state, result=None, error=None):
+    return update_set(object_update(vim.Task(moid), info__state=state, info__result=result, info__error=error))
+
+
+class TestVSphereTaskTracker:
+    def test_success(self, tracker: VSphereTaskTracker):
+        future = tracker.track(vim.Task("task-1"))
+        tracker.apply_update_set(task_update("task-1", "running"))
+        assert not future.done()
+        tracker.apply_update_set(task_update("task-1", "success", result="vm-9"))
+        assert future.result(timeout=1) == "vm-9"
+        assert tracker._collector.filters[0].destroyed
+
+    def test_error(self, tracker: VSphereTaskTracker):
+        future = tracker.submit(lambda name: vim.Task(name), "task-1")
+        tracker.apply_update_set(task_update("task-1", "error", error="disk full"))
+        with pytest.raises(VMMControllerException) as ei:
+            future.result(timeout=1)
+        assert "disk full" in str(ei.value)
+
+    def test_execute_many(self, tracker: VSphereTaskTracker):
+        def finish():
+            time.sleep(0.05)
+            tracker.apply_update_set(update_set(
+                object_update(vim.Task("task-1"), info__state="success", info__result="done"),
+                object_update(vim.Task("task-2"), info__state="error", info__error="locked"),
+            ))
+
+        def fail_to_start():
+            raise VMMControllerException("not started")
+
+        threading.Thread(target=finish).start()
+        results = tracker.execute_many(
+            {"VM_One": lambda: vim.Task("task-1"), "VM_Two": lambda: vim.Task("task-2"), "VM": fail_to_start})
+        assert [result.key for result in results] == ["VM_One", "VM_Two", "VM"]
+        assert results[0].value == "done"
+        assert "locked" in str(results[1].error)
+        assert "not started" in str(results[2].error)
+
+    def test_pending_tasks_fail_when_stopped(self, tracker: VSphereTaskTracker):
+        future = tracker.track(vim.Task("task-1"))
+        tracker.stop()
+        with pytest.raises(VMMControllerException):
+            future.result(timeout=1)
+
+
+def network_adapter(if_id):
+    return vim.vm.device.VirtualVmxnet3(
+        key=4000 + if_id, deviceInfo=vim.Description(label="Network adapter {}".format(if_id), summary=""))
+
+
+@pytest.fixture()
+def vmwc():
+    # Controller without a connection, all lookups and tasks are mocked
+    vmwc = VMWareController.__new__(VMWareController)
+    vmwc.si = None
+    vmwc.esxi = ESXiServer(resource_pool="SOCBED", data_center="DC", data_store="DS", vm_folder="SOCBED")
+    vm_obj = Mock()
+    vm_obj.config.hardware.device = [network_adapter(1), network_adapter(2)]
+    vmwc._vm_obj = Mock(return_value=vm_obj)
+    vmwc._snapshot_obj = Mock(return_value=vim.vm.Snapshot("snapshot-1"))
+    vmwc._snapshot_devices = Mock(return_value=[network_adapter(1), network_adapter(2)])
+    vmwc._vm_folder_obj = Mock(return_value=vim.Folder("group-v2"))
+    vmwc._data_store_obj = Mock(return_value=vim.Datastore("datastore-1"))
+    vmwc._resource_pool_obj = Mock(return_value=vim.ResourcePool("resgroup-1"))
+    vmwc._vmware_execute_task = Mock(return_value=None)
+    return vmwc
+
+
+def executed_task(vmwc):
+    assert vmwc._vmware_execute_task.call_count == 1
+    args, kwargs = vmwc._vmware_execute_task.call_args
+    return args[0], kwargs
+
+
+def macs_of(device_changes):
+    return [change.device.macAddress for change in device_changes]
+
+
+def options_of(option_values):
+    return {option.key: option.value for option in option_values}
+
+
+vnc_options = {"RemoteDisplay.vnc.enabled": "true", "RemoteDisplay.vnc.port": "5000"}
+
+
+class TestCloneAndConfigure:
+    def test_clone_is_configured_at_clone_time(self, vmwc: VMWareController):
+        vmwc.clone_and_configure("Client", "Snap", "ClientClone1", macs={1: 0x005056000001, 2: 0x005056000201},
+                                 vrde_port=5000)
+        function, kwargs = executed_task(vmwc)
+        assert function == vmwc._vm_obj.return_value.Clone
+        assert kwargs["name"] == "ClientClone1"
+        assert kwargs["spec"].location.diskMoveType == "createNewChildDiskBacking"
+        assert macs_of(kwargs["spec"].config.deviceChange) == ["00:50:56:00:00:01", "00:50:56:00:02:01"]
+        assert options_of(kwargs["spec"].config.extraConfig) == vnc_options
+
+    def test_missing_network_adapter(self, vmwc: VMWareController):
+        with pytest.raises(VMMControllerException):
+            vmwc.clone_and_configure("Client", "Snap", "ClientClone1", macs={3: 0x005056000001})
+
+    def test_full_clone_without_configuration(self, vmwc: VMWareController):
+        vmwc.clone_and_configure("Client", "Snap", "ClientClone1", linked=False)
+        function, kwargs = executed_task(vmwc)
+        assert function == vmwc._vm_obj.return_value.Clone
+        assert kwargs["spec"].location.diskMoveType == "moveAllDiskBackingsAndDisallowSharing"
+        assert kwargs["spec"].config is None
+
+
+class TestReconfiguration:
+    def test_clone_is_configured_with_one_task(self, vmwc: VMWareController):
+        vmwc.configure_clone("ClientClone1", macs={1: 0x005056000001, 2: 0x005056000201}, vrde_port=5000)
+        function, kwargs = executed_task(vmwc)
+        assert function == vmwc._vm_obj.return_value.ReconfigVM_Task
+        assert macs_of(kwargs["spec"].deviceChange) == ["00:50:56:00:00:01", "00:50:56:00:02:01"]
+        assert options_of(kwargs["spec"].extraConfig) == vnc_options
+
+    def test_nothing_to_configure(self, vmwc: VMWareController):
+        vmwc.configure_clone("ClientClone1")
+        assert not vmwc._vmware_execute_task.called
+
+    def test_set_vrde_port(self, vmwc: VMWareController):
+        vmwc.set_vrde_port("ClientClone1", 5000)
+        function, kwargs = executed_task(vmwc)
+        assert kwargs["spec"].deviceChange == []
+        assert options_of(kwargs["spec"].extraConfig) == vnc_options
+
+
+class GuestInventory:
+    # Guests become ready after the given delays, None means never
+    def __init__(self, delays):
+        self.delays = delays
+        self.content = SimpleNamespace(guestOperationsManager=SimpleNamespace(processManager=Mock()))
+
+    def wait_for(self, obj, path, value, timeout=None):
+        delay = self.delays[obj]
+        if delay is None or delay > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(delay)
+        return True
+
+
+class TestSetCredentials:
+    def build_controller(self, vmwc, delays):
+        inventory = GuestInventory(delays)
+        vmwc._vm_obj = lambda vm: vm
+        vmwc._inventories = lambda: (None, inventory)
+        return inventory.content.guestOperationsManager.processManager
+
+    def test_clones_wait_concurrently(self, vmwc: VMWareController):
+        vms = ["ClientClone{}".format(i) for i in range(1, 11)]
+        process_manager = self.build_controller(vmwc, {vm: 0.2 for vm in vms})
+        start = time.monotonic()
+        vmwc.set_credentials_many({vm: ("client1", "breach", "BREACH") for vm in vms}, timeout=5)
+        assert time.monotonic() - start < 1
+        assert sorted(call[0][0] for call in process_manager.StartProgramInGuest.call_args_list) == sorted(vms)
+
+    def test_common_timeout(self, vmwc: VMWareController):
+        process_manager = self.build_controller(vmwc, {"ClientClone1": 0, "ClientClone2": None})
+        with pytest.raises(VMMControllerException) as ei:
+            vmwc.set_credentials_many({vm: ("client", "breach", "BREACH") for vm in ["ClientClone1", "ClientClone2"]},
+                                      timeout=0.1)
+        assert "ClientClone2" in str(ei.value)
+        assert "ClientClone1" not in str(ei.value)
+        assert process_manager.StartProgramInGuest.call_count == 1
+
+    def test_unavailable_guest_operations_are_retried(self, vmwc: VMWareController):
+        process_manager = self.build_controller(vmwc, {"ClientClone1": 0})
+        process_manager.StartProgramInGuest.side_effect = [vim.fault.GuestOperationsUnavailable(), None]
+        vmwc.guest_operations_retry_interval = 0
+        vmwc.set_credentials("ClientClone1", "client1", "breach", "BREACH")
+        assert process_manager.StartProgramInGuest.call_count == 2
+
+
+class TestIndexedVMInfo:
+    def build_controller(self, vmwc):
+        # Real managed objects without a connection, any property read from them would fail
+        self.vm_obj = vim.VirtualMachine("vm-1")
+        inventory = VSphereInventory(content=None, container=None, types=[vim.VirtualMachine],
+                                     properties=VMWareController.vm_inventory_properties)
+        inventory.apply_update_set(update_set(object_update(
+            self.vm_obj, kind="enter", name="ClientClone1", runtime__powerState="poweredOff",
+            config__hardware__device=[network_adapter(1)], config__hardware__memoryMB=4096,
+            config__hardware__numCPU=2)))
+        vmwc._inventories = lambda: (None, inventory)
+        vmwc._vm_obj = lambda vm: self.vm_obj
+        return inventory
+
+    def test_get_inventory(self, vmwc: VMWareController):
+        self.build_controller(vmwc)
+        assert vmwc.get_inventory() == {"ClientClone1": False}
+
+    def test_get_vm_infos(self, vmwc: VMWareController):
+        self.build_controller(vmwc)
+        network_adapter_1 = network_adapter(1)
+        network_adapter_1.macAddress = "00:50:56:00:00:01"
+        vmwc._inventories()[1].set_property(self.vm_obj, "config.hardware.device", [network_adapter_1])
+        info = vmwc.get_vm_infos(["ClientClone1"])["ClientClone1"]
+        assert (info.name, info.state, info.running) == ("ClientClone1", "poweroff", False)
+        assert (info.macs, info.memory, info.cpus) == ({1: 0x005056000001}, 4096, 2)
+        with pytest.raises(VMMControllerException):
+            vmwc.get_vm_infos(["Missing"])
+
+    def test_power_state_of_own_tasks(self, vmwc: VMWareController):
+        self.build_controller(vmwc)
+        vmwc._vmware_execute_task = lambda function, on_success=None: on_success(None)
+        vmwc.start("ClientClone1")
+        assert vmwc.get_inventory() == {"ClientClone1": True}
+        vmwc.poweroff("ClientClone1")
+        assert vmwc.get_vm_info("ClientClone1").state == "poweroff"
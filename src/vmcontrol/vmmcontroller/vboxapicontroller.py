@@ -0,0 +1,276 @@
+# Copyright 2016-2022 Fraunhofer FKIE
+#
+# This file is part of SOCBED.
+#
+# SOCBED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SOCBED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from contextlib import contextmanager
+
+from vmcontrol.statewatcher import StateWatcher
+from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController, \
+    VMInfo, HostInfo
+
+
+class VBoxAPIController(VMMController):
+    # Talks to VBoxSVC through one long-lived connection of the VirtualBox Python API (vboxapi, shipped with the
+    # VirtualBox SDK) instead of spawning a vboxmanage process per call.
+    max_parallel_operations = 8
+
+    def __init__(self, manager=None):
+        self.manager = manager or self._connect()
+        self.vbox = self.manager.getVirtualBox()
+        self.const = self.manager.constants
+        self._main_thread = threading.get_ident()
+        self._initialized_threads = threading.local()
+
+    @staticmethod
+    def _connect():
+        try:
+            from vboxapi import VirtualBoxManager
+        except ImportError:
+            raise VMMControllerException("VirtualBox Python API (vboxapi) not found, install the VirtualBox SDK")
+        return VirtualBoxManager(None, None)
+
+    def get_vms(self):
+        with self._api():
+            return [machine.name for machine in self._machines() if machine.accessible]
+
+    def start(self, vm):
+        with self._api():
+            session = self.manager.getSessionObject()
+            # launchVMProcess locks the session once it returns
+            progress = self._machine(vm).launchVMProcess(session, "headless", [])
+            try:
+                self._wait(progress)
+            finally:
+                session.unlockMachine()
+
+    def poweroff(self, vm):
+        with self._api(), self._locked(vm, self.const.LockType_Shared) as session:
+            self._wait(session.console.powerDown())
+
+    def delete(self, vm):
+        with self._api():
+            machine = self._machine(vm)
+            media = machine.unregister(self.const.CleanupMode_DetachAllReturnHardDisksOnly)
+            self._wait(machine.deleteConfig(media))
+
+    def is_running(self, vm):
+        with self._api():
+            return self._is_online(self._machine(vm))
+
+    def get_inventory(self):
+        with self._api():
+            return {machine.name: self._is_online(machine) for machine in self._machines() if machine.accessible}
+
+    def get_macs(self, vm):
+        with self._api():
+            return [int(adapter.MACAddress, 16) for adapter in self._adapters(self._machine(vm)) if adapter.enabled]
+
+    def get_mac(self, vm, if_id=1):
+        with self._api():
+            adapters = self._adapters(self._machine(vm))
+            if not 0 < if_id <= len(adapters) or not adapters[if_id - 1].enabled:
+                raise VMMControllerException(
+                    'Cannot find MAC address for interface {if_id} on VM "{vm}"'.format(if_id=if_id, vm=vm)
+                )
+            return int(adapters[if_id - 1].MACAddress, 16)
+
+    def get_vm_info(self, vm):
+        with self._api():
+            machine = self._machine(vm)
+            running = self._is_online(machine)
+            macs = {slot + 1: int(adapter.MACAddress, 16)
+                    for slot, adapter in enumerate(self._adapters(machine)) if adapter.enabled}
+            port = machine.VRDEServer.getVRDEProperty("TCP/Ports")
+            return VMInfo(name=machine.name, state="running" if running else "poweroff", running=running, macs=macs,
+                          vrde_port=int(port) if port.isdigit() else None, memory=machine.memorySize,
+                          cpus=machine.CPUCount)
+
+    def get_host_info(self):
+        with self._api():
+            host = self.vbox.host
+            return HostInfo(memory=host.memorySize, cpus=host.processorCount)
+
+    def set_mac(self, vm, mac, if_id=1):
+        self.configure_clone(vm, macs={if_id: mac})
+
+    def set_vrde_port(self, vm, port):
+        self.configure_clone(vm, vrde_port=port)
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        if not macs and vrde_port is None:
+            return
+        with self._api(), self._locked(vm, self.const.LockType_Write) as session:
+            machine = session.machine
+            for if_id, mac in sorted((macs or dict()).items()):
+                machine.getNetworkAdapter(if_id - 1).MACAddress = hex(mac)[2:].upper().rjust(12, "0")
+            if vrde_port is not None:
+                machine.VRDEServer.setVRDEProperty("TCP/Ports", str(vrde_port))
+            machine.saveSettings()
+
+    def get_snapshots(self, vm):
+        with self._api():
+            machine = self._machine(vm)
+            if not machine.snapshotCount:
+                return list()
+            snapshots = list()
+            pending = [machine.findSnapshot("")]
+            while pending:
+                snapshot = pending.pop(0)
+                snapshots.append(snapshot.name)
+                pending.extend(self.manager.getArray(snapshot, "children"))
+            return snapshots
+
+    def create_snapshot(self, vm, snapshot):
+        with self._api(), self._locked(vm, self.const.LockType_Shared) as session:
+            result = session.machine.takeSnapshot(snapshot, "", True)
+            # Newer API versions also return the id of the new snapshot
+            self._wait(result[0] if isinstance(result, (tuple, list)) else result)
+
+    def delete_snapshot(self, vm, snapshot):
+        with self._api(), self._locked(vm, self.const.LockType_Shared) as session:
+            snapshot_obj = self._snapshot(vm, snapshot)
+            self._wait(session.machine.deleteSnapshot(snapshot_obj.id))
+
+    def restore_snapshot(self, vm, snapshot):
+        with self._api(), self._locked(vm, self.const.LockType_Shared) as session:
+            snapshot_obj = self._snapshot(vm, snapshot)
+            self._wait(session.machine.restoreSnapshot(snapshot_obj))
+
+    def clone(self, vm, snapshot, clone, linked=True):
+        with self._api():
+            source = self._snapshot(vm, snapshot).machine
+            clone_machine = self.vbox.createMachine("", clone, [], source.OSTypeId, "")
+            options = [self.const.CloneOptions_Link] if linked else list()
+            self._wait(source.cloneTo(clone_machine, self.const.CloneMode_MachineState, options))
+            clone_machine.saveSettings()
+            self.vbox.registerMachine(clone_machine)
+
+    def set_credentials(self, vm, user, password, domain):
+        with self._api(), self._locked(vm, self.const.LockType_Shared) as session:
+            session.console.guest.setCredentials(user, password, domain, True)
+
+    @contextmanager
+    def _api(self):
+        # Every thread other than the one holding the connection has to register with XPCOM/COM once
+        if threading.get_ident() != self._main_thread and not getattr(self._initialized_threads, "done", False):
+            self.manager.initPerThread()
+            self._initialized_threads.done = True
+        try:
+            yield
+        except VMMControllerException:
+            raise
+        except Exception as e:
+            raise VMMControllerException("VirtualBox API error: {e}".format(e=e))
+
+    @contextmanager
+    def _locked(self, vm, lock_type):
+        session = self.manager.getSessionObject()
+        self._machine(vm).lockMachine(session, lock_type)
+        try:
+            yield session
+        finally:
+            session.unlockMachine()
+
+    def _machines(self):
+        return self.manager.getArray(self.vbox, "machines")
+
+    def _machine(self, vm):
+        try:
+            return self.vbox.findMachine(vm)
+        except Exception:
+            raise VMMControllerException('No VM named "{vm}" found'.format(vm=vm))
+
+    def _snapshot(self, vm, snapshot):
+        try:
+            return self._machine(vm).findSnapshot(snapshot)
+        except VMMControllerException:
+            raise
+        except Exception:
+            raise VMMControllerException('No snapshot named "{snap}" on "{vm}"'.format(snap=snapshot, vm=vm))
+
+    def _adapters(self, machine):
+        count = self.vbox.systemProperties.getMaxNetworkAdapters(machine.chipsetType)
+        return [machine.getNetworkAdapter(slot) for slot in range(count)]
+
+    def _is_online(self, machine):
+        return self.const.MachineState_FirstOnline <= machine.state <= self.const.MachineState_LastOnline
+
+    @staticmethod
+    def _wait(progress):
+        progress.waitForCompletion(-1)
+        if progress.resultCode != 0:
+            raise VMMControllerException(progress.errorInfo.text)
+
+
+class LoggingVBoxAPIController(LoggingVMMController, VBoxAPIController):
+    pass
+
+
+class VBoxEventStateWatcher(StateWatcher):
+    # Listens to machine state and registration events of VBoxSVC instead of polling
+    event_timeout_ms = 500
+
+    def __init__(self, vbox_api_controller: VBoxAPIController):
+        super().__init__()
+        self.vbc = vbox_api_controller
+        self._names = dict()
+
+    def watch(self):
+        manager, const = self.vbc.manager, self.vbc.const
+        manager.initPerThread()
+        event_source = self.vbc.vbox.eventSource
+        listener = event_source.createListener()
+        event_types = [const.VBoxEventType_OnMachineStateChanged, const.VBoxEventType_OnMachineRegistered]
+        event_source.registerListener(listener, event_types, False)
+        try:
+            # Registered before taking the initial picture, so no change can slip through in between
+            machines = [machine for machine in self.vbc._machines() if machine.accessible]
+            self._names = {machine.id: machine.name for machine in machines}
+            self.update_all({machine.name: self._state(machine.state) for machine in machines})
+            while not self.stopping:
+                event = event_source.getEvent(listener, self.event_timeout_ms)
+                if event is None:
+                    continue
+                try:
+                    self._handle_event(event)
+                finally:
+                    event_source.eventProcessed(listener, event)
+        finally:
+            event_source.unregisterListener(listener)
+            manager.deinitPerThread()
+
+    def _handle_event(self, event):
+        manager, const = self.vbc.manager, self.vbc.const
+        if event.type == const.VBoxEventType_OnMachineStateChanged:
+            state_event = manager.queryInterface(event, "IMachineStateChangedEvent")
+            name = self._names.get(state_event.machineId)
+            if name is not None:
+                self.update(name, self._state(state_event.state))
+        elif event.type == const.VBoxEventType_OnMachineRegistered:
+            registered_event = manager.queryInterface(event, "IMachineRegisteredEvent")
+            if registered_event.registered:
+                machine = self.vbc.vbox.findMachine(registered_event.machineId)
+                self._names[machine.id] = machine.name
+                self.update(machine.name, self._state(machine.state))
+            else:
+                self.update(self._names.pop(registered_event.machineId, None), None)
+
+    def _state(self, machine_state):
+        const = self.vbc.const
+        return "running" if const.MachineState_FirstOnline <= machine_state <= const.MachineState_LastOnline \
+            else "poweroff"
+
@@ -16,33 +16,83 @@
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+import threading
+import time
 from subprocess import Popen, PIPE
 
-from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController
+from vmcontrol.vmmcontroller.asyncvmmcontroller import AsyncVMMController
+from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController, VMInfo
+
+
+# VMState values of "showvminfo --machinereadable" for which "list runningvms" lists a VM
+running_states = ("running", "paused", "stuck", "teleporting", "livesnapshotting", "starting", "stopping",
+                  "saving", "restoring", "teleportingpausedvm", "teleportingin", "onlinesnapshotting")
+
+
+def parse_vm_info(lines, vm=None):
+    # Single pass over the machine readable output, keeping only what goes into the record
+    vm_info = VMInfo(name=vm)
+    name_seen = False
+    for line in lines:
+        key, sep, value = line.partition("=")
+        if not sep:
+            continue
+        key = key.strip('"')
+        value = value.strip('"')
+        if key == "name" and not name_seen:
+            vm_info.name = value
+            name_seen = True
+        elif key == "VMState":
+            vm_info.state = value
+            vm_info.running = value in running_states
+        elif key.startswith("macaddress") and key[len("macaddress"):].isdigit():
+            vm_info.macs[int(key[len("macaddress"):])] = int(value, 16)
+        elif key in ("vrdeport", "vrdeports") and vm_info.vrde_port is None and value.isdigit():
+            vm_info.vrde_port = int(value)
+        elif key == "memory" and value.isdigit():
+            vm_info.memory = int(value)
+        elif key == "cpus" and value.isdigit():
+            vm_info.cpus = int(value)
+    return vm_info
 
 
 class VBoxController(VMMController):
+    max_parallel_operations = 8
+    # Seconds for which results of "list" and "showvminfo" are reused, our own mutations invalidate them at once
+    inventory_ttl = 2.0
+
+    def __init__(self):
+        self._cache = dict()
+        self._cache_generation = 0
+        self._cache_lock = threading.Lock()
+
     def get_vms(self):
         vbox_vector = ["list", "vms"]
-        out = self._vboxmanage_execute(vbox_vector)
+        out = self._query(vbox_vector)
         vms = self._vm_string_to_list(out)
         return vms
 
     def start(self, vm):
         vbox_vector = ["startvm", vm, "--type", "headless"]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
 
     def poweroff(self, vm):
         vbox_vector = ["controlvm", vm, "poweroff"]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
 
     def delete(self, vm):
         vbox_vector = ["unregistervm", vm, "--delete"]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
 
     def is_running(self, vm):
         return vm in self._get_running_vms()
 
+    def get_inventory(self):
+        vms = self._vm_string_to_list(self._query(["list", "vms"], max_age=0))
+        running_vms = self._vm_string_to_list(self._query(["list", "runningvms"], max_age=0))
+        return {vm: vm in running_vms for vm in vms}
+
     def get_macs(self, vm):
         vm_info = self._get_vm_info(vm)
         macs = [int(value, 16) for key, value in vm_info.items() if key.startswith("macaddress")]
@@ -59,10 +109,15 @@ class VBoxController(VMMController):
         mac = int(mac_string, 16)
         return mac
 
+    def get_vm_info(self, vm):
+        vbox_vector = ["showvminfo", vm, "--machinereadable"]
+        out = self._query(vbox_vector)
+        return parse_vm_info(out.splitlines(), vm=vm)
+
     def set_mac(self, vm, mac, if_id=1):
         mac_string = hex(mac)[2:].rjust(12, "0")
         vbox_vector = ["modifyvm", vm, "--macaddress" + str(if_id), mac_string]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
 
     def get_snapshots(self, vm):
         vbox_vector = ["snapshot", vm, "list", "--machinereadable"]
@@ -78,30 +133,24 @@ class VBoxController(VMMController):
                 # vm does not exist. Hence: there is a real error
                 raise e
         else:
-            out_lines = out.splitlines()
-            snapshot_lines = filter(lambda line: "=" in line, out_lines)
-            snapshots = [
-                value.strip('"')
-                for key, value in map(lambda line: line.split("=", maxsplit=1), snapshot_lines)
-                if key.strip('"').startswith("SnapshotName")
-            ]
+            snapshots = self._parse_snapshots(out)
         return snapshots
 
     def create_snapshot(self, vm, snapshot):
         vbox_vector = ["snapshot", vm, "take", snapshot]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
 
     def delete_snapshot(self, vm, snapshot):
         vbox_vector = ["snapshot", vm, "delete", snapshot]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
 
     def restore_snapshot(self, vm, snapshot):
         vbox_vector = ["snapshot", vm, "restore", snapshot]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
 
-    def clone(self, vm, snapshot, clone):
-        vbox_vector = ["clonevm", vm, "--name", clone, "--options", "link", "--snapshot", snapshot, "--register"]
-        self._vboxmanage_execute(vbox_vector)
+    def clone(self, vm, snapshot, clone, linked=True):
+        vbox_vector = self._clone_vector(vm, snapshot, clone, linked)
+        self._modify(vbox_vector)
 
     def set_credentials(self, vm, user, password, domain):
         vbox_vector = ["controlvm", vm, "setcredentials", user, password, domain]
@@ -109,22 +158,38 @@ class VBoxController(VMMController):
 
     def set_vrde_port(self, vm, port):
         vbox_vector = ["modifyvm", vm, "--vrdeport", str(port)]
-        self._vboxmanage_execute(vbox_vector)
+        self._modify(vbox_vector)
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        vbox_vector = self._configure_clone_vector(vm, macs, vrde_port)
+        if len(vbox_vector) > 2:
+            self._modify(vbox_vector)
 
     def _get_running_vms(self):
         vbox_vector = ["list", "runningvms"]
-        out = self._vboxmanage_execute(vbox_vector)
+        out = self._query(vbox_vector)
         running_vms = self._vm_string_to_list(out)
         return running_vms
 
-    def _vm_string_to_list(self, vm_string):
+    @staticmethod
+    def _vm_string_to_list(vm_string):
         lines = vm_string.splitlines()
         vms = [line.split('"')[1] for line in lines]
         return vms
 
-    def _get_vm_info(self, vm):
-        vbox_vector = ["showvminfo", vm, "--machinereadable"]
-        out = self._vboxmanage_execute(vbox_vector)
+    @staticmethod
+    def _parse_snapshots(out):
+        out_lines = out.splitlines()
+        snapshot_lines = filter(lambda line: "=" in line, out_lines)
+        snapshots = [
+            value.strip('"')
+            for key, value in map(lambda line: line.split("=", maxsplit=1), snapshot_lines)
+            if key.strip('"').startswith("SnapshotName")
+        ]
+        return snapshots
+
+    @staticmethod
+    def _parse_vm_info_dict(out):
         out_lines = out.splitlines()
         info_lines = filter(lambda line: "=" in line, out_lines)
         vm_info = {
@@ -133,6 +198,52 @@ class VBoxController(VMMController):
         }
         return vm_info
 
+    @staticmethod
+    def _clone_vector(vm, snapshot, clone, linked=True):
+        options = ["--options", "link"] if linked else list()
+        return ["clonevm", vm, "--name", clone] + options + ["--snapshot", snapshot, "--register"]
+
+    @staticmethod
+    def _configure_clone_vector(vm, macs=None, vrde_port=None):
+        vbox_vector = ["modifyvm", vm]
+        for if_id, mac in sorted((macs or dict()).items()):
+            vbox_vector += ["--macaddress" + str(if_id), hex(mac)[2:].rjust(12, "0")]
+        if vrde_port is not None:
+            vbox_vector += ["--vrdeport", str(vrde_port)]
+        return vbox_vector
+
+    def _get_vm_info(self, vm):
+        vbox_vector = ["showvminfo", vm, "--machinereadable"]
+        out = self._query(vbox_vector)
+        return self._parse_vm_info_dict(out)
+
+    def invalidate_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_generation += 1
+
+    def _query(self, vbox_vector, max_age=None):
+        max_age = self.inventory_ttl if max_age is None else max_age
+        key = tuple(vbox_vector)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            generation = self._cache_generation
+        if cached is not None and time.monotonic() - cached[0] < max_age:
+            return cached[1]
+        queried_at = time.monotonic()
+        out = self._vboxmanage_execute(vbox_vector)
+        with self._cache_lock:
+            # Do not keep results that may predate a mutation which finished while we were querying
+            if self._cache_generation == generation:
+                self._cache[key] = (queried_at, out)
+        return out
+
+    def _modify(self, vbox_vector):
+        try:
+            return self._vboxmanage_execute(vbox_vector)
+        finally:
+            self.invalidate_cache()
+
     @staticmethod
     def _vboxmanage_execute(vbox_vector):
         call_vector = ["vboxmanage"] + vbox_vector
@@ -147,3 +258,91 @@ class VBoxController(VMMController):
 
 class LoggingVBoxController(LoggingVMMController, VBoxController):
     pass
+
+
+class AsyncVBoxController(AsyncVMMController):
+    async def get_vms(self):
+        out = await self._vboxmanage_execute(["list", "vms"])
+        return VBoxController._vm_string_to_list(out)
+
+    async def start(self, vm):
+        await self._vboxmanage_execute(["startvm", vm, "--type", "headless"])
+
+    async def poweroff(self, vm):
+        await self._vboxmanage_execute(["controlvm", vm, "poweroff"])
+
+    async def delete(self, vm):
+        await self._vboxmanage_execute(["unregistervm", vm, "--delete"])
+
+    async def is_running(self, vm):
+        out = await self._vboxmanage_execute(["list", "runningvms"])
+        return vm in VBoxController._vm_string_to_list(out)
+
+    async def get_inventory(self):
+        vms_out, running_out = await asyncio.gather(
+            self._vboxmanage_execute(["list", "vms"]), self._vboxmanage_execute(["list", "runningvms"])
+        )
+        running_vms = VBoxController._vm_string_to_list(running_out)
+        return {vm: vm in running_vms for vm in VBoxController._vm_string_to_list(vms_out)}
+
+    async def get_macs(self, vm):
+        return list((await self.get_vm_info(vm)).macs.values())
+
+    async def get_mac(self, vm, if_id=1):
+        try:
+            return (await self.get_vm_info(vm)).macs[if_id]
+        except KeyError:
+            raise VMMControllerException(
+                'Cannot find MAC address for interface {if_id} on VM "{vm}"'.format(if_id=if_id, vm=vm)
+            )
+
+    async def get_vm_info(self, vm):
+        out = await self._vboxmanage_execute(["showvminfo", vm, "--machinereadable"])
+        return parse_vm_info(out.splitlines(), vm=vm)
+
+    async def set_mac(self, vm, mac, if_id=1):
+        await self.configure_clone(vm, macs={if_id: mac})
+
+    async def get_snapshots(self, vm):
+        try:
+            out = await self._vboxmanage_execute(["snapshot", vm, "list", "--machinereadable"])
+        except VMMControllerException:
+            # Same as VBoxController: vboxmanage fails for VMs without snapshots
+            if vm in await self.get_vms():
+                return list()
+            raise
+        return VBoxController._parse_snapshots(out)
+
+    async def create_snapshot(self, vm, snapshot):
+        await self._vboxmanage_execute(["snapshot", vm, "take", snapshot])
+
+    async def delete_snapshot(self, vm, snapshot):
+        await self._vboxmanage_execute(["snapshot", vm, "delete", snapshot])
+
+    async def restore_snapshot(self, vm, snapshot):
+        await self._vboxmanage_execute(["snapshot", vm, "restore", snapshot])
+
+    async def clone(self, vm, snapshot, clone, linked=True):
+        await self._vboxmanage_execute(VBoxController._clone_vector(vm, snapshot, clone, linked))
+
+    async def set_credentials(self, vm, user, password, domain):
+        await self._vboxmanage_execute(["controlvm", vm, "setcredentials", user, password, domain])
+
+    async def set_vrde_port(self, vm, port):
+        await self.configure_clone(vm, vrde_port=port)
+
+    async def configure_clone(self, vm, macs=None, vrde_port=None):
+        vbox_vector = VBoxController._configure_clone_vector(vm, macs, vrde_port)
+        if len(vbox_vector) > 2:
+            await self._vboxmanage_execute(vbox_vector)
+
+    @staticmethod
+    async def _vboxmanage_execute(vbox_vector):
+        p = await asyncio.create_subprocess_exec("vboxmanage", *vbox_vector, stdout=PIPE, stderr=PIPE)
+        out, err = await p.communicate()
+        if p.returncode != 0:
+            raise VMMControllerException(
+                "Error in execution of {vector}\n" "-------\n" "{err}" "-------".format(
+                    vector=vbox_vector, err=err.decode(errors="replace"))
+            )
+        return out.decode(errors="replace")
@@ -18,10 +18,14 @@
 
 import cmd
 import shlex
+import threading
 from contextlib import suppress
 
 from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException
 
+# Commands report errors by printing them, batch mode needs to know whether the last command of a thread failed
+command_status = threading.local()
+
 
 class VMMConsole(cmd.Cmd):
     # intro = ""
@@ -31,6 +35,10 @@ class VMMConsole(cmd.Cmd):
         super().__init__()
         self.vmmc = vmm_controller
 
+    def is_exclusive(self, command):
+        # Batch mode runs exclusive commands one at a time, the controllers can take parallel calls
+        return False
+
     def do_get_vms(self, arg):
         with print_suppress(VMMControllerException):
             print(self.vmmc.get_vms())
@@ -55,6 +63,11 @@ class VMMConsole(cmd.Cmd):
         with print_suppress(VMMControllerException):
             print(self.vmmc.is_running(vm=args[0]))
 
+    def do_get_inventory(self, arg):
+        with print_suppress(VMMControllerException):
+            for vm, running in sorted(self.vmmc.get_inventory().items()):
+                print("{vm}: {state}".format(vm=vm, state="running" if running else "off"))
+
     def do_get_macs(self, arg):
         args = Parser().parse(arg)
         with print_suppress(VMMControllerException):
@@ -99,7 +112,7 @@ class VMMConsole(cmd.Cmd):
     def do_clone(self, arg):
         args = Parser().parse(arg)
         with print_suppress(VMMControllerException):
-            self.vmmc.clone(vm=args[0], snapshot=args[1], clone=args[2])
+            self.vmmc.clone(vm=args[0], snapshot=args[1], clone=args[2], linked="full" not in args[3:])
 
     def do_set_credentials(self, arg):
         args = Parser().parse(arg)
@@ -109,11 +122,17 @@ class VMMConsole(cmd.Cmd):
     def do_exit(self, arg):
         return True
 
+    @staticmethod
+    def print_error(e):
+        command_status.failed = True
+        print(e)
+
 
 class print_suppress(suppress):
     def __exit__(self, exctype, excinst, exctb):
         exception_is_suppressed = super().__exit__(exctype, excinst, exctb)
         if exception_is_suppressed:
+            command_status.failed = True
             print("*** {type}: {e}\n".format(type=exctype.__name__, e=excinst))
         return exception_is_suppressed
 
@@ -17,11 +17,63 @@
 
 
 import logging
+import os
+from types import SimpleNamespace
+
+from vmcontrol.parallel import run_parallel
 
 logger = logging.getLogger(__name__)
 
 
+class VMInfo(SimpleNamespace):
+    name = None
+    state = None
+    running = False
+    vrde_port = None
+    # Configured memory in MB and number of virtual CPUs
+    memory = None
+    cpus = None
+
+    def __init__(self, **kwargs):
+        # MAC addresses by interface id
+        kwargs.setdefault("macs", dict())
+        super().__init__(**kwargs)
+
+    def _asdict(self):
+        return {"name": self.name, "state": self.state, "running": self.running, "macs": self.macs,
+                "vrde_port": self.vrde_port, "memory": self.memory, "cpus": self.cpus}
+
+    @classmethod
+    def from_dict(cls, dict_):
+        # JSON turns the interface ids into strings
+        macs = {int(if_id): mac for if_id, mac in dict_["macs"].items()}
+        return cls(**dict(dict_, macs=macs))
+
+
+class HostInfo(SimpleNamespace):
+    # Memory in MB and number of CPU threads of the machine running the VMs
+    memory = None
+    cpus = None
+
+    def _asdict(self):
+        return {"memory": self.memory, "cpus": self.cpus}
+
+    @classmethod
+    def from_dict(cls, dict_):
+        return cls(**dict_)
+
+
+def local_host_info():
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2 ** 20
+    except (AttributeError, ValueError, OSError):
+        memory = None
+    return HostInfo(memory=memory, cpus=os.cpu_count())
+
+
 class VMMController:
+    max_parallel_operations = 1
+
     def get_vms(self):
         raise NotImplementedError()
 
@@ -58,7 +110,7 @@ class VMMController:
     def restore_snapshot(self, vm, snapshot):
         raise NotImplementedError()
 
-    def clone(self, vm, snapshot, clone):
+    def clone(self, vm, snapshot, clone, linked=True):
         raise NotImplementedError()
 
     def set_credentials(self, vm, user, password, domain):
@@ -67,6 +119,53 @@ class VMMController:
     def set_vrde_port(self, vm, port):
         raise NotImplementedError()
 
+    def set_credentials_many(self, credentials, timeout=None):
+        # credentials maps VMs to (user, password, domain). The timeout is for all VMs together and only
+        # matters for backends that have to wait for the guests.
+        self._for_each_vm(lambda vm: self.set_credentials(vm, *credentials[vm]), list(credentials))
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        for if_id, mac in sorted((macs or dict()).items()):
+            self.set_mac(vm, mac, if_id=if_id)
+        if vrde_port is not None:
+            self.set_vrde_port(vm, vrde_port)
+
+    def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        # Backends that can configure a clone while creating it override this
+        self.clone(vm, snapshot, clone, linked=linked)
+        self.configure_clone(clone, macs=macs, vrde_port=vrde_port)
+
+    def get_inventory(self):
+        # Maps every VM to whether it is running, as seen at one point in time
+        return {vm: self.is_running(vm) for vm in self.get_vms()}
+
+    def get_vm_info(self, vm):
+        running = self.is_running(vm)
+        macs = {if_id: mac for if_id, mac in enumerate(self.get_macs(vm), start=1)}
+        return VMInfo(name=vm, state="running" if running else "poweroff", running=running, macs=macs)
+
+    def get_vm_infos(self, vms):
+        return self._for_each_vm(self.get_vm_info, vms)
+
+    def get_host_info(self):
+        # Hypervisors running on this machine can use the local resources
+        return local_host_info()
+
+    def get_snapshots_many(self, vms):
+        return self._for_each_vm(self.get_snapshots, vms)
+
+    def create_snapshots(self, snapshots):
+        self._for_each_vm(lambda vm: self.create_snapshot(vm, snapshots[vm]), list(snapshots))
+
+    def _for_each_vm(self, func, vms):
+        results = run_parallel(
+            func, vms, max_workers=self.max_parallel_operations, exceptions=(VMMControllerException,)
+        )
+        errors = ["{vm}: {e}".format(vm=result.key, e=result.error) for result in results if not result.succeeded]
+        if errors:
+            raise VMMControllerException("Operation failed for some VMs:\n" + "\n".join(errors))
+        return {result.key: result.value for result in results}
+
 
 class VMMControllerException(Exception):
     pass
@@ -92,6 +191,14 @@ class LoggingVMMController(VMMController):
         )
         super().set_mac(vm, mac, if_id=if_id)
 
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        mac_strings = {if_id: hex(mac)[2:].rjust(12, "0") for if_id, mac in (macs or dict()).items()}
+        logger.debug(
+            'Configuring clone "{vm}" with MAC addresses {macs} and VRDE port {port}'.format(
+                vm=vm, macs=mac_strings, port=vrde_port)
+        )
+        super().configure_clone(vm, macs=macs, vrde_port=vrde_port)
+
     def create_snapshot(self, vm, snapshot):
         logger.debug('Creating snapshot "{snapshot}" for "{vm}"'.format(vm=vm, snapshot=snapshot))
         super().create_snapshot(vm, snapshot)
@@ -104,12 +211,15 @@ class LoggingVMMController(VMMController):
         logger.debug('Restoring snapshot "{snapshot}" of "{vm}"'.format(vm=vm, snapshot=snapshot))
         super().restore_snapshot(vm, snapshot)
 
-    def clone(self, vm, snapshot, clone):
-        logger.debug(
-            'Cloning "{vm}" with snapshot "{snapshot}" to "{clone}"'.format(vm=vm, snapshot=snapshot, clone=clone)
-        )
-        super().clone(vm, snapshot, clone)
+    def clone(self, vm, snapshot, clone, linked=True):
+        logger.debug('Cloning "{vm}" with snapshot "{snapshot}" to "{clone}" ({kind} clone)'.format(
+            vm=vm, snapshot=snapshot, clone=clone, kind="linked" if linked else "full"))
+        super().clone(vm, snapshot, clone, linked=linked)
 
     def set_credentials(self, vm, user, password, domain):
         logger.debug('Setting credentials of "{vm}" to {cred}'.format(vm=vm, cred=(user, password, domain)))
         super().set_credentials(vm, user, password, domain)
+
+    def set_credentials_many(self, credentials, timeout=None):
+        logger.debug("Setting credentials of {vms}".format(vms=list(credentials)))
+        super().set_credentials_many(credentials, timeout=timeout)
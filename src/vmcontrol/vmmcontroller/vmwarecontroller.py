@@ -16,15 +16,27 @@
 # along with SOCBED. If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+import logging
 import ssl
+import threading
 import time
-import sys
+from concurrent.futures import Future
 from types import SimpleNamespace
 
 from pyVim import connect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
-from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController
+from vmcontrol.parallel import TaskResult, run_parallel
+from vmcontrol.statewatcher import StateWatcher
+from vmcontrol.vmmcontroller.asyncvmmcontroller import ThreadedAsyncVMMController
+from vmcontrol.vmmcontroller.vmmcontroller import VMMController, VMMControllerException, LoggingVMMController, VMInfo, \
+    HostInfo
+
+logger = logging.getLogger(__name__)
+
+# vSphere power states in the words of VMInfo.state
+power_states = {"poweredOn": "running", "poweredOff": "poweroff", "suspended": "saved"}
 
 
 class ESXiServer(SimpleNamespace):
@@ -38,14 +50,297 @@ class ESXiServer(SimpleNamespace):
     data_store = None
 
 
+class VSphereInventory:
+    # Name index of all managed objects of some types below a container. It is built with one PropertyCollector
+    # retrieval and kept current by WaitForUpdatesEx in a background thread, so lookups need no round trips.
+    # Further properties of the objects are followed as well and can be waited for.
+    max_wait_seconds = 1
+
+    def __init__(self, content, container, types, properties=()):
+        self.content = content
+        self.container = container
+        self.types = list(types)
+        self.properties = list(properties)
+        self.error = None
+        self._entries = dict()
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._collector = None
+        self._view = None
+        self._version = ""
+
+    def start(self):
+        self._view = self.content.viewManager.CreateContainerView(self.container, self.types, True)
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name="traverseEntities", path="view", skip=False, type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=self._view, skip=True, selectSet=[traversal_spec])
+        property_specs = [vmodl.query.PropertyCollector.PropertySpec(
+            type=type, pathSet=["name", "parent"] + self.properties)
+                          for type in self.types]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=property_specs)
+        self._collector = self.content.propertyCollector.CreatePropertyCollector()
+        self._collector.CreateFilter(filter_spec, partialUpdates=True)
+        self._collect(maxWaitSeconds=0)
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+
+    @property
+    def running(self):
+        return self._thread is not None and self.error is None
+
+    def names(self, type):
+        with self._condition:
+            return {entry.name: entry.obj for entry in self._entries.values() if isinstance(entry.obj, type)}
+
+    def entries(self, type):
+        # Copies, the background thread keeps changing the originals
+        with self._condition:
+            return [self._copy(entry) for entry in self._entries.values() if isinstance(entry.obj, type)]
+
+    def entry(self, obj):
+        with self._condition:
+            entry = self._entries.get(obj._moId)
+            return None if entry is None else self._copy(entry)
+
+    def find(self, type, name, ancestor=None):
+        with self._condition:
+            for entry in self._entries.values():
+                if entry.name == name and isinstance(entry.obj, type) and (
+                        ancestor is None or self._is_ancestor(ancestor, entry)):
+                    return entry.obj
+        return None
+
+    def add(self, obj, name, parent=None):
+        with self._condition:
+            self._entries.setdefault(
+                obj._moId, SimpleNamespace(obj=obj, name=name, parent=parent, properties=dict()))
+
+    def remove(self, obj):
+        with self._condition:
+            self._entries.pop(obj._moId, None)
+
+    def set_property(self, obj, path, value):
+        # Results of our own tasks, the PropertyCollector may report them only a moment later
+        with self._condition:
+            entry = self._entries.get(obj._moId)
+            if entry is not None:
+                entry.properties[path] = value
+                self._condition.notify_all()
+
+    def discard_property(self, obj, path):
+        with self._condition:
+            entry = self._entries.get(obj._moId)
+            if entry is not None:
+                entry.properties.pop(path, None)
+
+    def wait_for(self, obj, path, value, timeout=None):
+        # Returns whether the property reached the value within the timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                entry = self._entries.get(obj._moId)
+                if entry is not None and entry.properties.get(path) == value:
+                    return True
+                if self.error is not None:
+                    raise VMMControllerException("Inventory failed: {e}".format(e=self.error))
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+
+    def apply_update_set(self, update_set):
+        with self._condition:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    moid = object_update.obj._moId
+                    if object_update.kind == "leave":
+                        self._entries.pop(moid, None)
+                        continue
+                    entry = self._entries.setdefault(moid, SimpleNamespace(obj=object_update.obj, name=None,
+                                                                           parent=None, properties=dict()))
+                    for change in object_update.changeSet:
+                        if change.name in ("name", "parent"):
+                            setattr(entry, change.name, change.val)
+                        else:
+                            entry.properties[change.name] = change.val
+            self._condition.notify_all()
+
+    @staticmethod
+    def _copy(entry):
+        return SimpleNamespace(obj=entry.obj, name=entry.name, parent=entry.parent, properties=dict(entry.properties))
+
+    def _is_ancestor(self, ancestor, entry):
+        parent = entry.parent
+        while parent is not None:
+            if parent == ancestor:
+                return True
+            parent_entry = self._entries.get(parent._moId)
+            parent = parent_entry.parent if parent_entry is not None else None
+        return False
+
+    def _collect(self, **options):
+        # Large inventories arrive in several truncated update sets
+        wait_options = vmodl.query.PropertyCollector.WaitOptions(**options)
+        while True:
+            update_set = self._collector.WaitForUpdatesEx(self._version, wait_options)
+            if update_set is None:
+                return
+            self._version = update_set.version
+            self.apply_update_set(update_set)
+            if not update_set.truncated:
+                return
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                self._collect(maxWaitSeconds=self.max_wait_seconds)
+        except Exception as e:
+            logger.warning("{cls} stopped: {e}".format(cls=type(self).__name__, e=e))
+            with self._condition:
+                self.error = e
+                self._condition.notify_all()
+        finally:
+            self._collector.Destroy()
+            self._view.Destroy()
+
+
+class VSphereTaskTracker:
+    # Waits for any number of vSphere tasks with one PropertyCollector instead of polling every task. Callers
+    # get a future per task, the background thread resolves it once the task succeeded or failed.
+    max_wait_seconds = 1
+
+    def __init__(self, content):
+        self.error = None
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread is not None and self.error is None
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+
+    def submit(self, function, *args, **kwargs):
+        return self.track(function(*args, **kwargs))
+
+    def track(self, task):
+        if self.error is not None:
+            raise VMMControllerException("Task tracker failed: {e}".format(e=self.error))
+        future = Future()
+        entry = SimpleNamespace(future=future, filter=None, state=None, result=None, error=None)
+        with self._lock:
+            self._pending[task._moId] = entry
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.Task, pathSet=["info.state", "info.result", "info.error"])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=[property_spec])
+        filter_ = self._collector.CreateFilter(filter_spec, partialUpdates=True)
+        with self._lock:
+            entry.filter = filter_
+            finished = task._moId not in self._pending
+        if finished:
+            filter_.Destroy()
+        return future
+
+    def execute_many(self, calls):
+        # calls maps keys to functions starting one task each, all tasks run at the same time.
+        # Results keep the order of calls, failing tasks have an error instead of raising.
+        results = [TaskResult(key=key, attempts=1) for key in calls]
+        futures = dict()
+        start = time.perf_counter()
+        for result in results:
+            try:
+                futures[result.key] = self.submit(calls[result.key])
+            except (vmodl.MethodFault, VMMControllerException) as e:
+                result.error = VMMControllerException(str(e))
+        for result in results:
+            if result.key in futures:
+                try:
+                    result.value = futures[result.key].result()
+                except VMMControllerException as e:
+                    result.error = e
+            result.duration = time.perf_counter() - start
+        return results
+
+    def apply_update_set(self, update_set):
+        finished = list()
+        with self._lock:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    moid = object_update.obj._moId
+                    entry = self._pending.get(moid)
+                    if entry is None:
+                        continue
+                    for change in object_update.changeSet:
+                        setattr(entry, change.name[len("info."):], change.val)
+                    if str(entry.state) in ("success", "error"):
+                        finished.append(self._pending.pop(moid))
+        for entry in finished:
+            if entry.filter is not None:
+                entry.filter.Destroy()
+            if str(entry.state) == "success":
+                entry.future.set_result(entry.result)
+            else:
+                entry.future.set_exception(
+                    VMMControllerException("ESX Server error:\n{err}".format(err=str(entry.error))))
+
+    def _run(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait_seconds)
+        version = ""
+        try:
+            while not self._stopping.is_set():
+                update_set = self._collector.WaitForUpdatesEx(version, options)
+                if update_set is None:
+                    continue
+                version = update_set.version
+                self.apply_update_set(update_set)
+        except Exception as e:
+            logger.warning("{cls} stopped: {e}".format(cls=type(self).__name__, e=e))
+            self.error = e
+        finally:
+            with self._lock:
+                pending, self._pending = list(self._pending.values()), dict()
+            for entry in pending:
+                entry.future.set_exception(VMMControllerException("Lost track of task: {e}".format(e=self.error)))
+            self._collector.Destroy()
+
+
 class VMWareController(VMMController):
+    max_parallel_operations = 8
+    inventory_types = [vim.Datacenter, vim.Datastore, vim.Folder, vim.ResourcePool]
+    vm_inventory_properties = ["guest.guestOperationsReady", "runtime.powerState", "config.hardware.device",
+                               "config.hardware.memoryMB", "config.hardware.numCPU"]
+    guest_operations_timeout = 600
+    guest_operations_retry_interval = 1
+
     def __init__(self, esxi_server):
         super().__init__()
         self.esxi = esxi_server
         self.si = None
+        self._inventory = None
+        self._vm_inventory = None
+        self._inventory_lock = threading.Lock()
+        self._task_tracker = None
         self._init_si()
 
     def __del__(self):
+        self._close_task_tracker()
+        self._close_inventories()
         self._close_si()
 
     def _init_si(self):
@@ -64,25 +359,110 @@ class VMWareController(VMMController):
             connect.Disconnect(self.si)
             print("Disconnected SI")
 
+    def _inventories(self):
+        # Built on first use, the VM index covers the VMs of the configured resource pool only
+        with self._inventory_lock:
+            if self._vm_inventory is None or not (self._inventory.running and self._vm_inventory.running):
+                self._close_inventories()
+                content = self.si.RetrieveContent()
+                inventory = VSphereInventory(content, content.rootFolder, self.inventory_types)
+                inventory.start()
+                self._inventory = inventory
+                container = content.rootFolder
+                resource_pool = self.esxi.resource_pool
+                if resource_pool is not None:
+                    container = self._find(inventory, vim.ResourcePool, resource_pool)
+                    if container is None:
+                        raise VMMControllerException(
+                            "No resource pool named {resource_pool} found".format(resource_pool=resource_pool))
+                vm_inventory = VSphereInventory(
+                    content, container, [vim.VirtualMachine], properties=self.vm_inventory_properties)
+                vm_inventory.start()
+                self._vm_inventory = vm_inventory
+            return self._inventory, self._vm_inventory
+
+    def _close_inventories(self):
+        for inventory in (getattr(self, "_inventory", None), getattr(self, "_vm_inventory", None)):
+            if inventory is not None:
+                inventory.stop()
+        self._inventory = None
+        self._vm_inventory = None
+
+    def task_tracker(self):
+        with self._inventory_lock:
+            if self._task_tracker is None or not self._task_tracker.running:
+                self._close_task_tracker()
+                self._task_tracker = VSphereTaskTracker(self.si.RetrieveContent())
+            return self._task_tracker
+
+    def _close_task_tracker(self):
+        task_tracker = getattr(self, "_task_tracker", None)
+        if task_tracker is not None:
+            task_tracker.stop()
+        self._task_tracker = None
+
+    def _find(self, inventory, type, name, ancestor=None):
+        obj = inventory.find(type, name, ancestor=ancestor)
+        if obj is None:
+            # Objects created by others may not have reached the index yet
+            obj = self._obj_dict(type, container=ancestor or inventory.container).get(name)
+            if obj is not None:
+                inventory.add(obj, name, parent=ancestor)
+        return obj
+
     def get_vms(self):
         vms = list(self._vm_obj_dict().keys())
         return vms
 
     def start(self, vm):
         vm_obj = self._vm_obj(vm)
-        self._vmware_execute_task(vm_obj.PowerOn)
+        self._vmware_execute_task(
+            vm_obj.PowerOn,
+            on_success=lambda result: self._inventories()[1].set_property(vm_obj, "runtime.powerState", "poweredOn"))
 
     def poweroff(self, vm):
         vm_obj = self._vm_obj(vm)
-        self._vmware_execute_task(vm_obj.PowerOff)
+        self._vmware_execute_task(
+            vm_obj.PowerOff,
+            on_success=lambda result: self._inventories()[1].set_property(vm_obj, "runtime.powerState", "poweredOff"))
 
     def delete(self, vm):
         vm_obj = self._vm_obj(vm)
-        self._vmware_execute_task(vm_obj.Destroy)
+        self._vmware_execute_task(vm_obj.Destroy, on_success=lambda result: self._inventories()[1].remove(vm_obj))
 
     def is_running(self, vm):
-        vm_obj = self._vm_obj(vm)
-        return vm_obj.runtime.powerState == "poweredOn"
+        return self._entry_property(self._vm_entry(vm), "runtime.powerState") == "poweredOn"
+
+    def get_inventory(self):
+        return {vm: self._entry_property(entry, "runtime.powerState") == "poweredOn"
+                for vm, entry in self._vm_entries().items()}
+
+    def get_vm_infos(self, vms):
+        entries = self._vm_entries()
+        missing_vms = [vm for vm in vms if vm not in entries]
+        if missing_vms:
+            raise VMMControllerException("No vms named {vms} found".format(vms=missing_vms))
+        return {vm: self._vm_info_of(entries[vm]) for vm in vms}
+
+    def get_vm_info(self, vm):
+        return self._vm_info_of(self._vm_entry(vm))
+
+    def _vm_info_of(self, entry):
+        power_state = str(self._entry_property(entry, "runtime.powerState"))
+        macs = dict()
+        for dev in self._entry_property(entry, "config.hardware.device") or list():
+            if isinstance(dev, vim.vm.device.VirtualEthernetCard) and dev.macAddress:
+                if_id = int(dev.deviceInfo.label.rsplit(" ", 1)[-1])
+                macs[if_id] = int(dev.macAddress.replace(":", ""), 16)
+        return VMInfo(name=entry.name, state=power_states.get(power_state, power_state),
+                      running=power_state == "poweredOn", macs=macs,
+                      memory=self._entry_property(entry, "config.hardware.memoryMB"),
+                      cpus=self._entry_property(entry, "config.hardware.numCPU"))
+
+    def get_host_info(self):
+        # Resources of the cluster or standalone host that owns the resource pool
+        summary = self._resource_pool_obj(self.esxi.resource_pool).owner.summary
+        return HostInfo(memory=summary.totalMemory // 2 ** 20, cpus=summary.numCpuThreads)
 
     def get_macs(self, vm):
         mac_strs = [vec_obj.macAddress
@@ -106,28 +486,84 @@ class VMWareController(VMMController):
                     .format(label=adapter_label, vm=vm))
 
     def set_mac(self, vm, mac, if_id=1):
+        self._reconfigure(vm, macs={if_id: mac})
+
+    def set_vrde_port(self, vm, port):
+        self._reconfigure(vm, vrde_port=port)
+
+    def configure_clone(self, vm, macs=None, vrde_port=None):
+        if macs or vrde_port is not None:
+            self._reconfigure(vm, macs=macs, vrde_port=vrde_port)
+
+    def _reconfigure(self, vm, macs=None, vrde_port=None):
+        # All changes in one ReconfigVM task
         vm_obj = self._vm_obj(vm)
-        vec_obj = self._virtual_ethernet_card_obj(vm, self._adapter_label(if_id))
-        tmp_mac_str = hex(mac)[2:].upper().rjust(12, "0")
-        mac_str = ":".join([tmp_mac_str[2 * i:2 * (i + 1)] for i in range(6)])
-        vd_spec_obj = vim.vm.device.VirtualDeviceSpec()
-        vd_spec_obj.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
-        vd_spec_obj.device = vec_obj
-        vd_spec_obj.device.addressType = "manual"
-        vd_spec_obj.device.macAddress = mac_str
-        dev_changes = [vd_spec_obj]
+        config_spec_obj = self._config_spec(vm, vm_obj.config.hardware.device, macs=macs, vrde_port=vrde_port)
+        self._vmware_execute_task(
+            vm_obj.ReconfigVM_Task, spec=config_spec_obj,
+            on_success=lambda result: self._inventories()[1].discard_property(vm_obj, "config.hardware.device"))
+
+    def _config_spec(self, vm, devices, macs=None, vrde_port=None):
         config_spec_obj = vim.vm.ConfigSpec()
-        config_spec_obj.deviceChange = dev_changes
-        self._vmware_execute_task(vm_obj.ReconfigVM_Task, spec=config_spec_obj)
+        config_spec_obj.deviceChange = self._mac_device_changes(vm, devices, macs)
+        config_spec_obj.extraConfig = self._vnc_options(vrde_port)
+        return config_spec_obj
+
+    def _mac_device_changes(self, vm, devices, macs):
+        vec_objs = self._virtual_ethernet_card_obj_dict_of(devices)
+        dev_changes = list()
+        for if_id, mac in sorted((macs or dict()).items()):
+            adapter_label = self._adapter_label(if_id)
+            if adapter_label not in vec_objs:
+                raise VMMControllerException(
+                    "No network adapter labeled {label} on {vm}".format(label=adapter_label, vm=vm))
+            tmp_mac_str = hex(mac)[2:].upper().rjust(12, "0")
+            mac_str = ":".join([tmp_mac_str[2 * i:2 * (i + 1)] for i in range(6)])
+            vd_spec_obj = vim.vm.device.VirtualDeviceSpec()
+            vd_spec_obj.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+            vd_spec_obj.device = vec_objs[adapter_label]
+            vd_spec_obj.device.addressType = "manual"
+            vd_spec_obj.device.macAddress = mac_str
+            dev_changes.append(vd_spec_obj)
+        return dev_changes
+
+    @staticmethod
+    def _vnc_options(port):
+        # The VMware counterpart of a VRDE port is the VNC console of the VM
+        if port is None:
+            return list()
+        return [vim.option.OptionValue(key="RemoteDisplay.vnc.enabled", value="true"),
+                vim.option.OptionValue(key="RemoteDisplay.vnc.port", value=str(port))]
 
     def get_snapshots(self, vm):
         snapshots = list(self._snapshot_obj_dict(vm).keys())
         return snapshots
 
+    def get_snapshots_many(self, vms):
+        vm_dict = self._vm_obj_dict()
+        missing_vms = [vm for vm in vms if vm not in vm_dict]
+        if missing_vms:
+            raise VMMControllerException("No vms named {vms} found".format(vms=missing_vms))
+        snap_dicts = self._for_each_vm(lambda vm: self._snapshot_obj_dict_of(vm_dict[vm]), vms)
+        return {vm: list(snap_dict.keys()) for vm, snap_dict in snap_dicts.items()}
+
     def create_snapshot(self, vm, snapshot):
         vm_obj = self._vm_obj(vm)
         self._vmware_execute_task(vm_obj.CreateSnapshot, name=snapshot, memory=False, quiesce=False)
 
+    def create_snapshots(self, snapshots):
+        vm_dict = self._vm_obj_dict()
+        missing_vms = [vm for vm in snapshots if vm not in vm_dict]
+        if missing_vms:
+            raise VMMControllerException("No vms named {vms} found".format(vms=missing_vms))
+        results = self.task_tracker().execute_many({
+            vm: lambda vm=vm: vm_dict[vm].CreateSnapshot(name=snapshots[vm], memory=False, quiesce=False)
+            for vm in snapshots
+        })
+        errors = ["{vm}: {e}".format(vm=result.key, e=result.error) for result in results if not result.succeeded]
+        if errors:
+            raise VMMControllerException("Operation failed for some VMs:\n" + "\n".join(errors))
+
     def delete_snapshot(self, vm, snapshot):
         snap_obj = self._snapshot_obj(vm, snapshot)
         self._vmware_execute_task(snap_obj.Remove, removeChildren=False, consolidate=True)
@@ -136,22 +572,62 @@ class VMWareController(VMMController):
         snap_obj = self._snapshot_obj(vm, snapshot)
         self._vmware_execute_task(snap_obj.Revert)
 
-    def clone(self, vm, snapshot, clone):
+    def clone(self, vm, snapshot, clone, linked=True):
+        self._clone(vm, snapshot, clone, linked=linked)
+
+    def _clone(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
         vm_obj = self._vm_obj(vm)
-        snapshot_obj = self._snapshot_obj_dict(vm)[snapshot]
+        snapshot_obj = self._snapshot_obj(vm, snapshot)
         data_store = self._data_store_obj(self.esxi.data_store)
         dest_folder = self._vm_folder_obj(self.esxi.vm_folder, self.esxi.data_center)
         resource_pool = self._resource_pool_obj(self.esxi.resource_pool)
         relospec = vim.vm.RelocateSpec()
-        relospec.diskMoveType = "createNewChildDiskBacking"
+        relospec.diskMoveType = "createNewChildDiskBacking" if linked else "moveAllDiskBackingsAndDisallowSharing"
         relospec.datastore = data_store
         relospec.pool = resource_pool
         clonespec = vim.vm.CloneSpec()
         clonespec.location = relospec
         clonespec.snapshot = snapshot_obj
-        self._vmware_execute_task(vm_obj.Clone, folder=dest_folder, name=clone, spec=clonespec)
+        if macs or vrde_port is not None:
+            # The clone is created with its own MAC addresses and console port, no ReconfigVM afterwards
+            clonespec.config = self._config_spec(vm, self._snapshot_devices(snapshot_obj), macs=macs,
+                                                 vrde_port=vrde_port)
+        self._vmware_execute_task(vm_obj.Clone, folder=dest_folder, name=clone, spec=clonespec,
+                                  on_success=self._add_clone(clone, dest_folder))
+
+    def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        self._clone(vm, snapshot, clone, linked=linked, macs=macs, vrde_port=vrde_port)
+
+    def _add_clone(self, clone, dest_folder):
+        # Clone tasks return the new VM, which is indexed right away instead of waiting for the next update set
+        def add(clone_obj):
+            if clone_obj is not None:
+                self._inventories()[1].add(clone_obj, clone, parent=dest_folder)
+        return add
 
     def set_credentials(self, vm, user, password, domain):
+        self._set_credentials(vm, user, password, domain, time.monotonic() + self.guest_operations_timeout)
+
+    def set_credentials_many(self, credentials, timeout=None):
+        # Clones mostly wait for their guests to boot, so all of them wait at once until one common deadline
+        timeout = self.guest_operations_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        results = run_parallel(
+            lambda vm: self._set_credentials(vm, *credentials[vm], deadline), list(credentials),
+            max_workers=len(credentials), exceptions=(VMMControllerException,)
+        )
+        errors = ["{vm}: {e}".format(vm=result.key, e=result.error) for result in results if not result.succeeded]
+        if errors:
+            raise VMMControllerException("Operation failed for some VMs:\n" + "\n".join(errors))
+
+    def wait_for_guest_operations(self, vm, timeout=None):
+        vm_obj = self._vm_obj(vm)
+        if not self._inventories()[1].wait_for(vm_obj, "guest.guestOperationsReady", True, timeout=timeout):
+            raise VMMControllerException(
+                'Guest operations of "{vm}" not ready within {timeout:.0f}s'.format(vm=vm, timeout=timeout))
+        return vm_obj
+
+    def _set_credentials(self, vm, user, password, domain, deadline):
         local_admin_user = "breach"
         local_admin_password = "breach"
         # local_admin_domain = "client"
@@ -168,61 +644,62 @@ class VMWareController(VMMController):
             "New-ItemProperty -Path $winlogon_registry_key -Name AutoAdminLogon -Value 1 -Force",
             "Restart-Computer"
         ])
-        vm_obj = self._vm_obj(vm)
         cred_obj = vim.vm.guest.NamePasswordAuthentication(
             username=local_admin_user, password=local_admin_password)
-        gom = self.si.content.guestOperationsManager
+        gom = self._inventories()[1].content.guestOperationsManager
         program_spec = vim.vm.guest.ProcessManager.ProgramSpec(
             programPath=powershell_exe,
             arguments=change_autologon_script,
             workingDirectory="C:\\BREACH"
         )
-        executed = False
-        print("running.", end="")
-        sys.stdout.flush()
-        while not executed:
+        while True:
+            vm_obj = self.wait_for_guest_operations(vm, timeout=max(0, deadline - time.monotonic()))
             try:
                 gom.processManager.StartProgramInGuest(vm_obj, cred_obj, program_spec)
-                executed = True
-                print("success")
+                return
             except vim.fault.GuestOperationsUnavailable as e:
-                print(".", end="")
-                sys.stdout.flush()
-                time.sleep(1)
-
-    def _resource_pool_obj(self, resource_pool, content=None):
-        try:
-            return self._obj_dict(vim.ResourcePool, content=content)[resource_pool]
-        except KeyError:
+                # Guest tools may report readiness a moment before they accept operations
+                if time.monotonic() + self.guest_operations_retry_interval > deadline:
+                    raise VMMControllerException('Guest operations of "{vm}" unavailable: {e}'.format(vm=vm, e=e))
+                time.sleep(self.guest_operations_retry_interval)
+            except vmodl.MethodFault as e:
+                raise VMMControllerException(
+                    'Could not set credentials of "{vm}": {e}'.format(vm=vm, e=e.msg or type(e).__name__)
+                )
+
+    def _resource_pool_obj(self, resource_pool):
+        obj = self._find(self._inventories()[0], vim.ResourcePool, resource_pool)
+        if obj is None:
             raise VMMControllerException(
                 "No resource pool named {resource_pool} found".format(resource_pool=resource_pool))
+        return obj
 
-    def _data_store_obj(self, data_store, content=None):
-        try:
-            return self._obj_dict(vim.Datastore, content=content)[data_store]
-        except KeyError:
+    def _data_store_obj(self, data_store):
+        obj = self._find(self._inventories()[0], vim.Datastore, data_store)
+        if obj is None:
             raise VMMControllerException("No data store named {data_store} found".format(data_store=data_store))
+        return obj
 
-    def _data_center_obj(self, data_center, content=None):
-        try:
-            return self._obj_dict(vim.Datacenter, content=content)[data_center]
-        except KeyError:
+    def _data_center_obj(self, data_center):
+        obj = self._find(self._inventories()[0], vim.Datacenter, data_center)
+        if obj is None:
             raise VMMControllerException("No data center named {data_center} found".format(data_center=data_center))
+        return obj
 
-    def _vm_folder_obj(self, vm_folder, data_center, content=None):
+    def _vm_folder_obj(self, vm_folder, data_center):
         data_center_obj = self._data_center_obj(data_center)
-        try:
-            return self._obj_dict(vim.Folder, content=content, container=data_center_obj.vmFolder)[vm_folder]
-        except KeyError:
+        obj = self._find(self._inventories()[0], vim.Folder, vm_folder, ancestor=data_center_obj)
+        if obj is None:
             raise VMMControllerException(
                 "No folder named {vm_folder} on {data_center} found".format(vm_folder=vm_folder,
                                                                             data_center=data_center))
+        return obj
 
-    def _vm_obj(self, vm, content=None):
-        try:
-            return self._vm_obj_dict(content=content)[vm]
-        except KeyError:
+    def _vm_obj(self, vm):
+        obj = self._find(self._inventories()[1], vim.VirtualMachine, vm)
+        if obj is None:
             raise VMMControllerException("No vm named {vm} found".format(vm=vm))
+        return obj
 
     def _snapshot_obj(self, vm, snapshot):
         try:
@@ -239,33 +716,52 @@ class VMWareController(VMMController):
     def _adapter_label(self, vmware_adapter_id):
         return "Network adapter {adapter_id}".format(adapter_id=vmware_adapter_id)
 
-    def _vm_obj_dict(self, content=None):
-        content = content or self.si.RetrieveContent()
+    def _vm_obj_dict(self):
+        return self._inventories()[1].names(vim.VirtualMachine)
+
+    def _vm_entries(self):
+        return {entry.name: entry for entry in self._inventories()[1].entries(vim.VirtualMachine)}
+
+    def _vm_entry(self, vm):
+        vm_obj = self._vm_obj(vm)
+        entry = self._inventories()[1].entry(vm_obj)
+        return entry or SimpleNamespace(obj=vm_obj, name=vm, parent=None, properties=dict())
+
+    @staticmethod
+    def _entry_property(entry, path):
+        # Read from the object itself if the PropertyCollector has not reported the property (yet)
+        if path in entry.properties:
+            return entry.properties[path]
+        value = entry.obj
+        for name in path.split("."):
+            value = None if value is None else getattr(value, name)
+        return value
+
+    def _vm_container_obj(self, content):
         if self.esxi.resource_pool is not None:
-            container = self._resource_pool_obj(self.esxi.resource_pool, content=content)
-        else:
-            container = content.rootFolder
-        viewType = [vim.VirtualMachine]
-        recursive = True
-        containerView = content.viewManager.CreateContainerView(
-            container, viewType, recursive)
-        VmList = containerView.view
-        vm_dict = {vm_obj.name: vm_obj for vm_obj in VmList}
-        return vm_dict
+            return self._resource_pool_obj(self.esxi.resource_pool)
+        return content.rootFolder
 
     def _obj_dict(self, type, content=None, container=None):
+        # Full scan with one round trip per object, only used if the inventory index misses
         content = content or self.si.RetrieveContent()
         container = container or content.rootFolder
         viewType = [type]
         recursive = True
         containerView = content.viewManager.CreateContainerView(
             container, viewType, recursive)
-        ViewList = containerView.view
-        obj_dict = {obj.name: obj for obj in ViewList}
+        try:
+            ViewList = containerView.view
+            obj_dict = {obj.name: obj for obj in ViewList}
+        finally:
+            containerView.Destroy()
         return obj_dict
 
     def _snapshot_obj_dict(self, vm):
-        vm_obj = self._vm_obj(vm)
+        return self._snapshot_obj_dict_of(self._vm_obj(vm))
+
+    @staticmethod
+    def _snapshot_obj_dict_of(vm_obj):
         if vm_obj.snapshot is None:
             return dict()
         snapshot_root = vm_obj.snapshot.rootSnapshotList
@@ -280,37 +776,154 @@ class VMWareController(VMMController):
         return snap_dict
 
     def _virtual_ethernet_card_obj_dict(self, vm):
-        vm_obj = self._vm_obj(vm)
+        return self._virtual_ethernet_card_obj_dict_of(self._vm_obj(vm).config.hardware.device)
+
+    @staticmethod
+    def _virtual_ethernet_card_obj_dict_of(devices):
         d = {dev.deviceInfo.label: dev
-             for dev in vm_obj.config.hardware.device
+             for dev in devices
              if isinstance(dev, vim.vm.device.VirtualEthernetCard)}
         return d
 
     @staticmethod
-    def _vmware_execute_task(function, *args, **kwargs):
-        task = function(*args, **kwargs)
-        last_state = ""
-        while True:
-            state = task.info.state
-            if last_state == state:
-                print(".", end="")
-            elif state == "running":
-                print("running.", end="")
-            elif state == "queued":
-                print("queued.", end="")
-            elif state == "success":
-                print("success")
-                return task.info.result
-            elif state == "error":
-                print()
-                raise VMMControllerException("ESX Server error:\n{err}".format(err=str(task.info.error)))
-            else:
-                print()
-                raise VMMControllerException("Unknown task state:\n{task}".format(task=task.info))
-            last_state = state
-            sys.stdout.flush()
-            time.sleep(0.1)
+    def _snapshot_devices(snapshot_obj):
+        return snapshot_obj.config.hardware.device
+
+    def _vmware_execute_task(self, function, *args, on_success=None, **kwargs):
+        # on_success updates the index with the result of the task
+        result = self.task_tracker().submit(function, *args, **kwargs).result()
+        if on_success is not None:
+            on_success(result)
+        return result
 
 
 class LoggingVMWareController(LoggingVMMController, VMWareController):
     pass
+
+
+class TaskStartingVMWareController(VMWareController):
+    # Starts vSphere tasks without waiting for them, the last task started by a thread is kept for it
+    def __init__(self, esxi_server):
+        self._started = threading.local()
+        super().__init__(esxi_server)
+
+    def _vmware_execute_task(self, function, *args, on_success=None, **kwargs):
+        self._started.task = function(*args, **kwargs), on_success
+
+    def pop_started_task(self):
+        started, self._started.task = getattr(self._started, "task", None), None
+        return started or (None, None)
+
+
+class AsyncVMWareController(ThreadedAsyncVMMController):
+    # Blocking lookups run in worker threads, while waiting for task completion only occupies the event loop
+    def __init__(self, esxi_server):
+        super().__init__(TaskStartingVMWareController(esxi_server))
+
+    async def start(self, vm):
+        await self._execute_task(self.vmmc.start, vm)
+
+    async def poweroff(self, vm):
+        await self._execute_task(self.vmmc.poweroff, vm)
+
+    async def delete(self, vm):
+        await self._execute_task(self.vmmc.delete, vm)
+
+    async def set_mac(self, vm, mac, if_id=1):
+        await self._execute_task(self.vmmc.set_mac, vm, mac, if_id=if_id)
+
+    async def create_snapshot(self, vm, snapshot):
+        await self._execute_task(self.vmmc.create_snapshot, vm, snapshot)
+
+    async def delete_snapshot(self, vm, snapshot):
+        await self._execute_task(self.vmmc.delete_snapshot, vm, snapshot)
+
+    async def restore_snapshot(self, vm, snapshot):
+        await self._execute_task(self.vmmc.restore_snapshot, vm, snapshot)
+
+    async def clone(self, vm, snapshot, clone, linked=True):
+        await self._execute_task(self.vmmc.clone, vm, snapshot, clone, linked=linked)
+
+    async def set_vrde_port(self, vm, port):
+        await self._execute_task(self.vmmc.set_vrde_port, vm, port)
+
+    async def configure_clone(self, vm, macs=None, vrde_port=None):
+        if macs or vrde_port is not None:
+            await self._execute_task(self.vmmc.configure_clone, vm, macs=macs, vrde_port=vrde_port)
+
+    async def clone_and_configure(self, vm, snapshot, clone, linked=True, macs=None, vrde_port=None):
+        # The clone is configured by its clone spec, this is a single task
+        await self._execute_task(
+            self.vmmc.clone_and_configure, vm, snapshot, clone, linked=linked, macs=macs, vrde_port=vrde_port)
+
+    async def _execute_task(self, method, *args, **kwargs):
+        task, on_success = await asyncio.to_thread(self._start_task, method, *args, **kwargs)
+        result = await self._wait_for_task(task)
+        if on_success is not None:
+            on_success(result)
+        return result
+
+    def _start_task(self, method, *args, **kwargs):
+        method(*args, **kwargs)
+        return self.vmmc.pop_started_task()
+
+    async def _wait_for_task(self, task):
+        future = await asyncio.to_thread(lambda: self.vmmc.task_tracker().track(task))
+        return await asyncio.wrap_future(future)
+
+
+class VSphereStateWatcher(StateWatcher):
+    # Follows runtime.powerState of all VMs through PropertyCollector.WaitForUpdatesEx
+    max_wait_seconds = 1
+
+    def __init__(self, vmware_controller: VMWareController):
+        super().__init__()
+        self.vmwc = vmware_controller
+        self._names = dict()
+        self._power_states = dict()
+
+    def watch(self):
+        content = self.vmwc.si.RetrieveContent()
+        view = content.viewManager.CreateContainerView(self.vmwc._vm_container_obj(content), [vim.VirtualMachine], True)
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name="traverseEntities", path="view", skip=False, type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine, pathSet=["name", "runtime.powerState"])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=[property_spec])
+        collector = content.propertyCollector.CreatePropertyCollector()
+        collector.CreateFilter(filter_spec, partialUpdates=True)
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait_seconds)
+        version = ""
+        try:
+            while not self.stopping:
+                update_set = collector.WaitForUpdatesEx(version, options)
+                if update_set is None:
+                    continue
+                version = update_set.version
+                self.apply_update_set(update_set, initial=not self._ready.is_set())
+        finally:
+            collector.Destroy()
+            view.Destroy()
+
+    def apply_update_set(self, update_set, initial=False):
+        for filter_update in update_set.filterSet:
+            for object_update in filter_update.objectSet:
+                moid = object_update.obj._moId
+                if object_update.kind == "leave":
+                    self._power_states.pop(moid, None)
+                    self.update(self._names.pop(moid, None), None)
+                    continue
+                for change in object_update.changeSet:
+                    if change.name == "name":
+                        self._names[moid] = change.val
+                    elif change.name == "runtime.powerState":
+                        self._power_states[moid] = str(change.val)
+        states = {self._names[moid]: power_states.get(power_state, power_state)
+                  for moid, power_state in self._power_states.items() if moid in self._names}
+        if initial:
+            self.update_all(states)
+        else:
+            for vm, state in states.items():
+                self.update(vm, state)
+